@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional
 from pydantic import BaseModel
 
 class ConfigData(BaseModel):
@@ -6,6 +6,13 @@ class ConfigData(BaseModel):
     number_of_users: int
     max_posts_per_user: int
     max_likes_per_user: int
+    # number of requests sent to api at once
+    concurrency: int = 10
+    # run reports are written to report_path.json and report_path.txt
+    report_path: str = 'bot-report'
+    # "http" sends requests to api_url over network, "asgi" calls
+    # server.main:app in the same process without uvicorn and sockets
+    transport: Literal['http', 'asgi'] = 'http'
 
 
 class ConfigReaderBase:
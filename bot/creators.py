@@ -1,6 +1,9 @@
-from typing import Dict, Optional, Union
+import asyncio
+import time
+from typing import Any, Dict, Optional, Union
 from abc import ABC, abstractmethod
 from pydantic.main import BaseModel
+import httpx
 import requests
 from .services import (
     UserData,
@@ -11,8 +14,10 @@ from .services import (
     PostCreate,
     LikeData,
     InstanceCreatorInterafce,
+    AsyncInstanceCreatorInterface,
     GenerationError
 )
+from .metrics import MetricsRecorder, metrics
 
 class ApiError(GenerationError):
     
@@ -22,19 +27,38 @@ class ApiError(GenerationError):
 
 
 class InstanceCreatorApi(InstanceCreatorInterafce):
+    # shared by all creators, keeps connections alive between requests
+    _session = requests.Session()
 
     def create_instance(self, data: BaseModel, **kwargs) -> BaseModel:
         NotImplemented
 
-    def _request(self, method: str, url: str, json: Optional[Dict] = None, headers: Optional[Dict] = None) -> Dict:
+    def _request(
+        self,
+        method: str,
+        url: str,
+        json: Optional[Dict] = None,
+        headers: Optional[Dict] = None,
+        endpoint: Optional[str] = None,
+    ) -> Dict:
+        '''
+        endpoint is url template the request is counted under in metrics, url by default
+        '''
         if headers is None:
             headers = {}
-        response = requests.request(
-            method,
-            url,
-            headers=headers,
-            json=json,
-        )
+        name = MetricsRecorder.endpoint_name(method, endpoint or url)
+        start = time.perf_counter()
+        try:
+            response = self._session.request(
+                method,
+                url,
+                headers=headers,
+                json=json,
+            )
+        except requests.RequestException:
+            metrics.record(name, 0, time.perf_counter() - start)
+            raise
+        metrics.record(name, response.status_code, time.perf_counter() - start)
         if not (200 <= response.status_code <= 299):
             raise ApiError(status_code=response.status_code)
         return response.json()
@@ -96,7 +120,8 @@ class ApiLikeCreator(InstanceCreatorApi):
             self._request(
                 'POST',
                 self._post_like_url.format(post_id=str(post.id)),
-                headers={'Authorization': f'Bearer {user.access_token}'}
+                headers={'Authorization': f'Bearer {user.access_token}'},
+                endpoint=self._post_like_url,
             )
         except ApiError as error:
             status = "Can't like"
@@ -105,3 +130,148 @@ class ApiLikeCreator(InstanceCreatorApi):
             username = user.username,
             status = status
         ) 
+
+
+
+class AsyncApiClient:
+    '''
+    Shared keep-alive connection pool for async creators, at most concurrency
+    requests are sent at once. Requests rejected by server with 503 are retried
+    after Retry-After seconds. Every attempt is timed into metrics.
+
+    When ASGI app is given requests are passed to it in the same process
+    instead of network, app startup and shutdown events are run on enter and exit.
+    '''
+
+    def __init__(
+        self,
+        concurrency: int,
+        retries: int = 5,
+        timeout: float = 30,
+        metrics: MetricsRecorder = metrics,
+        app: Optional[Any] = None,
+    ) -> None:
+        self._app = app
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            timeout=timeout,
+            follow_redirects=True,
+            transport=None if app is None else httpx.ASGITransport(app=app),
+        )
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._retries = retries
+        self.metrics = metrics
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        json: Optional[Dict] = None,
+        headers: Optional[Dict] = None,
+        endpoint: Optional[str] = None,
+    ) -> Dict:
+        '''
+        endpoint is url template the request is counted under in metrics, url by default
+        '''
+        name = MetricsRecorder.endpoint_name(method, endpoint or url)
+        for attempt in range(self._retries + 1):
+            async with self._semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await self._client.request(method, url, json=json, headers=headers)
+                except httpx.HTTPError:
+                    self.metrics.record(name, 0, time.perf_counter() - start)
+                    raise
+                self.metrics.record(name, response.status_code, time.perf_counter() - start)
+            if response.status_code != 503 or attempt == self._retries:
+                break
+            await asyncio.sleep(float(response.headers.get('Retry-After', 1)))
+        if not (200 <= response.status_code <= 299):
+            raise ApiError(status_code=response.status_code)
+        return response.json()
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+    async def __aenter__(self) -> 'AsyncApiClient':
+        if self._app is not None:
+            await self._app.router.startup()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.aclose()
+        if self._app is not None:
+            await self._app.router.shutdown()
+
+
+def load_app() -> Any:
+    '''
+    Imports server app for in-process transport, server settings are read
+    from environment the same way as when server is started
+    '''
+    from server.main import app
+    return app
+
+
+class AsyncInstanceCreatorApi(AsyncInstanceCreatorInterface):
+    def __init__(self, client: AsyncApiClient) -> None:
+        self._client = client
+
+    async def create_instance(self, data: BaseModel, **kwargs) -> BaseModel:
+        NotImplemented
+
+
+class AsyncApiUserCreator(AsyncInstanceCreatorApi):
+    def __init__(self, client: AsyncApiClient, register_url: str, login_url: str) -> None:
+        super().__init__(client)
+        self._register_url = register_url
+        self._login_url = login_url
+
+    async def create_instance(self, user_data: UserCreate) -> UserData:
+        await self._client.request('POST', self._register_url, json=user_data.dict())
+        data = await self._client.request('POST', self._login_url, json=user_data.dict())
+        return UserData(
+            **user_data.dict(),
+            **JwtTokenPair(**data).dict(),
+        )
+
+
+class AsyncApiPostCreator(AsyncInstanceCreatorApi):
+    def __init__(self, client: AsyncApiClient, post_create_url: str) -> None:
+        super().__init__(client)
+        self._post_create_url = post_create_url
+
+    async def create_instance(self, user: UserData, post_data: PostCreate) -> Post:
+        data = await self._client.request(
+            'POST',
+            self._post_create_url,
+            json=post_data.dict(),
+            headers={'Authorization': f'Bearer {user.access_token}'}
+        )
+        return Post(**data)
+
+
+class AsyncApiLikeCreator(AsyncInstanceCreatorApi):
+    def __init__(self, client: AsyncApiClient, post_like_url: str) -> None:
+        '''
+        post_like_url should be string with format like "api/posts/{post_id}/like"
+        '''
+        super().__init__(client)
+        self._post_like_url = post_like_url
+
+    async def create_instance(self, user: UserData, post: Post) -> LikeData:
+        status = "Liked"
+        try:
+            await self._client.request(
+                'POST',
+                self._post_like_url.format(post_id=str(post.id)),
+                headers={'Authorization': f'Bearer {user.access_token}'},
+                endpoint=self._post_like_url,
+            )
+        except ApiError as error:
+            status = "Can't like"
+        return LikeData(
+            post_id = str(post.id),
+            username = user.username,
+            status = status
+        )
@@ -1,54 +1,79 @@
+import asyncio
+import time
 from random import randint
-from bot.config import Config, JsonConfigReader
+from bot.config import Config, ConfigData, JsonConfigReader
 from bot.services import UserGenerator, PostGenerator, UserLikesGenerator
-from bot.creators import ApiUserCreator, ApiPostCreator, ApiLikeCreator
+from bot.metrics import metrics, format_report
+from bot.creators import load_app, AsyncApiClient, AsyncApiUserCreator, AsyncApiPostCreator, AsyncApiLikeCreator
 from bot.randomizers import TimeUserRandomizer, SimplePostRandomizer
 
-if __name__ == "__main__":
-    config = Config(JsonConfigReader('./bot-config.json')).get_config()
-    print('Starting automated bot')
-    print('Config:', *str(config).split(), sep='\n  ')
-    
-    # generating users
-    print('Creating users')
-    user_generator = UserGenerator(
-        ApiUserCreator(
-            config.api_url + '/users/register',
-            config.api_url + '/users/login',
-        ),
-        TimeUserRandomizer()
-    )
-    users = user_generator.generate(
-        config.number_of_users
-    )
-    print('Users:', *[u.username for u in users], sep='\n  ')
 
-    #generating posts
-    print('Creating posts')
-    post_generator = PostGenerator(
-        ApiPostCreator(
-            config.api_url + '/posts',
-        ),
-        SimplePostRandomizer()
-    )
-    for user in users:
-        post_generator.generate(
-            randint(1, config.max_posts_per_user),
-            user
+async def run_bot(config: ConfigData) -> None:
+    app = load_app() if config.transport == 'asgi' else None
+    async with AsyncApiClient(config.concurrency, app=app) as client:
+        # generating users
+        print('Creating users')
+        start = time.perf_counter()
+        user_generator = UserGenerator(
+            AsyncApiUserCreator(
+                client,
+                config.api_url + '/users/register',
+                config.api_url + '/users/login',
+            ),
+            TimeUserRandomizer()
+        )
+        users = await user_generator.generate_async(
+            config.number_of_users
+        )
+        print('Users:', *[u.username for u in users], sep='\n  ')
+
+        #generating posts
+        print('Creating posts')
+        post_generator = PostGenerator(
+            AsyncApiPostCreator(
+                client,
+                config.api_url + '/posts/',
+            ),
+            SimplePostRandomizer()
         )
-    print('Posts:', *[p.title for p in post_generator.posts], sep='\n  ')
+        await asyncio.gather(*(
+            post_generator.generate_async(
+                randint(1, config.max_posts_per_user),
+                user
+            )
+            for user in users
+        ))
+        print('Posts:', *[p.title for p in post_generator.posts], sep='\n  ')
 
-    #like posts
-    print('Creating likes')
-    like_generator = UserLikesGenerator(
-        ApiLikeCreator(
-            config.api_url + '/posts/{post_id}/like'
+        #like posts
+        print('Creating likes')
+        like_generator = UserLikesGenerator(
+            AsyncApiLikeCreator(
+                client,
+                config.api_url + '/posts/{post_id}/like'
+            )
         )
-    )
-    for user in user_generator.users:
-        like_generator.generate(
-            randint(1, config.max_likes_per_user),
-            user,
-            post_generator.posts
+        await asyncio.gather(*(
+            like_generator.generate_async(
+                randint(1, config.max_likes_per_user),
+                user,
+                post_generator.posts
+            )
+            for user in user_generator.users
+        ))
+        print('Likes:', *like_generator.likes, sep='\n  ')
+        print(
+            f'Created {len(users)} users, {len(post_generator.posts)} posts and'
+            f' {len(like_generator.likes)} likes in {time.perf_counter() - start:.1f} s'
         )
-    print('Likes:', *like_generator.likes, sep='\n  ')
\ No newline at end of file
+
+    report = metrics.write_reports(config.report_path)
+    print(format_report(report), end='')
+    print(f'Reports written to {config.report_path}.json and {config.report_path}.txt')
+
+
+if __name__ == "__main__":
+    config = Config(JsonConfigReader('./bot-config.json')).get_config()
+    print('Starting automated bot')
+    print('Config:', *str(config).split(), sep='\n  ')
+    asyncio.get_event_loop().run_until_complete(run_bot(config))
@@ -0,0 +1,170 @@
+import json
+import math
+import sys
+import time
+from collections import Counter
+from typing import Dict
+from urllib.parse import urlsplit
+
+
+# latencies below are counted in the lowest bucket
+MIN_LATENCY_MS = 0.001
+PERCENTILES = (50, 90, 99)
+
+
+class LatencyHistogram:
+    '''
+    Log-linear histogram of latencies in milliseconds. Buckets grow by
+    relative_error, so percentiles are off by at most that fraction while
+    memory depends only on the range of latencies, not on their number.
+    '''
+
+    def __init__(self, relative_error: float = 0.01) -> None:
+        self._base = math.log1p(relative_error)
+        self._buckets: Counter = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency_ms: float) -> None:
+        index = math.ceil(math.log(max(latency_ms, MIN_LATENCY_MS)) / self._base)
+        self._buckets[index] += 1
+        self.count += 1
+        self.total += latency_ms
+        self.max = max(self.max, latency_ms)
+
+    def percentile(self, percent: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                return min(math.exp(index * self._base), self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class EndpointStats:
+    def __init__(self) -> None:
+        self.latency = LatencyHistogram()
+        self.status_codes: Counter = Counter()
+
+    @property
+    def errors(self) -> int:
+        return sum(count for status, count in self.status_codes.items() if not 200 <= status <= 299)
+
+    def to_dict(self, duration: float) -> Dict:
+        count = self.latency.count
+        return {
+            'count': count,
+            'errors': self.errors,
+            'error_rate': round(self.errors / count, 4) if count else 0.0,
+            'throughput': round(count / duration, 2) if duration else 0.0,
+            'latency_ms': {
+                **{f'p{p}': round(self.latency.percentile(p), 2) for p in PERCENTILES},
+                'max': round(self.latency.max, 2),
+                'mean': round(self.latency.mean, 2),
+            },
+            'status_codes': {str(status): n for status, n in sorted(self.status_codes.items())},
+        }
+
+
+class MetricsRecorder:
+    '''
+    Collects latency and status of every api request by endpoint,
+    status 0 means request failed without response
+    '''
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self._endpoints: Dict[str, EndpointStats] = {}
+
+    @staticmethod
+    def endpoint_name(method: str, url: str) -> str:
+        '''
+        url can be a template like "http://host/api/posts/{post_id}/like",
+        so requests to different objects are counted as one endpoint
+        '''
+        return f'{method.upper()} {urlsplit(url).path}'
+
+    def record(self, endpoint: str, status: int, seconds: float) -> None:
+        stats = self._endpoints.get(endpoint)
+        if stats is None:
+            stats = self._endpoints[endpoint] = EndpointStats()
+        stats.latency.add(seconds * 1000)
+        stats.status_codes[status] += 1
+
+    def to_dict(self) -> Dict:
+        duration = time.time() - self.started
+        return {
+            'duration_s': round(duration, 2),
+            'endpoints': {
+                name: stats.to_dict(duration)
+                for name, stats in sorted(self._endpoints.items())
+            },
+        }
+
+    def write_reports(self, path: str) -> Dict:
+        '''
+        Writes path.json and path.txt, returns written report
+        '''
+        report = self.to_dict()
+        with open(f'{path}.json', 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+            file.write('\n')
+        with open(f'{path}.txt', 'w') as file:
+            file.write(format_report(report))
+        return report
+
+
+def format_report(report: Dict) -> str:
+    header = f"{'endpoint':<36} {'count':>7} {'err%':>6} {'req/s':>8}" + ''.join(
+        f' {name:>8}' for name in (*(f'p{p}' for p in PERCENTILES), 'max')
+    )
+    lines = [f"duration {report['duration_s']} s", header]
+    for name, stats in report['endpoints'].items():
+        latency = stats['latency_ms']
+        lines.append(
+            f"{name:<36} {stats['count']:>7} {stats['error_rate'] * 100:>6.2f} {stats['throughput']:>8.2f}"
+            + ''.join(f' {latency[key]:>8.2f}' for key in (*(f'p{p}' for p in PERCENTILES), 'max'))
+        )
+    return '\n'.join(lines) + '\n'
+
+
+def compare_reports(old: Dict, new: Dict) -> str:
+    '''
+    Formats change of throughput, error rate and latency between two json reports
+    '''
+    keys = (*(f'p{p}' for p in PERCENTILES), 'max')
+    lines = [f"{'endpoint':<36} {'req/s':>16} {'err%':>14}" + ''.join(f' {key:>18}' for key in keys)]
+    for name in sorted({*old['endpoints'], *new['endpoints']}):
+        before = old['endpoints'].get(name)
+        after = new['endpoints'].get(name)
+        if before is None or after is None:
+            lines.append(f"{name:<36} {'only in new' if before is None else 'only in old'}")
+            continue
+        lines.append(
+            f"{name:<36} {before['throughput']:>7.1f} -> {after['throughput']:<6.1f}"
+            f" {before['error_rate'] * 100:>5.1f} -> {after['error_rate'] * 100:<5.1f}"
+            + ''.join(
+                f" {before['latency_ms'][key]:>7.1f} -> {after['latency_ms'][key]:<7.1f}"
+                for key in keys
+            )
+        )
+    return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRecorder()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python -m bot.metrics old-report.json new-report.json')
+        sys.exit(1)
+    with open(sys.argv[1]) as old_file, open(sys.argv[2]) as new_file:
+        print(compare_reports(json.load(old_file), json.load(new_file)), end='')
@@ -1,5 +1,6 @@
+import asyncio
 import random
-from typing import List, Tuple
+from typing import List, Tuple, Union
 from abc import ABC, abstractmethod
 from pydantic.main import BaseModel
 from server.models.user import UserCreate, UserLogin
@@ -25,6 +26,13 @@ class InstanceCreatorInterafce(ABC):
         ...
 
 
+class AsyncInstanceCreatorInterface(ABC):
+
+    @abstractmethod
+    async def create_instance(self, data: BaseModel, **kwargs) -> BaseModel:
+        ...
+
+
 # __________________ Users _____________________
 
 class UserData(UserCreate, JwtTokenPair):
@@ -32,7 +40,11 @@ class UserData(UserCreate, JwtTokenPair):
 
 
 class UserGenerator:
-    def __init__(self, instance_creator: InstanceCreatorInterafce, data_creator: DataCreatorInterface) -> None:
+    def __init__(
+        self,
+        instance_creator: Union[InstanceCreatorInterafce, AsyncInstanceCreatorInterface],
+        data_creator: DataCreatorInterface,
+    ) -> None:
         self._instance_creator = instance_creator
         self._data_creator = data_creator
         self._users: List[UserData] = []
@@ -49,12 +61,24 @@ class UserGenerator:
                 self._users.append(user)
         return self.users
 
+    async def generate_async(self, quantity: int) -> Tuple[UserData]:
+        users = await asyncio.gather(*(
+            self._instance_creator.create_instance(self._data_creator.get_data())
+            for _ in range(0, quantity)
+        ))
+        self._users.extend(user for user in users if user)
+        return self.users
+
 
 # __________________ Posts _____________________
 
 
 class PostGenerator:
-    def __init__(self, instance_creator: InstanceCreatorInterafce, data_creator: DataCreatorInterface) -> None:
+    def __init__(
+        self,
+        instance_creator: Union[InstanceCreatorInterafce, AsyncInstanceCreatorInterface],
+        data_creator: DataCreatorInterface,
+    ) -> None:
         self._instance_creator = instance_creator
         self._data_creator = data_creator
         self._posts : List[Post] = []
@@ -73,6 +97,16 @@ class PostGenerator:
                 self._posts.append(post)
         return self.posts
 
+    async def generate_async(self, quantity: int, user: UserData) -> Tuple[Post]:
+        posts = await asyncio.gather(*(
+            self._instance_creator.create_instance(
+                user, self._data_creator.get_data(f' #{i} by {user.username}')
+            )
+            for i in range(0, quantity)
+        ))
+        self._posts.extend(post for post in posts if post)
+        return self.posts
+
 
 
 # ___________ Likes ________________
@@ -84,7 +118,7 @@ class LikeData(BaseModel):
 
 
 class UserLikesGenerator:
-    def __init__(self, instance_creator: InstanceCreatorInterafce) -> None:
+    def __init__(self, instance_creator: Union[InstanceCreatorInterafce, AsyncInstanceCreatorInterface]) -> None:
         self._instance_creator = instance_creator
         self._likes: List[Like] = []
 
@@ -96,4 +130,12 @@ class UserLikesGenerator:
         for _ in range(0,quantity):
             like = self._instance_creator.create_instance(user, random.choice(posts))
             self._likes.append(like)
+        return self.likes
+
+    async def generate_async(self, quantity: int, user: UserData, posts: List[Post]) -> Tuple[Like]:
+        likes = await asyncio.gather(*(
+            self._instance_creator.create_instance(user, random.choice(posts))
+            for _ in range(0, quantity)
+        ))
+        self._likes.extend(likes)
         return self.likes
\ No newline at end of file
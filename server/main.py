@@ -1,17 +1,38 @@
+import asyncio
 import inspect
 import re
 from fastapi import FastAPI, Request
 from fastapi.openapi.utils import get_openapi
 from fastapi.routing import APIRoute
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
 from fastapi_jwt_auth.exceptions import AuthJWTException
+from pymongo.errors import PyMongoError
 
-from .routers import users, posts, analytics
-from .settings import engine
+from .routers import users, posts, analytics, exports
+from .settings import storage, METRICS_ENABLED, READY_TIMEOUT, SLOW_QUERY_MS
+from .models.analytics import LikeCounter
+from .models.indexes import ensure_indexes
+from .models.post import Like, Post
+from .models.user import User
+from .utils.activity import request_time_buffer
+from .utils.context import RequestContextMiddleware
+from .utils.metrics import CONTENT_TYPE, MetricsMiddleware, record_db_operation, registry
+from .utils.responses import FastJSONResponse
+from .utils.search import search_backend
+from .utils.slow_queries import slow_query_log
+from .utils.security import PasswordHasherBusy, password_hasher
 
 
-app = FastAPI(title='BlogAPI')
+app = FastAPI(title='BlogAPI', default_response_class=FastJSONResponse)
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    storage.add_listener(record_db_operation)
+
+if SLOW_QUERY_MS > 0:
+    app.add_middleware(RequestContextMiddleware)
+    storage.add_listener(slow_query_log.record)
 
 
 app.include_router(
@@ -32,12 +53,76 @@ app.include_router(
     tags=['Analytic'],
 )
 
+app.include_router(
+    router=exports.router,
+    prefix='/api/export',
+    tags=['Export'],
+)
+
+
+@app.on_event('startup')
+def connect_storage():
+    # every worker creates its own client after fork
+    storage.connect()
+
+
+@app.on_event('startup')
+def start_request_time_buffer():
+    request_time_buffer.start()
+
+
+@app.on_event('startup')
+async def setup_indexes(drop_undeclared: bool = False):
+    # undeclared indexes are dropped only by server.scripts.reconcile_indexes, not by every worker
+    for model in (User, Post, Like, LikeCounter):
+        await ensure_indexes(
+            storage.engine, model, (*model.__indexes__, *search_backend.get_indexes(model)),
+            drop_undeclared=drop_undeclared,
+        )
+    await search_backend.setup(storage.engine)
+
+
+@app.on_event('shutdown')
+async def stop_request_time_buffer():
+    await request_time_buffer.stop()
+
+
+@app.on_event('shutdown')
+def stop_password_hasher():
+    password_hasher.shutdown()
+
+
+@app.on_event('shutdown')
+async def close_storage():
+    await storage.close()
+
 
 @app.get('/ping')
 def ping_pong():
     return 'pong'
 
 
+@app.get('/ready')
+async def readiness():
+    '''
+    Readiness probe, 503 until the database client is connected and answers ping
+    '''
+    if not storage.connected:
+        return JSONResponse(status_code=503, content={"detail": "Database is not connected"})
+    try:
+        await asyncio.wait_for(storage.ping(), READY_TIMEOUT)
+    except (asyncio.TimeoutError, PyMongoError):
+        return JSONResponse(status_code=503, content={"detail": "Database is not available"})
+    return 'ready'
+
+
+@app.get('/metrics', include_in_schema=False)
+def metrics():
+    if not METRICS_ENABLED:
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+
 @app.exception_handler(AuthJWTException)
 def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     return JSONResponse(
@@ -46,6 +131,15 @@ def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     )
 
 
+@app.exception_handler(PasswordHasherBusy)
+def password_hasher_busy_handler(request: Request, exc: PasswordHasherBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Too many login attempts, try again later"},
+        headers={"Retry-After": "1"},
+    )
+
+
 def custom_openapi():
     if app.openapi_schema:
         return app.openapi_schema
@@ -0,0 +1,75 @@
+import datetime as dt
+from typing import Any, Optional, Tuple
+
+from odmantic import AIOEngine, Model
+
+from server.settings import LIKES_CACHE_SIZE, LIKES_CACHE_TTL, LIKES_CACHE_CLOSED_TTL
+from server.utils.cache import TTLCache
+from .indexes import Index
+
+
+class LikeCounter(Model):
+    '''
+    Number of likes made per day, kept up to date by like and unlike
+    '''
+    date: dt.datetime
+    count: int = 0
+
+    __indexes__ = (
+        Index('date', unique=True),
+    )
+
+
+DateRange = Tuple[Optional[dt.datetime], Optional[dt.datetime]]
+
+
+class LikeCountsCache(TTLCache):
+    '''
+    Likes per day results keyed by (date_from, date_to). Ranges ending before
+    today can change only on unlike of an old like or a post delete, so they
+    are kept for closed_ttl, ranges including today for ttl. Invalidation
+    is local to the worker, other workers see changes after the ttl.
+
+    Parameters:
+        maxsize (int): Maximum number of cached ranges
+        ttl (float): Time to live of ranges including today
+        closed_ttl (float): Time to live of ranges ending before today
+    '''
+
+    def __init__(self, maxsize: int, ttl: float, closed_ttl: float) -> None:
+        super().__init__(maxsize, ttl)
+        self.closed_ttl = closed_ttl
+        # changed on every invalidation, so results computed meanwhile are not stored
+        self.version = 0
+
+    @staticmethod
+    def normalize(date_from: Optional[dt.datetime], date_to: Optional[dt.datetime]) -> DateRange:
+        if date_to is not None and date_to.date() >= dt.date.today():
+            date_to = None
+        return date_from, date_to
+
+    def set_range(self, key: DateRange, value: Any) -> None:
+        closed = key[1] is not None
+        self.set(key, value, ttl=self.closed_ttl if closed else None)
+
+    def invalidate(self, date: dt.datetime) -> None:
+        '''
+        Drops cached ranges containing date
+        '''
+        self.version += 1
+        for key in self.keys():
+            date_from, date_to = key
+            if (date_from is None or date_from <= date) and (date_to is None or date <= date_to):
+                self.pop(key)
+
+
+like_counts_cache = LikeCountsCache(LIKES_CACHE_SIZE, LIKES_CACHE_TTL, LIKES_CACHE_CLOSED_TTL)
+
+
+async def count_like(engine: AIOEngine, date: dt.datetime, delta: int = 1) -> None:
+    await engine.get_collection(LikeCounter).update_one(
+        {+LikeCounter.date: date},
+        {'$inc': {+LikeCounter.count: delta}},
+        upsert=True,
+    )
+    like_counts_cache.invalidate(date)
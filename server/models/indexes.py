@@ -0,0 +1,106 @@
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type, Union
+
+from odmantic import AIOEngine, Model
+from pymongo import ASCENDING, TEXT
+from pymongo.errors import OperationFailure
+
+
+logger = logging.getLogger(__name__)
+
+
+class Index:
+    '''
+    Declaration of MongoDB index, models list them in __indexes__
+
+    Parameters:
+        *keys: Key names (dotted for embedded fields), or pairs of key name
+            and direction (pymongo.ASCENDING, DESCENDING, TEXT)
+        name (str): Index name, generated from keys by default
+        unique (bool): Reject documents with duplicate key values
+
+        >>> class Post(Model):
+        >>>     __indexes__ = (
+        >>>         Index('owner'),
+        >>>         Index(('created_at', DESCENDING), ('_id', DESCENDING)),
+        >>>         Index('likes.user_id'),
+        >>>     )
+    '''
+
+    def __init__(
+        self,
+        *keys: Union[str, Tuple[str, Any]],
+        name: Optional[str] = None,
+        unique: bool = False,
+    ) -> None:
+        self.keys: List[Tuple[str, Any]] = [
+            (key, ASCENDING) if isinstance(key, str) else tuple(key) for key in keys
+        ]
+        self.name = name or '_'.join(f'{key}_{direction}' for key, direction in self.keys)
+        self.unique = unique
+
+    @property
+    def is_text(self) -> bool:
+        return any(direction == TEXT for _, direction in self.keys)
+
+    def matches(self, info: Dict[str, Any]) -> bool:
+        '''
+        Compares declaration with index description from index_information()
+        '''
+        if bool(info.get('unique')) != self.unique:
+            return False
+        if self.is_text:
+            return set(info.get('weights', {})) == {key for key, _ in self.keys}
+        return [(key, direction) for key, direction in info['key']] == self.keys
+
+    async def create(self, engine: AIOEngine, model: Type[Model]) -> None:
+        await engine.get_collection(model).create_index(
+            self.keys, name=self.name, unique=self.unique,
+        )
+
+    def __repr__(self) -> str:
+        return f'Index({self.name!r}, unique={self.unique})'
+
+
+async def drop_index_if_exists(collection: Any, name: str) -> None:
+    '''
+    Drops index, an index already dropped by another worker is skipped
+    '''
+    try:
+        await collection.drop_index(name)
+    except OperationFailure as error:
+        # IndexNotFound
+        if error.code != 27:
+            logger.exception('Failed to drop index %s of %s', name, collection.name)
+
+
+async def ensure_indexes(
+    engine: AIOEngine, model: Type[Model], indexes: Sequence[Index], drop_undeclared: bool = False
+) -> None:
+    '''
+    Reconciles indexes of model collection with declared ones: creates
+    missing and recreates changed indexes. Indexes which are not declared,
+    like ones created by hand, are dropped only with drop_undeclared.
+    Every worker runs this on startup, so it tolerates concurrent runs.
+    '''
+    collection = engine.get_collection(model)
+    existing = await collection.index_information()
+    declared = {index.name: index for index in indexes}
+    for name in existing:
+        if name != '_id_' and name not in declared:
+            if not drop_undeclared:
+                logger.info('Keeping not declared index %s of %s', name, model.__name__)
+                continue
+            logger.info('Dropping index %s of %s', name, model.__name__)
+            await drop_index_if_exists(collection, name)
+    for name, index in declared.items():
+        info = existing.get(name)
+        if info is not None and index.matches(info):
+            continue
+        if info is not None:
+            logger.info('Recreating changed index %s of %s', name, model.__name__)
+            await drop_index_if_exists(collection, name)
+        try:
+            await index.create(engine, model)
+        except OperationFailure:
+            logger.exception('Failed to create index %s of %s', name, model.__name__)
@@ -3,20 +3,43 @@ import datetime as dt
 from pydantic import BaseModel
 
 from odmantic import Field, Model
-from odmantic.bson import ObjectId
+from odmantic.bson import BSON_TYPES_ENCODERS, ObjectId
+from pymongo import DESCENDING
 
+from .indexes import Index
 
-class Like(BaseModel):
+
+def today() -> dt.datetime:
+    return dt.datetime.combine(dt.date.today(), dt.time(0))
+
+
+class Like(Model):
+    '''
+    Like of post by user, date is the day when like was made
+    '''
+    post: ObjectId
     user_id: ObjectId
-    date: dt.datetime = dt.datetime.combine(dt.date.today(), dt.time(0))
+    date: dt.datetime
+
+    __indexes__ = (
+        Index('post', 'user_id', unique=True),
+        Index('date'),
+    )
 
 
 class Post(Model):
     owner: ObjectId
     title: str
     text: str
-    created_at: dt.datetime = dt.datetime.now()
-    likes: List[Like] = []
+    created_at: dt.datetime = Field(default_factory=dt.datetime.now)
+    like_count: int = 0
+    # incremented by every write, used as ETag of post
+    version: int = 0
+
+    __indexes__ = (
+        Index('owner'),
+        Index(('created_at', DESCENDING), ('_id', DESCENDING)),
+    )
 
 
 class PostBase(BaseModel):
@@ -33,3 +56,16 @@ class PostUpdate(BaseModel):
     text: Optional[str] = None
 
 
+class LikeCreate(BaseModel):
+    post_id: ObjectId
+
+
+class LikeStatus(BaseModel):
+    post_id: ObjectId
+    liked: bool
+    like_count: int
+    like: Like
+
+    class Config:
+        json_encoders = BSON_TYPES_ENCODERS
+
@@ -1,11 +1,12 @@
 from typing import Optional
 from datetime import datetime
-from pydantic import BaseModel, EmailStr, Field, validator
-from odmantic import Model
+from pydantic import BaseModel, EmailStr, validator
+from odmantic import Field, Model
 from odmantic.bson import ObjectId
 
-from server.utils.security import hash_password, verify_password
+from server.utils.security import hash_password, hash_password_async, verify_password, verify_password_async
 from server.settings import MIN_PASSWORD_LENGTH
+from .indexes import Index
 
 
 class User(Model):
@@ -14,9 +15,16 @@ class User(Model):
     password: str
     last_login: Optional[datetime] = None
     last_request: Optional[datetime] = None
-    registration_date: datetime = datetime.now()
+    registration_date: datetime = Field(default_factory=datetime.now)
     super_user: bool = False
     deleted: bool = False
+    # incremented by every write, used as ETag of user
+    version: int = 0
+
+    __indexes__ = (
+        Index('email', unique=True),
+        Index('username', unique=True),
+    )
 
     def update_login_time(self):
         self.last_login = datetime.now()
@@ -30,6 +38,12 @@ class User(Model):
     def verify_pswd(self, raw_password: str) -> bool:
         return verify_password(raw_password, self.password)
 
+    async def set_password_async(self, raw_password: str):
+        self.password = await hash_password_async(raw_password)
+
+    async def verify_pswd_async(self, raw_password: str) -> bool:
+        return await verify_password_async(raw_password, self.password)
+
 
 class UserBase(BaseModel):
     email: EmailStr
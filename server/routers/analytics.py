@@ -1,12 +1,16 @@
 from typing import Optional
 import datetime as dt
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Response
+from odmantic import AIOEngine
 from pydantic import BaseModel
 
-from server.settings import engine
-from server.models.post import Post
+from server.models.analytics import LikeCounter, like_counts_cache
+from server.utils.cache import SingleFlight
 from server.models.user import User
-from .dependencies import allow_only_admin
+from server.utils.activity import request_time_buffer
+from server.utils.slow_queries import slow_query_log
+from server.settings import ANALYTICS_READ_PREFERENCE
+from .dependencies import allow_only_admin, get_engine, get_engine_for, user_cache, DateFilter
 
 
 router = APIRouter(
@@ -14,41 +18,54 @@ router = APIRouter(
 )
 
 
-class DateFilter():
-    date_from: Optional[dt.datetime]
-    date_to: Optional[dt.datetime]
+likes_flight = SingleFlight()
 
-    def __init__(self, date_from:Optional[dt.date] = None, date_to: Optional[dt.date] = None) -> None:
-        self.date_from = dt.datetime.combine(date_from, dt.time(0)) if date_from else None
-        self.date_to = dt.datetime.combine(date_to, dt.time(0)) if date_to else None
+# analytics tolerate replication lag, so they can be served by secondaries
+get_analytics_engine = get_engine_for(ANALYTICS_READ_PREFERENCE)
 
-    def get_filter_dict(self):
-        res = dict()
-        if self.date_from:
-            res["$gte"] = self.date_from
-        if self.date_to:
-            res["$lte"] = self.date_to        
-        return res
+
+async def count_likes(engine: AIOEngine, date_from: Optional[dt.datetime], date_to: Optional[dt.datetime]):
+    query = {+LikeCounter.count: {"$gt": 0}}
+    date_match = DateFilter(date_from, date_to).get_filter_dict()
+    if date_match:
+        query[+LikeCounter.date] = date_match
+    counters = await engine.find(LikeCounter, query, sort=LikeCounter.date)
+    return [{"_id": counter.date, "count": counter.count} for counter in counters]
 
 
 @router.get('/likes')
-async def get_likes(date_filter: DateFilter = Depends()):
-    collection = engine.get_collection(Post)
-    pipeline = [
-        { "$unwind": "$likes"},
-        {"$group":{"_id": "$likes.date", "count":{"$sum":1}}},
-    ]
-    date_match = date_filter.get_filter_dict()
-    if date_match:
-        pipeline.append({"$match": {"_id":  date_match}})
-    res = await collection.aggregate(pipeline).to_list(length=None)
+async def get_likes(response: Response, date_filter: DateFilter = Depends(), engine: AIOEngine = Depends(get_engine)):
+    # read from primary, a secondary behind the write which invalidated the
+    # range would put old counts into the cache for its whole ttl
+    key = like_counts_cache.normalize(date_filter.date_from, date_filter.date_to)
+    res = like_counts_cache.get(key)
+    response.headers['X-Cache'] = 'MISS' if res is None else 'HIT'
+    if res is None:
+        version = like_counts_cache.version
+        res = await likes_flight.run(key, lambda: count_likes(engine, *key))
+        if version == like_counts_cache.version:
+            like_counts_cache.set_range(key, res)
     return res
     
 
 @router.get('/user-activity/{username}')
-async def get_user_activity(username: str):
+async def get_user_activity(username: str, engine: AIOEngine = Depends(get_analytics_engine)):
     user = await engine.find_one(User, User.username == username)
     return {
         "last_login": user.last_login,
-        "last_request": user.last_request
-    }
\ No newline at end of file
+        "last_request": request_time_buffer.get(user.id) or user.last_request
+    }
+
+
+@router.get('/user-cache')
+async def get_user_cache_stats():
+    return user_cache.stats()
+
+
+@router.get('/slow-queries')
+async def get_slow_queries(limit: int = 20):
+    '''
+    Shapes of database operations slower than SLOW_QUERY_MS in this worker,
+    largest total time first, with counts, percentiles and explain plans
+    '''
+    return slow_query_log.top(limit)
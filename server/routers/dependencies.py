@@ -1,32 +1,93 @@
-from typing import List, Optional, Union
+import asyncio
+import base64
+import binascii
+import datetime as dt
+import logging
+import time
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Type, Union
 
 from server.models.user import User
 from fastapi import Depends, HTTPException
+from fastapi.responses import Response
 from fastapi.security import HTTPBearer
 from odmantic import ObjectId
+from bson import json_util
 from bson.objectid import ObjectId as BsonId
 from fastapi_jwt_auth import AuthJWT
 from server.models.user import User
-from server.settings import engine
-from odmantic import Model
-from odmantic.query import QueryExpression, SortExpression, match
+from pymongo.errors import PyMongoError
+from server.settings import storage, COUNT_CACHE_TTL, USER_CACHE_SIZE, USER_CACHE_TTL
+from server.utils.activity import request_time_buffer
+from server.utils.cache import TTLCache
+from server.utils.responses import FastJSONResponse, etag_matches, make_etag, not_modified
+from server.utils.search import search_backend
+from odmantic import AIOEngine, Model
+from odmantic.query import QueryExpression, SortExpression, and_, match
 from odmantic.engine import AIOCursor
 from odmantic.field import FieldProxy
+from pydantic.json import ENCODERS_BY_TYPE
 
 
-async def get_authorized_user(Authorize: AuthJWT = Depends(), dummy = Depends(HTTPBearer())) -> User:
+logger = logging.getLogger(__name__)
+
+# projected documents are returned as dicts, so ObjectId needs a json encoder
+ENCODERS_BY_TYPE[BsonId] = str
+ENCODERS_BY_TYPE[ObjectId] = str
+
+# authorized users keyed by jwt subject
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def get_engine() -> AIOEngine:
+    '''
+    Engine of configured storage backend, override this dependency
+    to run routers against another storage
+    '''
+    return storage.engine
+
+
+def get_engine_for(read_preference: str) -> Callable[[], AIOEngine]:
+    '''
+    Creates dependency returning engine which reads with read_preference,
+    for routers which can read from secondaries
+
+        >>> router = APIRouter()
+        >>> @router.get('/')
+        >>> async def some_ep(engine: AIOEngine = Depends(get_engine_for('secondaryPreferred'))):
+    '''
+    def get_read_engine() -> AIOEngine:
+        return storage.engine_for(read_preference)
+    return get_read_engine
+
+
+async def get_user_by_subject(engine: AIOEngine, subject: str) -> Optional[User]:
+    '''
+    Returns user for jwt subject from user_cache, fetching it from database on miss
+    '''
+    user = user_cache.get(subject)
+    if user is None:
+        user = await engine.find_one(User, User.id == BsonId(subject))
+        if user is not None:
+            user_cache.set(subject, user)
+    return user
+
+
+async def get_authorized_user(
+    Authorize: AuthJWT = Depends(),
+    dummy = Depends(HTTPBearer()),
+    engine: AIOEngine = Depends(get_engine),
+) -> User:
     Authorize.jwt_required()
-    user_id = BsonId(Authorize.get_jwt_subject())
-    user = await engine.find_one(User, User.id == user_id)
+    user = await get_user_by_subject(engine, Authorize.get_jwt_subject())
     if not user:
         raise HTTPException(400, detail="No user found")
     user.update_request_time()
-    await engine.save(user)
+    request_time_buffer.touch(engine, user.id, user.last_request)
     return user
 
 
-async def get_admin_user(user_id: ObjectId = Depends(get_authorized_user)) -> User:
-    user = await engine.find_one(User, User.id == user_id)
+async def get_admin_user(user: User = Depends(get_authorized_user)) -> User:
     if not user.super_user:
         raise HTTPException(403)
     return user
@@ -39,76 +100,378 @@ async def allow_only_admin(Authorize: AuthJWT = Depends(), dummy = Depends(HTTPB
         raise HTTPException(403)
 
 
+class DateFilter():
+    date_from: Optional[dt.datetime]
+    date_to: Optional[dt.datetime]
+
+    def __init__(self, date_from:Optional[dt.date] = None, date_to: Optional[dt.date] = None) -> None:
+        self.date_from = dt.datetime.combine(date_from, dt.time(0)) if date_from else None
+        self.date_to = dt.datetime.combine(date_to, dt.time(0)) if date_to else None
+
+    def get_filter_dict(self):
+        '''
+        Range including the whole date_to day, so datetime fields
+        like created_at match until its end
+        '''
+        res = dict()
+        if self.date_from:
+            res["$gte"] = self.date_from
+        if self.date_to:
+            res["$lt"] = self.date_to + dt.timedelta(days=1)
+        return res
+
+
+def encode_cursor(value: Any, object_id: ObjectId) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps([value, object_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, ObjectId]:
+    try:
+        value, object_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(400, detail="Invalid cursor")
+    if not isinstance(object_id, BsonId):
+        raise HTTPException(400, detail="Invalid cursor")
+    return value, object_id
+
+
+def build_projection(
+    model: Type[Model],
+    fields: Optional[str],
+    default_fields: Optional[Sequence[str]] = None,
+    hidden_fields: Sequence[str] = (),
+) -> Dict[str, int]:
+    '''
+    Returns MongoDB projection for comma separated names of model fields,
+    default_fields are used when fields is not given or empty (all fields
+    if None), hidden_fields are never returned. id is always included.
+    '''
+    if fields is not None and not fields.strip(' ,'):
+        fields = None
+    if fields is None:
+        if default_fields is None:
+            default_fields = [name for name in model.__odm_fields__ if name not in hidden_fields]
+        names = default_fields
+    else:
+        names = [name.strip() for name in fields.split(',') if name.strip()]
+    projection = {'_id': 1}
+    for name in names:
+        field = model.__odm_fields__.get(name)
+        if field is None or name in hidden_fields:
+            raise HTTPException(400, detail=f"Unknown field: {name}")
+        projection[field.key_name] = 1
+    return projection
+
+
+def doc_to_dict(model: Type[Model], doc: Dict) -> Dict:
+    '''
+    Converts projected document to dict keyed by model field names
+    '''
+    names = {field.key_name: name for name, field in model.__odm_fields__.items()}
+    return {names.get(key, key): value for key, value in doc.items()}
+
+
+def get_projection(
+    model: Type[Model],
+    default_fields: Optional[Sequence[str]] = None,
+    hidden_fields: Sequence[str] = (),
+) -> Callable[..., Dict[str, int]]:
+    '''
+    Creates dependency reading "fields" query parameter of detail endpoints,
+    see build_projection
+    '''
+    def projection(fields: Optional[str] = None) -> Dict[str, int]:
+        return build_projection(model, fields, default_fields, hidden_fields)
+    return projection
+
+
+async def find_one_versioned(
+    engine: AIOEngine,
+    model: Type[Model],
+    query: Dict,
+    projection: Dict[str, int],
+    if_none_match: Optional[str] = None,
+) -> Response:
+    '''
+    Returns projected document with ETag built from its version. When client
+    sends If-None-Match only version is read and 304 is returned if it matches.
+    '''
+    collection = engine.get_collection(model)
+    version_key = model.__odm_fields__['version'].key_name
+    if if_none_match is not None:
+        doc = await collection.find_one(query, {version_key: 1})
+        if doc is None:
+            raise HTTPException(404)
+        etag = make_etag(doc['_id'], doc.get(version_key, 0), projection)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    doc = await collection.find_one(query, {**projection, version_key: 1})
+    if doc is None:
+        raise HTTPException(404)
+    version = doc.get(version_key, 0) if version_key in projection else doc.pop(version_key, 0)
+    etag = make_etag(doc['_id'], version, projection)
+    return FastJSONResponse(doc_to_dict(model, doc), headers={'ETag': etag})
+
+
+class CountMode(str, Enum):
+    exact = 'exact'
+    estimated = 'estimated'
+
+
+class CountCache:
+    '''
+    Keeps estimated_document_count of model collections. Value older than ttl
+    is still returned while a fresh one is fetched in background.
+
+    Parameters:
+        ttl (float): Seconds after which the value is refreshed
+    '''
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._values: Dict[type, Tuple[int, float]] = {}
+        self._refreshing: Dict[type, asyncio.Future] = {}
+
+    async def get(self, engine: AIOEngine, model: Type[Model]) -> int:
+        item = self._values.get(model)
+        if item is None:
+            return await self._refresh(engine, model)
+        value, fetched_at = item
+        if time.monotonic() - fetched_at > self.ttl and model not in self._refreshing:
+            self._refreshing[model] = asyncio.ensure_future(self._refresh_in_background(engine, model))
+        return value
+
+    async def _refresh(self, engine: AIOEngine, model: Type[Model]) -> int:
+        value = await engine.get_collection(model).estimated_document_count()
+        self._values[model] = (value, time.monotonic())
+        return value
+
+    async def _refresh_in_background(self, engine: AIOEngine, model: Type[Model]) -> None:
+        try:
+            await self._refresh(engine, model)
+        except PyMongoError:
+            logger.exception('Failed to refresh count of %s', model.__name__)
+        finally:
+            self._refreshing.pop(model, None)
+
+
+count_cache = CountCache(COUNT_CACHE_TTL)
+
+
 class Selector:
     '''
     This class used for getting list of items with some query parameters
     
     Parameters:
-        q (str): Used for text search by specific field
+        q (str): Used for full text search by lookup fields, results are ordered
+            by relevance unless sort or cursor is given
         skip (int): Start from item with index skip in database queryset
         limit (int): Limit quantity of qyeryset objects
         sort (str): Sorting parameter, should be a name of string and "-" at front 
             if want to sort in descending order, example: "-field_name"
+        cursor (str): Switches to keyset pagination, skip is ignored. Pass empty
+            cursor for the first page and self.next_cursor for the following ones
+        count_mode (CountMode): "exact" counts matching items with a query run alongside
+            the page, "estimated" returns cached collection size for unfiltered lists
+        fields (str): Comma separated names of fields to return, default fields if not given
+        engine (AIOEngine): Engine of storage queried for items
     '''
 
     _lookup_fields = None
     _model = None
+    _default_fields = None
+    _hidden_fields = ()
 
-    def __init__(self, q: Optional[str] = None, skip: int = 0, limit: int = 10, sort: Optional[str] = None) -> None:
+    def __init__(
+        self,
+        q: Optional[str] = None,
+        skip: int = 0,
+        limit: int = 10,
+        sort: Optional[str] = None,
+        cursor: Optional[str] = None,
+        count_mode: CountMode = CountMode.exact,
+        fields: Optional[str] = None,
+        engine: AIOEngine = Depends(get_engine),
+    ) -> None:
+        self.engine: AIOEngine = engine
         self.q: str = q
         self.skip: int = skip if skip > 0 else 0
         self.limit: int = limit if limit > 0 else 10
         self.sort: str = sort
+        self.cursor: Optional[str] = cursor
+        self.count_mode: CountMode = count_mode
+        self.fields: Optional[str] = fields
+        self.next_cursor: Optional[str] = None
 
-    async def get_objects(self, *queries: QueryExpression, sort: Optional[str] = None) -> AIOCursor:
+    async def get_objects(self, *queries: QueryExpression, sort: Optional[str] = None) -> List[Dict]:
         '''
-        Returns query result - list of items with limit and skip,
-        and add self.count - quantity of items in database 
+        Returns query result - list of items with limit and skip (or after cursor),
+        and add self.count - quantity of items matching queries and q.
+        Items are dicts containing only fields selected by self.fields
         '''
         if sort:
             self.sort = sort
         queries = list(queries)
-        sort = self._build_sort_expression()
-        self.count: int = await engine.count(self._model, *queries)
-        if self.q is not None:
-            for field in self._lookup_fields:
-                queries.append(field.match(self.q))
-
-        res = await engine.find(
-            self._model,
-            *queries,
-            skip=self.skip,
-            limit=self.limit,
-            sort=sort,
+        projection = build_projection(
+            self._model, self.fields, self._default_fields, self._hidden_fields
         )
+        sort = self._build_sort_expression()
+        sort_stages = [{'$sort': dict(sort)}] if sort else []
+        if self.q is not None and self._lookup_fields:
+            search = search_backend.search(self._model, self.q)
+            queries.append(QueryExpression(search.query))
+            if sort is None:
+                sort_stages = search.sort_stages
+        page_queries = []
+        skip = self.skip
+        # sort key read only for next_cursor, it is removed from items
+        cursor_only_key = None
+        if self.cursor is not None:
+            sort, page_queries = self._build_keyset_expression()
+            sort_stages = [{'$sort': dict(sort)}]
+            skip = 0
+            sort_field = self._get_sort_field()
+            if sort_field and +sort_field[0] not in projection:
+                cursor_only_key = +sort_field[0]
+                projection[cursor_only_key] = 1
+
+        if self.count_mode == CountMode.estimated and not queries:
+            cursor = self.engine.get_collection(self._model).find(
+                and_(*page_queries) if page_queries else {}, projection
+            )
+            if sort:
+                cursor = cursor.sort(list(sort.items()))
+            docs = await cursor.skip(skip).limit(self.limit).to_list(length=None)
+            self.count: int = await count_cache.get(self.engine, self._model)
+        else:
+            docs, self.count = await self._find_with_count(
+                queries, page_queries, sort_stages, skip, projection
+            )
+
+        res = [doc_to_dict(self._model, doc) for doc in docs]
+        if self.cursor is not None and len(res) == self.limit:
+            last = res[-1]
+            value = last.get(self._get_sort_name()) if self._get_sort_field() else None
+            self.next_cursor = encode_cursor(value, last['id'])
+        if cursor_only_key is not None:
+            for item in res:
+                item.pop(self._get_sort_name(), None)
         return res
 
-    def _build_sort_expression(self) -> Union[SortExpression, None]:
+    async def _find_with_count(
+        self,
+        queries: List[QueryExpression],
+        page_queries: List[QueryExpression],
+        sort_stages: List[Dict],
+        skip: int,
+        projection: Dict[str, int],
+    ) -> Tuple[List[Dict], int]:
+        '''
+        Fetches projected documents of the page and the number of items
+        matching queries. The page pipeline starts with $match and $sort, so
+        it can use an index and stop after limit documents. The count runs
+        as a separate query at the same time.
+        '''
+        page_match = [*queries, *page_queries]
+        pipeline = [{'$match': and_(*page_match) if page_match else {}}, *sort_stages]
+        if skip:
+            pipeline.append({'$skip': skip})
+        pipeline.append({'$limit': self.limit})
+        pipeline.append({'$project': projection})
+
+        collection = self.engine.get_collection(self._model)
+        docs, count = await asyncio.gather(
+            collection.aggregate(pipeline).to_list(length=None),
+            collection.count_documents(and_(*queries) if queries else {}),
+        )
+        return docs, count
+
+    def _build_keyset_expression(self) -> Tuple[SortExpression, List[QueryExpression]]:
+        '''
+        Keyset pagination: returns sort by (sort key, id) and query continuing
+        right after the pair stored in self.cursor, so no skipped documents are walked.
+        Null and missing values sort before all others and do not match $gt/$lt,
+        so they are matched separately.
+        '''
+        sort_field = self._get_sort_field()
+        descending = sort_field is not None and sort_field[1]
+        operator = '$lt' if descending else '$gt'
+        sort = SortExpression({
+            **(self._build_sort_expression() or {}),
+            '_id': -1 if descending else 1,
+        })
+        if not self.cursor:
+            return sort, []
+        value, last_id = decode_cursor(self.cursor)
+        if sort_field is None:
+            return sort, [QueryExpression({'_id': {operator: last_id}})]
+        key = +sort_field[0]
+        if value is None:
+            following = [] if descending else [{key: {'$ne': None}}]
+        else:
+            following = [{key: {operator: value}}]
+            if descending:
+                following.append({key: None})
+        return sort, [QueryExpression({'$or': [
+            *following,
+            {key: value, '_id': {operator: last_id}},
+        ]})]
+
+    def _get_sort_name(self) -> str:
+        return self.sort.strip().strip('_').strip('-')
+
+    def _get_sort_field(self) -> Optional[Tuple[FieldProxy, bool]]:
+        '''
+        Returns model field from self.sort and True if order is descending
+        '''
         if self.sort is None:
             return None
         sort = self.sort.strip().strip('_')
+        if sort.strip('-') in self._hidden_fields:
+            return None
         field = self._model.__dict__.get(sort.strip('-'))
         if field is None:
             return None
-        if sort[0] == '-':
+        return field, sort[0] == '-'
+
+    def _build_sort_expression(self) -> Union[SortExpression, None]:
+        sort_field = self._get_sort_field()
+        if sort_field is None:
+            return None
+        field, descending = sort_field
+        if descending:
             return field.desc()
         else:
             return field.asc()
 
 
-def get_selector(model: Model, *lookup_fields: FieldProxy) -> Selector:
+def get_selector(
+    model: Model,
+    *lookup_fields: FieldProxy,
+    default_fields: Optional[Sequence[str]] = None,
+    hidden_fields: Sequence[str] = (),
+) -> Selector:
     '''
     Used as class factory to create classs constructor initialized for 
     use with Depend for specific endpoint.
 
     Parameters:
         model (Model): Model from which you want to fetch data
-        *lookup_fields (FieldProxy): The fields of odmantic.Model in wich you want search by q parameter 
+        *lookup_fields (FieldProxy): The fields of odmantic.Model in wich you want search by q parameter,
+            they are registered in search_backend
+        default_fields (Sequence[str]): Names of fields returned when fields parameter is not given,
+            all not hidden fields if None
+        hidden_fields (Sequence[str]): Names of fields which are never returned
 
         >>> @app.get('/')
         >>> async def some_ep(selector: Selector = Depends(get_selector(Model, Model.title, Model.text, ...))):
     '''
+    if lookup_fields:
+        search_backend.register(model, *lookup_fields)
+
     class SelectorInterface(Selector):
         _model = model
         _lookup_fields = lookup_fields
+        _default_fields = default_fields
+        _hidden_fields = tuple(hidden_fields)
     return SelectorInterface
\ No newline at end of file
@@ -0,0 +1,68 @@
+from typing import AsyncIterator, Dict, Type
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+from odmantic import AIOEngine, Model
+
+from server.settings import EXPORT_BATCH_SIZE
+from server.models.post import Like, Post
+from server.models.user import User
+from server.utils.responses import dumps
+from .dependencies import allow_only_admin, build_projection, doc_to_dict, get_engine, DateFilter
+from .users import user_hidden_fields
+
+
+router = APIRouter(
+    dependencies=[Depends(allow_only_admin)]
+)
+
+
+async def iter_ndjson(
+    engine: AIOEngine, model: Type[Model], query: Dict, projection: Dict[str, int]
+) -> AsyncIterator[bytes]:
+    '''
+    Yields documents as newline delimited json, EXPORT_BATCH_SIZE documents
+    per chunk. The cursor is read only as fast as the client receives chunks.
+    '''
+    cursor = engine.get_collection(model).find(query, projection, batch_size=EXPORT_BATCH_SIZE)
+    cursor = cursor.sort('_id', 1)
+    lines = []
+    try:
+        async for doc in cursor:
+            lines.append(dumps(doc_to_dict(model, doc)))
+            if len(lines) >= EXPORT_BATCH_SIZE:
+                yield b'\n'.join(lines) + b'\n'
+                lines = []
+        if lines:
+            yield b'\n'.join(lines) + b'\n'
+    finally:
+        await cursor.close()
+
+
+def export_response(
+    engine: AIOEngine, model: Type[Model], date_field: str, date_filter: DateFilter, hidden_fields=()
+) -> StreamingResponse:
+    query = {}
+    date_match = date_filter.get_filter_dict()
+    if date_match:
+        query[date_field] = date_match
+    projection = build_projection(model, None, hidden_fields=hidden_fields)
+    return StreamingResponse(
+        iter_ndjson(engine, model, query, projection),
+        media_type='application/x-ndjson',
+    )
+
+
+@router.get('/posts')
+async def export_posts(date_filter: DateFilter = Depends(), engine: AIOEngine = Depends(get_engine)):
+    return export_response(engine, Post, +Post.created_at, date_filter)
+
+
+@router.get('/users')
+async def export_users(date_filter: DateFilter = Depends(), engine: AIOEngine = Depends(get_engine)):
+    return export_response(engine, User, +User.registration_date, date_filter, user_hidden_fields)
+
+
+@router.get('/likes')
+async def export_likes(date_filter: DateFilter = Depends(), engine: AIOEngine = Depends(get_engine)):
+    return export_response(engine, Like, +Like.date, date_filter)
@@ -1,26 +1,105 @@
-from typing import Optional, List
-from fastapi import APIRouter, Depends
+from collections import Counter
+from typing import Any, Dict, Optional, List, Sequence, Tuple, Type
+from fastapi import APIRouter, Depends, Header
 from fastapi.exceptions import HTTPException
+from odmantic import AIOEngine, Model
 from odmantic.bson import ObjectId
 from fastapi_jwt_auth import AuthJWT
+from pydantic import BaseModel, ValidationError
 from pydantic.utils import Obj
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from server.models.post import Like, PostCreate, PostUpdate, Post
+from server.models.post import Like, LikeCreate, LikeStatus, PostCreate, PostUpdate, Post, today
 from server.models.user import User
-from server.settings import engine
-from .dependencies import get_authorized_user, Selector, get_selector
+from server.models.analytics import count_like
+from server.settings import BULK_MAX_ITEMS, SEARCH_POST_TEXT
+from server.utils.responses import FastJSONResponse, etag_response, model_response
+from server.utils.search import search_backend
+from .dependencies import (
+    get_authorized_user, get_engine, Selector, get_selector, get_projection, find_one_versioned,
+)
 
 
 router = APIRouter()
 
+post_lookup_fields = (Post.title, Post.text) if SEARCH_POST_TEXT else (Post.title,)
+# text is returned by lists only when requested with fields parameter
+post_list_fields = ('owner', 'title', 'created_at', 'like_count')
 
-async def get_post_by_id(post_id: ObjectId) -> Post:
+
+async def get_post_by_id(post_id: ObjectId, engine: AIOEngine = Depends(get_engine)) -> Post:
     post = await engine.find_one(Post, Post.id == post_id)
     if post is None:
         raise HTTPException(404)
     return post
 
 
+async def check_post_exists(engine: AIOEngine, post_id: ObjectId) -> None:
+    if not await engine.get_collection(Post).count_documents({'_id': post_id}, limit=1):
+        raise HTTPException(404)
+
+
+async def delete_post_likes(engine: AIOEngine, post_id: ObjectId) -> None:
+    collection = engine.get_collection(Like)
+    pipeline = [
+        {"$match": {+Like.post: post_id}},
+        {"$group": {"_id": "$date", "count": {"$sum": 1}}},
+    ]
+    async for day in collection.aggregate(pipeline):
+        await count_like(engine, day['_id'], -day['count'])
+    await collection.delete_many({+Like.post: post_id})
+
+
+async def add_to_like_count(engine: AIOEngine, post_id: ObjectId, delta: int) -> Optional[int]:
+    '''
+    Returns updated like_count of post or None if there is no such post
+    '''
+    post = await engine.get_collection(Post).find_one_and_update(
+        {'_id': post_id},
+        {'$inc': {+Post.like_count: delta, +Post.version: 1}},
+        projection={+Post.like_count: 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    return None if post is None else post[+Post.like_count]
+
+
+def validate_bulk_items(
+    schema: Type[BaseModel],
+    items: List[Dict[str, Any]],
+) -> Tuple[List[Tuple[int, BaseModel]], List[Optional[Dict]]]:
+    '''
+    Validates every item of bulk request with schema, returns valid items with
+    their indexes and list of results where invalid items already have 422 status
+    '''
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(400, detail=f"Too many items, maximum is {BULK_MAX_ITEMS}")
+    valid, results = [], []
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, schema.parse_obj(item)))
+            results.append(None)
+        except ValidationError as error:
+            results.append({'status': 422, 'id': None, 'detail': error.errors()})
+    return valid, results
+
+
+async def insert_unordered(engine: AIOEngine, model: Type[Model], instances: Sequence[Model]) -> Dict[int, Dict]:
+    '''
+    Inserts instances with one unordered bulk write,
+    returns write errors by position of instance
+    '''
+    if not instances:
+        return {}
+    try:
+        await engine.get_collection(model).insert_many(
+            [instance.doc() for instance in instances], ordered=False
+        )
+    except BulkWriteError as error:
+        return {e['index']: e for e in error.details['writeErrors']}
+    return {}
+
+
 async def get_post_only_owner(
     post: Post = Depends(get_post_by_id),
     user: User = Depends(get_authorized_user)
@@ -31,54 +110,174 @@ async def get_post_only_owner(
 
 
 @router.get('/', dependencies=[Depends(get_authorized_user)])
-async def post_list(selector: Selector = Depends(get_selector(Post, Post.title))):
+async def post_list(
+    selector: Selector = Depends(get_selector(Post, *post_lookup_fields, default_fields=post_list_fields)),
+    if_none_match: Optional[str] = Header(None),
+):
     posts = await selector.get_objects()
-    return {'count': selector.count, 'posts': posts}
+    return etag_response(
+        {'count': selector.count, 'posts': posts, 'next_cursor': selector.next_cursor}, if_none_match
+    )
 
 
 @router.post('/', response_model=Post)
-async def post_create(post: PostCreate, user: ObjectId = Depends(get_authorized_user)):
+async def post_create(
+    post: PostCreate,
+    user: User = Depends(get_authorized_user),
+    engine: AIOEngine = Depends(get_engine),
+):
     post = await engine.save(Post(**post.dict(), owner=user.id))
-    return post
+    search_backend.index_object(post)
+    return model_response(post)
 
 
-@router.get('/{post_id}', response_model=Post, dependencies=[Depends(get_authorized_user)])
-async def post_detail(post : Post = Depends(get_post_by_id), Authorize: AuthJWT = Depends()):
-    return post
+@router.post('/bulk')
+async def post_bulk_create(
+    items: List[Dict[str, Any]],
+    user: User = Depends(get_authorized_user),
+    engine: AIOEngine = Depends(get_engine),
+):
+    valid, results = validate_bulk_items(PostCreate, items)
+    posts = [Post(**post.dict(), owner=user.id) for _, post in valid]
+    errors = await insert_unordered(engine, Post, posts)
+    for position, ((index, _), post) in enumerate(zip(valid, posts)):
+        error = errors.get(position)
+        if error is None:
+            search_backend.index_object(post)
+            results[index] = {'status': 201, 'id': post.id, 'detail': None}
+        else:
+            results[index] = {'status': 400, 'id': None, 'detail': error['errmsg']}
+    return FastJSONResponse({'created': len(posts) - len(errors), 'results': results})
+
+
+@router.post('/likes/bulk')
+async def post_bulk_like(
+    items: List[Dict[str, Any]],
+    user: User = Depends(get_authorized_user),
+    engine: AIOEngine = Depends(get_engine),
+):
+    valid, results = validate_bulk_items(LikeCreate, items)
+    post_ids = list({item.post_id for _, item in valid})
+    cursor = engine.get_collection(Post).find({'_id': {'$in': post_ids}}, {'_id': 1})
+    existing = {doc['_id'] async for doc in cursor} if post_ids else set()
+    date = today()
+    pending = []
+    for index, item in valid:
+        if item.post_id in existing:
+            pending.append((index, Like(post=item.post_id, user_id=user.id, date=date)))
+        else:
+            results[index] = {'status': 404, 'id': None, 'detail': "Not Found"}
+    errors = await insert_unordered(engine, Like, [like for _, like in pending])
+    like_counts = Counter()
+    for position, (index, like) in enumerate(pending):
+        error = errors.get(position)
+        if error is None:
+            like_counts[like.post] += 1
+            results[index] = {'status': 201, 'id': like.id, 'detail': None}
+        elif error['code'] == 11000:
+            results[index] = {'status': 400, 'id': None, 'detail': "Already liked"}
+        else:
+            results[index] = {'status': 400, 'id': None, 'detail': error['errmsg']}
+    if like_counts:
+        await engine.get_collection(Post).bulk_write([
+            UpdateOne({'_id': post_id}, {'$inc': {+Post.like_count: count, +Post.version: 1}})
+            for post_id, count in like_counts.items()
+        ], ordered=False)
+        await count_like(engine, date, sum(like_counts.values()))
+    return FastJSONResponse({'created': sum(like_counts.values()), 'results': results})
+
+
+@router.get('/{post_id}', responses={200: {'model': Post}}, dependencies=[Depends(get_authorized_user)])
+async def post_detail(
+    post_id: ObjectId,
+    projection: Dict[str, int] = Depends(get_projection(Post)),
+    if_none_match: Optional[str] = Header(None),
+    engine: AIOEngine = Depends(get_engine),
+):
+    return await find_one_versioned(engine, Post, {'_id': post_id}, projection, if_none_match)
 
 
 @router.put('/{post_id}', response_model=Post)
-async def post_update(*, post : Post = Depends(get_post_only_owner), data: PostUpdate):
-    updated_data = {**post.dict(), **data.dict(exclude_unset=True)}
-    post = Post(**updated_data)
-    await engine.save(post)
-    return post
+async def post_update(*, 
+    post_id: ObjectId,
+    data: PostUpdate,
+    user: User = Depends(get_authorized_user),
+    engine: AIOEngine = Depends(get_engine),
+):
+    # only changed fields are written, so concurrent like_count updates are kept
+    changes = {
+        Post.__odm_fields__[name].key_name: value
+        for name, value in data.dict(exclude_unset=True, exclude_none=True).items()
+    }
+    collection = engine.get_collection(Post)
+    query = {'_id': post_id, +Post.owner: user.id}
+    if changes:
+        doc = await collection.find_one_and_update(
+            query, {'$set': changes, '$inc': {+Post.version: 1}}, return_document=ReturnDocument.AFTER
+        )
+    else:
+        doc = await collection.find_one(query)
+    if doc is None:
+        await check_post_exists(engine, post_id)
+        raise HTTPException(403)
+    post = Post.parse_doc(doc)
+    search_backend.index_object(post)
+    return model_response(post)
 
 @router.delete('/{post_id}', status_code=204)
-async def post_delete(*, post : Post = Depends(get_post_only_owner)):
+async def post_delete(*, post : Post = Depends(get_post_only_owner), engine: AIOEngine = Depends(get_engine)):
     await engine.delete(post)
+    search_backend.remove_object(post)
+    await delete_post_likes(engine, post.id)
+
+
+@router.get('/{post_id}/likes', dependencies=[Depends(get_authorized_user)])
+async def post_likes(
+    post_id: ObjectId,
+    selector: Selector = Depends(get_selector(Like)),
+    if_none_match: Optional[str] = Header(None),
+    engine: AIOEngine = Depends(get_engine),
+):
+    await check_post_exists(engine, post_id)
+    likes = await selector.get_objects(Like.post == post_id)
+    return etag_response(
+        {'count': selector.count, 'likes': likes, 'next_cursor': selector.next_cursor}, if_none_match
+    )
+
 
-@router.post('/{post_id}/like', response_model=Post)
+@router.post('/{post_id}/like', response_model=LikeStatus)
 async def post_like(*, 
-    post : Post = Depends(get_post_by_id), 
-    user: ObjectId = Depends(get_authorized_user),
+    post_id: ObjectId,
+    user: User = Depends(get_authorized_user),
+    engine: AIOEngine = Depends(get_engine),
 ):
-    for like in post.likes:
-        if like.user_id == user.id:
-            raise HTTPException(400, detail="Already liked")
-    post.likes.append(Like(user_id = user.id))
-    await engine.save(post)
-    return post
+    like = Like(post=post_id, user_id=user.id, date=today())
+    try:
+        await engine.get_collection(Like).insert_one(like.doc())
+    except DuplicateKeyError:
+        await check_post_exists(engine, post_id)
+        raise HTTPException(400, detail="Already liked")
+    like_count = await add_to_like_count(engine, post_id, 1)
+    if like_count is None:
+        await engine.delete(like)
+        raise HTTPException(404)
+    await count_like(engine, like.date)
+    return model_response(LikeStatus.construct(post_id=post_id, liked=True, like_count=like_count, like=like))
 
 
-@router.post('/{post_id}/unlike', response_model=Post)
+@router.post('/{post_id}/unlike', response_model=LikeStatus)
 async def post_unlike(*, 
-    post : Post = Depends(get_post_by_id),
-    user: ObjectId = Depends(get_authorized_user)
+    post_id: ObjectId,
+    user: User = Depends(get_authorized_user),
+    engine: AIOEngine = Depends(get_engine),
 ):
-    for i, like in enumerate(post.likes):
-        if like.user_id == user.id:
-            post.likes.pop(i)
-            await engine.save(post)
-            return post
-    raise HTTPException(400, "No like found")
+    removed = await engine.get_collection(Like).find_one_and_delete(
+        {+Like.post: post_id, +Like.user_id: user.id}
+    )
+    if removed is None:
+        await check_post_exists(engine, post_id)
+        raise HTTPException(400, "No like found")
+    like = Like.parse_doc(removed)
+    like_count = await add_to_like_count(engine, post_id, -1) or 0
+    await count_like(engine, like.date, -1)
+    return model_response(LikeStatus.construct(post_id=post_id, liked=False, like_count=like_count, like=like))
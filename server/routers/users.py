@@ -1,39 +1,53 @@
+from typing import Dict, Optional
 from fastapi.security import HTTPBearer
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Header
 from fastapi_jwt_auth import AuthJWT
+from odmantic import AIOEngine
+from pymongo.errors import DuplicateKeyError
 
 from server.utils.security import create_tokens
 from server.models.user import User, UserCreate, UserInfo, UserLogin
-from server.settings import engine
-from .dependencies import get_authorized_user, Selector, get_selector
+from server.utils.responses import etag_response, model_response
+from server.utils.search import search_backend
+from .dependencies import (
+    get_authorized_user, get_engine, Selector, get_selector, get_projection, find_one_versioned, user_cache,
+)
 
 
 router = APIRouter()
 
+# password hash is never returned
+user_hidden_fields = ('password',)
+user_default_fields = ('email', 'username', 'last_login', 'last_request', 'registration_date', 'deleted')
+
 
 @router.post('/register', response_model=UserInfo)
-async def register_user(user: UserCreate, Authorize: AuthJWT = Depends()):
-    existing_users = await engine.find(
-        User, (User.email == user.email) | (User.username == user.username)
-    )
-    if existing_users:
-        raise HTTPException(400, detail="User with this email or username already exists")
+async def register_user(user: UserCreate, Authorize: AuthJWT = Depends(), engine: AIOEngine = Depends(get_engine)):
     user = User(**user.dict())
-    user.set_password(user.password)
-    user = await engine.save(user)
+    await user.set_password_async(user.password)
+    # unique email and username indexes reject existing users
+    try:
+        await engine.get_collection(User).insert_one(user.doc())
+    except DuplicateKeyError:
+        raise HTTPException(400, detail="User with this email or username already exists")
+    search_backend.index_object(user)
     return user
 
 
 @router.post('/login')
-async def login_user(data: UserLogin, Authorize: AuthJWT = Depends()):
+async def login_user(data: UserLogin, Authorize: AuthJWT = Depends(), engine: AIOEngine = Depends(get_engine)):
     user = await engine.find_one(User, (User.email == data.email) & (User.deleted == False))
     if not user:
         raise HTTPException(404)
-    if not user.verify_pswd(data.password):
+    if not await user.verify_pswd_async(data.password):
         raise HTTPException(400, detail='Wrong login data')
     user.update_login_time()
-    await engine.save(user)
-    return create_tokens(Authorize, str(user.id), is_admin=user.super_user)
+    await engine.get_collection(User).update_one(
+        {'_id': user.id},
+        {'$set': {+User.last_login: user.last_login}, '$inc': {+User.version: 1}},
+    )
+    user_cache.pop(str(user.id))
+    return model_response(create_tokens(Authorize, str(user.id), is_admin=user.super_user))
 
 
 @router.get('/refresh', dependencies=[Depends(HTTPBearer())])
@@ -45,26 +59,43 @@ async def refresh_tokens(Authorize: AuthJWT = Depends()):
 
 @router.get('/', dependencies=[Depends(get_authorized_user)])
 async def list_users(
-    selector: Selector = Depends(get_selector(User, User.username, User.email))
+    selector: Selector = Depends(get_selector(
+        User, User.username, User.email,
+        default_fields=user_default_fields,
+        hidden_fields=user_hidden_fields,
+    )),
+    if_none_match: Optional[str] = Header(None),
 ):
     users = await selector.get_objects()
-    return {'count': selector.count, 'users': users}
+    return etag_response(
+        {'count': selector.count, 'users': users, 'next_cursor': selector.next_cursor}, if_none_match
+    )
 
 
-@router.get('/{username}', response_model=UserInfo, dependencies=[Depends(get_authorized_user)])
-async def read_user(username: str):
-    user = await engine.find_one(User, User.username == username)
-    if user is None:
-        raise HTTPException(404)
-    return user
+@router.get('/{username}', responses={200: {'model': UserInfo}}, dependencies=[Depends(get_authorized_user)])
+async def read_user(
+    username: str,
+    projection: Dict[str, int] = Depends(get_projection(User, user_default_fields, user_hidden_fields)),
+    if_none_match: Optional[str] = Header(None),
+    engine: AIOEngine = Depends(get_engine),
+):
+    return await find_one_versioned(engine, User, {+User.username: username}, projection, if_none_match)
 
 
 @router.delete('/{username}')
-async def delete_user(username: str, req_user: User = Depends(get_authorized_user)):
-    user = await engine.find_one(User, User.username == username)
+async def delete_user(
+    username: str,
+    req_user: User = Depends(get_authorized_user),
+    engine: AIOEngine = Depends(get_engine),
+):
+    # users delete only themselves, so the authorized user is not fetched again
+    user = req_user if req_user.username == username else await engine.find_one(User, User.username == username)
     if user is None:
         raise HTTPException(404)
     if req_user.id != user.id:
         raise HTTPException(403)
-    user.deleted = True
-    await engine.save(user)
+    await engine.get_collection(User).update_one(
+        {'_id': user.id},
+        {'$set': {+User.deleted: True}, '$inc': {+User.version: 1}},
+    )
+    user_cache.pop(str(user.id))
@@ -0,0 +1,75 @@
+import argparse
+import time
+import uuid
+from typing import Callable, List
+
+import requests
+
+from server.scripts.benchmark_login import percentile
+
+
+def measure(name: str, call: Callable[[], requests.Response], requests_count: int) -> None:
+    latencies: List[float] = []
+    for _ in range(requests_count):
+        start = time.perf_counter()
+        call().raise_for_status()
+        latencies.append((time.perf_counter() - start) * 1000)
+    print(
+        f'{name:<24} p50 {percentile(latencies, 50):6.2f} ms'
+        f'  p99 {percentile(latencies, 99):6.2f} ms'
+        f'  {len(latencies) / (sum(latencies) / 1000):7.1f} req/s'
+    )
+
+
+def benchmark_endpoints(session: requests.Session, api_url: str, posts_count: int, requests_count: int) -> None:
+    '''
+    Measures latency of post and user endpoints one request at a time,
+    so numbers reflect handler and serialization cost
+    '''
+    name = uuid.uuid4().hex[:12]
+    credentials = {'email': f'{name}@benchmark.com', 'password': 'benchmark'}
+    session.post(
+        api_url + '/users/register', json={**credentials, 'username': name}
+    ).raise_for_status()
+    tokens = session.post(api_url + '/users/login', json=credentials).json()
+
+    session.headers['Authorization'] = f"Bearer {tokens['access_token']}"
+    response = session.post(api_url + '/posts/bulk', json=[
+        {'title': f'{name} {i}', 'text': 'benchmark ' * 50} for i in range(posts_count)
+    ])
+    response.raise_for_status()
+    post_id = response.json()['results'][0]['id']
+
+    post_url = f'{api_url}/posts/{post_id}'
+    liked = [False]
+
+    def toggle_like() -> requests.Response:
+        liked[0] = not liked[0]
+        return session.post(post_url + ('/like' if liked[0] else '/unlike'))
+
+    measure('GET posts limit=100', lambda: session.get(api_url + '/posts/', params={'limit': 100}), requests_count)
+    measure('GET post', lambda: session.get(post_url), requests_count)
+    measure('POST post', lambda: session.post(api_url + '/posts/', json={'title': name, 'text': 'text'}), requests_count)
+    measure('PUT post', lambda: session.put(post_url, json={'title': name}), requests_count)
+    measure('POST like/unlike', toggle_like, requests_count)
+    measure('GET users limit=100', lambda: session.get(api_url + '/users/', params={'limit': 100}), requests_count)
+    measure('GET user', lambda: session.get(f'{api_url}/users/{name}'), requests_count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency of post and user endpoints')
+    parser.add_argument('api_url', nargs='?', default='http://localhost:8000/api')
+    parser.add_argument('--posts', type=int, default=100, help='posts created before measuring')
+    parser.add_argument('--requests', type=int, default=300, help='requests per endpoint')
+    parser.add_argument(
+        '--asgi', action='store_true',
+        help='call server.main:app in this process instead of server at api_url',
+    )
+    args = parser.parse_args()
+    if args.asgi:
+        from fastapi.testclient import TestClient
+        from server.main import app
+        with TestClient(app) as client:
+            benchmark_endpoints(client, args.api_url, args.posts, args.requests)
+    else:
+        benchmark_endpoints(requests.Session(), args.api_url, args.posts, args.requests)
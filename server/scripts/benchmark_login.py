@@ -0,0 +1,86 @@
+import argparse
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+import requests
+
+
+def percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def measure(session: requests.Session, url: str, requests_count: int) -> List[float]:
+    '''
+    Returns latencies of sequential requests to url in milliseconds
+    '''
+    latencies = []
+    for _ in range(requests_count):
+        start = time.perf_counter()
+        session.get(url).raise_for_status()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def login_storm(api_url: str, credentials: Dict[str, str], stop: threading.Event, statuses: List[int]) -> None:
+    session = requests.Session()
+    while not stop.is_set():
+        statuses.append(session.post(api_url + '/users/login', json=credentials).status_code)
+
+
+def report(name: str, latencies: List[float]) -> None:
+    print(
+        f'{name:>8}: p50 {percentile(latencies, 50):7.1f} ms'
+        f'  p99 {percentile(latencies, 99):7.1f} ms'
+        f'  max {max(latencies):7.1f} ms'
+    )
+
+
+def benchmark_login(api_url: str, probe_path: str, clients: int, requests_count: int) -> None:
+    '''
+    Measures latency of probe endpoint alone and during login storm of
+    concurrent clients, latency should stay flat while passwords are hashed
+    '''
+    name = uuid.uuid4().hex[:12]
+    credentials = {'email': f'{name}@benchmark.com', 'password': 'benchmark'}
+    requests.post(
+        api_url + '/users/register', json={**credentials, 'username': name}
+    ).raise_for_status()
+
+    session = requests.Session()
+    probe_url = api_url.rsplit('/api', 1)[0] + probe_path
+    measure(session, probe_url, 10)
+    report('idle', measure(session, probe_url, requests_count))
+
+    stop = threading.Event()
+    statuses: List[int] = []
+    threads = [
+        threading.Thread(target=login_storm, args=(api_url, credentials, stop, statuses))
+        for _ in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    try:
+        report('storm', measure(session, probe_url, requests_count))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+    print(
+        f'{len(statuses)} logins in {elapsed:.1f} s ({len(statuses) / elapsed:.1f}/s),'
+        f' {statuses.count(503)} rejected with 503'
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency of other endpoints during login storm')
+    parser.add_argument('api_url', nargs='?', default='http://localhost:8000/api')
+    parser.add_argument('--probe', default='/ping', help='path of endpoint measured during storm')
+    parser.add_argument('--clients', type=int, default=32, help='concurrent logging in clients')
+    parser.add_argument('--requests', type=int, default=200, help='probe requests per phase')
+    args = parser.parse_args()
+    benchmark_login(args.api_url, args.probe, args.clients, args.requests)
@@ -0,0 +1,56 @@
+import asyncio
+
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+
+from server.settings import engine
+from server.models.post import Like, Post
+
+loop = asyncio.get_event_loop()
+
+BATCH_SIZE = 100
+
+
+async def insert_likes(operations) -> None:
+    try:
+        await engine.get_collection(Like).bulk_write(operations, ordered=False)
+    except BulkWriteError as error:
+        # likes already moved by previous run of the migration
+        if any(e['code'] != 11000 for e in error.details['writeErrors']):
+            raise
+
+
+async def migrate_likes():
+    '''
+    Moves likes embedded in Post.likes into Like collection and stores their
+    number in Post.like_count. Can be run again if interrupted.
+    '''
+    posts = engine.get_collection(Post)
+    await posts.update_many(
+        {+Post.like_count: {'$exists': False}}, {'$set': {+Post.like_count: 0}}
+    )
+    migrated = 0
+    cursor = posts.find({'likes': {'$exists': True}}, {'likes': 1}).batch_size(BATCH_SIZE)
+    async for post in cursor:
+        likes = post['likes'] or []
+        operations = [
+            InsertOne(Like(post=post['_id'], user_id=like['user_id'], date=like['date']).doc())
+            for like in likes
+        ]
+        for i in range(0, len(operations), BATCH_SIZE):
+            await insert_likes(operations[i:i + BATCH_SIZE])
+        like_count = await engine.get_collection(Like).count_documents({+Like.post: post['_id']})
+        await posts.update_one(
+            {'_id': post['_id']},
+            {
+                '$set': {+Post.like_count: like_count},
+                '$unset': {'likes': ''},
+                '$inc': {+Post.version: 1},
+            },
+        )
+        migrated += 1
+    print(f'Done, {migrated} posts migrated')
+
+
+if __name__ == '__main__':
+    loop.run_until_complete(migrate_likes())
@@ -0,0 +1,38 @@
+import asyncio
+
+from pymongo import DeleteMany, UpdateOne
+
+from server.settings import engine
+from server.models.analytics import LikeCounter
+from server.models.post import Like
+
+loop = asyncio.get_event_loop()
+
+
+async def rebuild_like_counters():
+    '''
+    Recounts likes per day and overwrites counts of LikeCounter documents,
+    used for backfill and for fixing counters drifted by failed writes
+    '''
+    pipeline = [
+        {"$group": {"_id": "$date", "count": {"$sum": 1}}},
+    ]
+    counts = await engine.get_collection(Like).aggregate(pipeline).to_list(length=None)
+    operations = [
+        # existing counters keep their _id, which a replacement can not change
+        UpdateOne(
+            {+LikeCounter.date: item['_id']},
+            {'$set': {+LikeCounter.count: item['count']}},
+            upsert=True,
+        )
+        for item in counts
+    ]
+    operations.append(
+        DeleteMany({+LikeCounter.date: {'$nin': [item['_id'] for item in counts]}})
+    )
+    await engine.get_collection(LikeCounter).bulk_write(operations, ordered=True)
+    print(f'Done, {len(counts)} days counted')
+
+
+if __name__ == '__main__':
+    loop.run_until_complete(rebuild_like_counters())
@@ -0,0 +1,19 @@
+import asyncio
+
+from server.main import setup_indexes
+
+loop = asyncio.get_event_loop()
+
+
+async def reconcile_indexes():
+    '''
+    Makes indexes match the declared ones, also dropping indexes which are
+    not declared. Workers only create missing indexes on startup, so run this
+    once after removing or renaming an index.
+    '''
+    await setup_indexes(drop_undeclared=True)
+    print('Done')
+
+
+if __name__ == '__main__':
+    loop.run_until_complete(reconcile_indexes())
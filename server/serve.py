@@ -0,0 +1,72 @@
+'''
+Production entry point, run with "python -m server.serve". Every worker is a
+separate process with its own database client, workers which exit after
+WEB_MAX_REQUESTS are replaced by the supervisor.
+'''
+import argparse
+import importlib.util
+import logging
+import os
+from typing import Any, Dict
+
+import uvicorn
+
+from server.settings import (
+    WEB_GRACEFUL_TIMEOUT, WEB_KEEP_ALIVE, WEB_MAX_REQUESTS, WEB_MAX_REQUESTS_JITTER, WEB_WORKERS,
+)
+
+
+logger = logging.getLogger('uvicorn.error')
+
+APP = 'server.main:app'
+
+
+def usable_cpu_count() -> int:
+    '''
+    CPUs this process may run on, which respects container cpusets unlike os.cpu_count
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def is_installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def server_options(
+    host: str = '0.0.0.0',
+    port: int = 8000,
+    workers: int = WEB_WORKERS,
+    max_requests: int = WEB_MAX_REQUESTS,
+) -> Dict[str, Any]:
+    '''
+    Returns uvicorn.run keyword arguments, workers=0 uses one worker per usable CPU
+    '''
+    return {
+        'host': host,
+        'port': port,
+        'workers': workers or usable_cpu_count(),
+        'loop': 'uvloop' if is_installed('uvloop') else 'asyncio',
+        'http': 'httptools' if is_installed('httptools') else 'h11',
+        'limit_max_requests': max_requests or None,
+        'limit_max_requests_jitter': WEB_MAX_REQUESTS_JITTER if max_requests else 0,
+        'timeout_graceful_shutdown': WEB_GRACEFUL_TIMEOUT,
+        'timeout_keep_alive': WEB_KEEP_ALIVE,
+        'proxy_headers': True,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run BlogAPI with production settings')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=WEB_WORKERS, help='0 for one per CPU')
+    parser.add_argument('--max-requests', type=int, default=WEB_MAX_REQUESTS, help='0 to never restart workers')
+    args = parser.parse_args()
+    options = server_options(args.host, args.port, args.workers, args.max_requests)
+    logging.basicConfig(level=logging.INFO)
+    logger.info(
+        'Starting %s workers, loop %s, http %s', options['workers'], options['loop'], options['http']
+    )
+    uvicorn.run(APP, **options)
@@ -1,10 +1,10 @@
 from datetime import timedelta
-from odmantic import AIOEngine
-from motor.motor_asyncio import AsyncIOMotorClient
 from fastapi_jwt_auth import AuthJWT
 from pydantic import BaseModel
 import os
 
+from server.storage import get_storage
+
 # JWT auth settings
 SECRET_KEY = os.environ.get('SECRET_KEY', '09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7')
 
@@ -13,9 +13,99 @@ MIN_PASSWORD_LENGTH = 3
 
 DATABASE = os.environ.get('DATABASE', 'blog')
 DB_CLIENT = os.environ.get('DB_CLIENT' ,"mongodb://root:root@db:27017/")
-# DB settings
-client = AsyncIOMotorClient(DB_CLIENT)
-engine = AIOEngine(client, database=DATABASE)
+# DB settings, "mongo" uses DB_CLIENT, "memory" keeps data in process for tests and benchmarks
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+
+# Motor connection pool of every worker, timeouts are in milliseconds
+DB_MAX_POOL_SIZE = int(os.environ.get('DB_MAX_POOL_SIZE', 100))
+DB_MIN_POOL_SIZE = int(os.environ.get('DB_MIN_POOL_SIZE', 0))
+DB_MAX_IDLE_TIME_MS = int(os.environ.get('DB_MAX_IDLE_TIME_MS', 0)) or None
+DB_CONNECT_TIMEOUT_MS = int(os.environ.get('DB_CONNECT_TIMEOUT_MS', 20000))
+DB_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('DB_SERVER_SELECTION_TIMEOUT_MS', 30000))
+DB_SOCKET_TIMEOUT_MS = int(os.environ.get('DB_SOCKET_TIMEOUT_MS', 0)) or None
+DB_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('DB_WAIT_QUEUE_TIMEOUT_MS', 0)) or None
+# Comma separated wire compressors tried in order, like "zstd,snappy,zlib"
+DB_COMPRESSORS = os.environ.get('DB_COMPRESSORS', '')
+# Default read preference and the one of analytics endpoints, analytics
+# read from secondaries can lag behind writes by replication delay
+DB_READ_PREFERENCE = os.environ.get('DB_READ_PREFERENCE', 'primary')
+ANALYTICS_READ_PREFERENCE = os.environ.get('ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+
+DB_CLIENT_OPTIONS = {
+    'maxPoolSize': DB_MAX_POOL_SIZE,
+    'minPoolSize': DB_MIN_POOL_SIZE,
+    'maxIdleTimeMS': DB_MAX_IDLE_TIME_MS,
+    'connectTimeoutMS': DB_CONNECT_TIMEOUT_MS,
+    'serverSelectionTimeoutMS': DB_SERVER_SELECTION_TIMEOUT_MS,
+    'socketTimeoutMS': DB_SOCKET_TIMEOUT_MS,
+    'waitQueueTimeoutMS': DB_WAIT_QUEUE_TIMEOUT_MS,
+    'readPreference': DB_READ_PREFERENCE,
+}
+if DB_COMPRESSORS:
+    DB_CLIENT_OPTIONS['compressors'] = DB_COMPRESSORS
+
+# client is created on app startup in every worker, not at import,
+# so forked workers never share connections
+storage = get_storage(STORAGE_BACKEND, DB_CLIENT, DATABASE, **DB_CLIENT_OPTIONS)
+engine = storage.engine
+
+# Seconds between bulk writes of buffered User.last_request values
+REQUEST_TIME_FLUSH_INTERVAL = float(os.environ.get('REQUEST_TIME_FLUSH_INTERVAL', 5))
+
+# Per worker cache of authorized users
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+
+# Seconds before estimated collection counts used by lists are refreshed
+COUNT_CACHE_TTL = float(os.environ.get('COUNT_CACHE_TTL', 30))
+
+# Full text search: "mongo" uses text indexes, "memory" in-process inverted index
+# text indexes are not supported by memory storage
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'memory' if STORAGE_BACKEND == 'memory' else 'mongo')
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 1000))
+# Search posts by text besides title
+SEARCH_POST_TEXT = os.environ.get('SEARCH_POST_TEXT', '').lower() in ('1', 'true', 'yes')
+
+# Cache of likes analytics, closed ranges are ranges ending before today.
+# Every worker has its own cache and a like change invalidates only the cache
+# of the worker handling it, so with several workers a closed range can stay
+# stale for up to LIKES_CACHE_CLOSED_TTL after an unlike of an old like or a
+# post delete. Lower it when such counts have to be exact sooner.
+LIKES_CACHE_SIZE = int(os.environ.get('LIKES_CACHE_SIZE', 256))
+LIKES_CACHE_TTL = float(os.environ.get('LIKES_CACHE_TTL', 60))
+LIKES_CACHE_CLOSED_TTL = float(os.environ.get('LIKES_CACHE_CLOSED_TTL', 24 * 60 * 60))
+
+# Number of documents read from database and sent to client at once by exports
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 500))
+
+# Maximum number of items accepted by one bulk create request
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 1000))
+
+# Threads hashing passwords outside of event loop and number of hash calls
+# allowed to wait for a free thread, calls over the limit are rejected with 503
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1)))
+PASSWORD_HASH_QUEUE_SIZE = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE', 64))
+
+# Production server (server.serve): number of workers (0 - number of usable CPUs),
+# requests after which a worker is replaced (0 - never) with random jitter so
+# workers do not restart at once, and seconds to finish open requests on shutdown
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 0))
+WEB_MAX_REQUESTS = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+WEB_MAX_REQUESTS_JITTER = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', 1000))
+WEB_GRACEFUL_TIMEOUT = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+WEB_KEEP_ALIVE = int(os.environ.get('WEB_KEEP_ALIVE', 5))
+
+# Seconds /ready waits for database ping
+READY_TIMEOUT = float(os.environ.get('READY_TIMEOUT', 2))
+
+# Request and database metrics on /metrics in Prometheus format
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# Database operations slower than SLOW_QUERY_MS are logged (0 disables), explain
+# plan is captured for first slow operation of every query shape
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', 'true').lower() in ('1', 'true', 'yes')
+SLOW_QUERY_MAX_SHAPES = int(os.environ.get('SLOW_QUERY_MAX_SHAPES', 200))
 
 
 # in production you can use Settings management
@@ -0,0 +1,23 @@
+from typing import Any
+
+from .base import Storage, StorageEngine
+from .instrument import Operation
+from .memory import MemoryStorage
+from .mongo import MongoStorage
+
+
+STORAGE_BACKENDS = {
+    'mongo': MongoStorage,
+    'memory': MemoryStorage,
+}
+
+
+def get_storage(backend: str, url: str, database: str, **client_options: Any) -> Storage:
+    '''
+    Creates storage by backend name, url and client_options are used only by mongo
+    '''
+    if backend == 'mongo':
+        return MongoStorage(url, database, **client_options)
+    if backend == 'memory':
+        return MemoryStorage(database)
+    raise ValueError(f'Unknown storage backend {backend!r}, choose one of {", ".join(STORAGE_BACKENDS)}')
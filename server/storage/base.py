@@ -0,0 +1,108 @@
+from typing import Any, Dict, List, Optional
+
+from odmantic import AIOEngine
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+
+from .instrument import InstrumentedDatabase, Listener
+
+
+class StorageEngine(AIOEngine):
+    '''
+    ODMantic engine using client of storage. The client is looked up on every
+    use, so the engine can be imported before the client is created on startup.
+
+    Parameters:
+        storage (Storage): Storage providing the client
+        read_preference (str): Read preference name like "secondaryPreferred",
+            default of client if None
+    '''
+
+    def __init__(self, storage: 'Storage', read_preference: Optional[str] = None) -> None:
+        # AIOEngine constructor needs a client, attributes are set here instead
+        self.storage = storage
+        self.database_name = storage.database_name
+        self.read_preference = read_preference
+
+    @property
+    def client(self) -> Any:
+        return self.storage.client
+
+    @property
+    def database(self) -> Any:
+        return self.storage.get_database(self.read_preference)
+
+
+class Storage:
+    '''
+    Database used by the app, gives ODMantic engines over a Motor compatible
+    client. The client is created by connect or on first use and released by close.
+    Operations on databases given by storage are passed to listeners.
+    '''
+
+    def __init__(self, database: str) -> None:
+        self.database_name = database
+        self.listeners: List[Listener] = []
+        self._client: Any = None
+        self._databases: Dict[Optional[str], Any] = {}
+        self._engines: Dict[Optional[str], StorageEngine] = {}
+
+    def create_client(self) -> Any:
+        raise NotImplementedError
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            self._client = self.create_client()
+        return self._client
+
+    @property
+    def connected(self) -> bool:
+        return self._client is not None
+
+    def connect(self) -> Any:
+        return self.client
+
+    def add_listener(self, listener: Listener) -> None:
+        '''
+        Registers callable called with every finished Operation, it is called in
+        the event loop after each database call so it has to be fast
+        '''
+        self.listeners.append(listener)
+
+    def get_database(self, read_preference: Optional[str] = None) -> InstrumentedDatabase:
+        database = self._databases.get(read_preference)
+        if database is None:
+            if read_preference is None:
+                database = self.client[self.database_name]
+            else:
+                database = self.client.get_database(
+                    self.database_name,
+                    read_preference=make_read_preference(read_pref_mode_from_name(read_preference), None),
+                )
+            database = self._databases[read_preference] = InstrumentedDatabase(database, self.listeners)
+        return database
+
+    @property
+    def engine(self) -> StorageEngine:
+        return self.engine_for(None)
+
+    def engine_for(self, read_preference: Optional[str]) -> StorageEngine:
+        '''
+        Returns engine reading with read_preference, writes always go to primary
+        '''
+        engine = self._engines.get(read_preference)
+        if engine is None:
+            engine = self._engines[read_preference] = StorageEngine(self, read_preference)
+        return engine
+
+    async def ping(self) -> None:
+        '''
+        Checks that database answers, raises PyMongoError otherwise
+        '''
+        await self.client.admin.command('ping')
+
+    async def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+            self._databases.clear()
@@ -0,0 +1,155 @@
+'''
+Wrappers of database and collection objects which time every operation and
+pass it to listeners of storage, used for metrics of database calls
+'''
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+
+class Operation(NamedTuple):
+    '''
+    Finished database operation, args and kwargs are the ones of collection
+    method, for cursors kwargs also get sort, skip and limit set on the cursor
+    '''
+    collection: str
+    name: str
+    seconds: float
+    args: Tuple
+    kwargs: Dict[str, Any]
+
+
+Listener = Callable[[Operation], None]
+
+# collection methods returning cursors, their time is the time of reading results
+CURSOR_METHODS = frozenset(('find', 'aggregate', 'list_indexes'))
+# coroutine methods timed as a whole
+ASYNC_METHODS = frozenset((
+    'find_one', 'find_one_and_update', 'find_one_and_replace', 'find_one_and_delete',
+    'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one',
+    'delete_one', 'delete_many', 'bulk_write', 'count_documents', 'estimated_document_count',
+    'distinct', 'create_index', 'create_indexes', 'drop_index', 'drop_indexes', 'index_information',
+))
+
+
+class InstrumentedCursor:
+    '''
+    Cursor recording one operation with the summed time of its fetches when
+    it is exhausted, read with to_list or closed
+    '''
+
+    def __init__(self, cursor: Any, collection: str, name: str, args: Tuple, kwargs: Dict, listeners: List[Listener]):
+        self._cursor = cursor
+        self._collection = collection
+        self._name = name
+        self._args = args
+        self._kwargs = dict(kwargs)
+        self._listeners = listeners
+        self._seconds = 0.0
+        self._recorded = False
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+    def _modify(self, name: str, *args: Any) -> 'InstrumentedCursor':
+        self._kwargs[name] = args[0] if len(args) == 1 else args
+        getattr(self._cursor, name)(*args)
+        return self
+
+    def sort(self, *args: Any) -> 'InstrumentedCursor':
+        return self._modify('sort', *args)
+
+    def skip(self, skip: int) -> 'InstrumentedCursor':
+        return self._modify('skip', skip)
+
+    def limit(self, limit: int) -> 'InstrumentedCursor':
+        return self._modify('limit', limit)
+
+    def batch_size(self, batch_size: int) -> 'InstrumentedCursor':
+        return self._modify('batch_size', batch_size)
+
+    def _record(self) -> None:
+        if not self._recorded:
+            self._recorded = True
+            operation = Operation(self._collection, self._name, self._seconds, self._args, self._kwargs)
+            for listener in self._listeners:
+                listener(operation)
+
+    def __aiter__(self) -> 'InstrumentedCursor':
+        return self
+
+    async def __anext__(self) -> Any:
+        started = time.perf_counter()
+        try:
+            return await self._cursor.__anext__()
+        except StopAsyncIteration:
+            self._seconds += time.perf_counter() - started
+            self._record()
+            raise
+        finally:
+            if not self._recorded:
+                self._seconds += time.perf_counter() - started
+
+    async def next(self) -> Any:
+        return await self.__anext__()
+
+    async def to_list(self, length: Optional[int] = None) -> List[Any]:
+        started = time.perf_counter()
+        try:
+            return await self._cursor.to_list(length=length)
+        finally:
+            self._seconds += time.perf_counter() - started
+            self._record()
+
+    async def close(self) -> None:
+        await self._cursor.close()
+        self._record()
+
+
+class InstrumentedCollection:
+
+    def __init__(self, collection: Any, listeners: List[Listener]) -> None:
+        self._collection = collection
+        self._listeners = listeners
+        self.name = collection.name
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._collection, name)
+        if name in ASYNC_METHODS:
+            return self._timed(name, attribute)
+        if name in CURSOR_METHODS:
+            return lambda *args, **kwargs: InstrumentedCursor(
+                attribute(*args, **kwargs), self.name, name, args, kwargs, self._listeners
+            )
+        return attribute
+
+    def _timed(self, name: str, method: Callable) -> Callable:
+        async def timed(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                operation = Operation(self.name, name, time.perf_counter() - started, args, kwargs)
+                for listener in self._listeners:
+                    listener(operation)
+        return timed
+
+
+class InstrumentedDatabase:
+
+    def __init__(self, database: Any, listeners: List[Listener]) -> None:
+        self._database = database
+        self._listeners = listeners
+        self._collections: Dict[str, InstrumentedCollection] = {}
+        self.name = database.name
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._database, name)
+
+    def __getitem__(self, name: str) -> InstrumentedCollection:
+        return self.get_collection(name)
+
+    def get_collection(self, name: str) -> InstrumentedCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = InstrumentedCollection(self._database[name], self._listeners)
+        return collection
@@ -0,0 +1,656 @@
+'''
+In-memory implementation of the part of Motor client API used by ODMantic
+and the routers. Documents of a collection are kept in insertion order in a
+dict keyed by _id, declared indexes enforce uniqueness and narrow equality
+lookups on their first key. Operations run synchronously inside the event
+loop, so each of them is atomic.
+'''
+import copy
+from collections import defaultdict, deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple, Union
+
+from bson.objectid import ObjectId
+from bson.son import SON
+from pymongo import (
+    DeleteMany, DeleteOne, IndexModel, InsertOne, ReplaceOne, ReturnDocument, TEXT, UpdateMany, UpdateOne,
+)
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import (
+    BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult,
+)
+
+from .base import Storage
+from .query import (
+    MISSING, aggregate, apply_update, equality_value, get_path, is_update_document,
+    match, normalize_sort, project, sort_documents, upsert_document,
+)
+
+
+def _hashable(value: Any) -> Any:
+    if isinstance(value, Mapping):
+        return tuple((key, _hashable(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+class MemoryIndex:
+    '''
+    Index of collection, maps values of its first key to ids of documents
+    and values of all keys to ids when unique
+    '''
+
+    def __init__(self, name: str, keys: List[Tuple[str, Any]], unique: bool = False) -> None:
+        self.name = name
+        self.keys = keys
+        self.unique = unique
+        self.is_text = any(direction == TEXT for _, direction in keys)
+        self._by_first: Dict[Any, Set[Any]] = defaultdict(set)
+        self._by_key: Dict[Tuple, Any] = {}
+
+    def info(self) -> Dict[str, Any]:
+        if self.is_text:
+            info: Dict[str, Any] = {
+                'key': [('_fts', 'text'), ('_ftsx', 1)],
+                'weights': {key: 1 for key, _ in self.keys},
+            }
+        else:
+            info = {'key': list(self.keys)}
+        info['v'] = 2
+        if self.unique:
+            info['unique'] = True
+        return info
+
+    def _values(self, doc: Mapping) -> Tuple:
+        values = []
+        for key, _ in self.keys:
+            value = get_path(doc, key)
+            values.append(None if value is MISSING else _hashable(value))
+        return tuple(values)
+
+    def check(self, doc: Mapping, doc_id: Any, collection: str) -> None:
+        if not self.unique or self.is_text:
+            return
+        values = self._values(doc)
+        owner = self._by_key.get(values, doc_id)
+        if owner != doc_id:
+            dup_key = dict(zip((key for key, _ in self.keys), values))
+            message = f'E11000 duplicate key error collection: {collection} index: {self.name} dup key: {dup_key}'
+            raise DuplicateKeyError(message, 11000, {
+                'index': 0, 'code': 11000, 'errmsg': message, 'keyPattern': dict(self.keys), 'keyValue': dup_key,
+            })
+
+    def add(self, doc: Mapping, doc_id: Any) -> None:
+        if self.is_text:
+            return
+        values = self._values(doc)
+        self._by_first[values[0]].add(doc_id)
+        if self.unique:
+            self._by_key[values] = doc_id
+
+    def remove(self, doc: Mapping, doc_id: Any) -> None:
+        if self.is_text:
+            return
+        values = self._values(doc)
+        ids = self._by_first.get(values[0])
+        if ids is not None:
+            ids.discard(doc_id)
+            if not ids:
+                del self._by_first[values[0]]
+        if self.unique and self._by_key.get(values) == doc_id:
+            del self._by_key[values]
+
+    def lookup(self, value: Any) -> Set[Any]:
+        return self._by_first.get(_hashable(value), set())
+
+
+class MemoryCursor:
+    '''
+    Async cursor over documents, query is evaluated on first read so sort,
+    skip and limit can be chained like on Motor cursor
+    '''
+
+    def __init__(self, load: Callable[['MemoryCursor'], List[Dict]]) -> None:
+        self._load = load
+        self._results: Optional[Deque[Dict]] = None
+        self.sort_spec: List[Tuple[str, int]] = []
+        self.skip_count = 0
+        self.limit_count = 0
+
+    def sort(self, key_or_list: Any, direction: Any = None) -> 'MemoryCursor':
+        self.sort_spec = normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, skip: int) -> 'MemoryCursor':
+        self.skip_count = skip
+        return self
+
+    def limit(self, limit: int) -> 'MemoryCursor':
+        self.limit_count = limit
+        return self
+
+    def batch_size(self, batch_size: int) -> 'MemoryCursor':
+        return self
+
+    def _fetch(self) -> Deque[Dict]:
+        if self._results is None:
+            self._results = deque(self._load(self))
+        return self._results
+
+    def __aiter__(self) -> 'MemoryCursor':
+        return self
+
+    async def __anext__(self) -> Dict:
+        results = self._fetch()
+        if not results:
+            raise StopAsyncIteration
+        return results.popleft()
+
+    async def next(self) -> Dict:
+        return await self.__anext__()
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict]:
+        results = self._fetch()
+        count = len(results) if length is None else min(length, len(results))
+        return [results.popleft() for _ in range(count)]
+
+    async def close(self) -> None:
+        self._results = deque()
+
+
+class MemorySession:
+    '''
+    Session stand-in, operations are atomic so transactions do nothing
+    '''
+
+    def __init__(self, client: 'MemoryClient') -> None:
+        self.client = client
+        self.in_transaction = False
+
+    def start_transaction(self, *args: Any, **kwargs: Any) -> 'MemorySession':
+        self.in_transaction = True
+        return self
+
+    async def commit_transaction(self) -> None:
+        self.in_transaction = False
+
+    async def abort_transaction(self) -> None:
+        self.in_transaction = False
+
+    async def end_session(self) -> None:
+        pass
+
+    async def __aenter__(self) -> 'MemorySession':
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        self.in_transaction = False
+
+
+class MemoryCollection:
+
+    def __init__(self, database: 'MemoryDatabase', name: str) -> None:
+        self.database = database
+        self.name = name
+        self.full_name = f'{database.name}.{name}'
+        self.clear()
+
+    def clear(self) -> None:
+        '''
+        Removes documents and indexes, collection objects are kept by their
+        users like Motor handles, so dropped collection is cleared in place
+        '''
+        self._documents: Dict[Any, Dict] = {}
+        # insertion number of documents, to keep natural order of index lookups
+        self._positions: Dict[Any, int] = {}
+        self._inserted = 0
+        self._indexes: Dict[str, MemoryIndex] = {'_id_': MemoryIndex('_id_', [('_id', 1)], unique=True)}
+
+    def with_options(self, **kwargs: Any) -> 'MemoryCollection':
+        return self
+
+    # ____________ Reads ____________
+
+    def _candidates(self, query: Mapping) -> Iterable[Any]:
+        '''
+        Ids of documents that can match query, narrowed by _id or by
+        equality on first key of an index
+        '''
+        condition = query.get('_id', MISSING)
+        if condition is not MISSING:
+            value = equality_value(condition)
+            if value is not MISSING:
+                return [value] if _hashable(value) in self._documents else []
+            if isinstance(condition, Mapping) and set(condition) == {'$in'}:
+                return [value for value in condition['$in'] if _hashable(value) in self._documents]
+        best: Optional[Set[Any]] = None
+        for index in self._indexes.values():
+            if index.is_text or index.name == '_id_':
+                continue
+            value = equality_value(query.get(index.keys[0][0], MISSING))
+            if value is MISSING or isinstance(value, list):
+                continue
+            ids = index.lookup(value)
+            if best is None or len(ids) < len(best):
+                best = ids
+        if best is not None:
+            # keep natural order of documents
+            return sorted(best, key=lambda doc_id: self._positions[_hashable(doc_id)])
+        return list(self._documents)
+
+    def _matching(self, query: Optional[Mapping]) -> List[Dict]:
+        query = query or {}
+        docs = []
+        for doc_id in self._candidates(query):
+            doc = self._documents.get(_hashable(doc_id))
+            if doc is not None and match(doc, query):
+                docs.append(doc)
+        return docs
+
+    def _first(self, query: Optional[Mapping], sort: Any = None) -> Optional[Dict]:
+        docs = self._matching(query)
+        if sort:
+            docs = sort_documents(docs, normalize_sort(sort))
+        return docs[0] if docs else None
+
+    def find(
+        self,
+        filter: Optional[Mapping] = None,
+        projection: Union[None, Mapping, Sequence] = None,
+        skip: int = 0,
+        limit: int = 0,
+        sort: Any = None,
+        **kwargs: Any,
+    ) -> MemoryCursor:
+        def load(cursor: MemoryCursor) -> List[Dict]:
+            docs = self._matching(filter)
+            if cursor.sort_spec:
+                docs = sort_documents(docs, cursor.sort_spec)
+            docs = docs[cursor.skip_count:]
+            if cursor.limit_count:
+                docs = docs[:abs(cursor.limit_count)]
+            return [project(doc, projection) for doc in docs]
+
+        cursor = MemoryCursor(load).skip(skip).limit(limit)
+        if sort is not None:
+            cursor.sort(sort)
+        return cursor
+
+    async def find_one(
+        self, filter: Optional[Mapping] = None, projection: Union[None, Mapping, Sequence] = None, *args: Any, **kwargs: Any
+    ) -> Optional[Dict]:
+        if filter is not None and not isinstance(filter, Mapping):
+            filter = {'_id': filter}
+        doc = self._first(filter, kwargs.get('sort'))
+        return None if doc is None else project(doc, projection)
+
+    def aggregate(self, pipeline: Sequence[Mapping], **kwargs: Any) -> MemoryCursor:
+        def load(cursor: MemoryCursor) -> List[Dict]:
+            stages = list(pipeline)
+            # use indexes for leading $match like MongoDB does
+            if stages and '$match' in stages[0]:
+                docs = self._matching(stages.pop(0)['$match'])
+            else:
+                docs = list(self._documents.values())
+            return copy.deepcopy(aggregate(docs, stages))
+        return MemoryCursor(load)
+
+    async def count_documents(self, filter: Mapping, skip: int = 0, limit: int = 0, **kwargs: Any) -> int:
+        count = max(0, len(self._matching(filter)) - skip)
+        return min(count, limit) if limit else count
+
+    async def estimated_document_count(self, **kwargs: Any) -> int:
+        return len(self._documents)
+
+    async def distinct(self, key: str, filter: Optional[Mapping] = None, **kwargs: Any) -> List[Any]:
+        values: Dict[Any, Any] = {}
+        for doc in self._matching(filter):
+            value = get_path(doc, key)
+            for item in value if isinstance(value, list) else [value]:
+                if item is not MISSING:
+                    values.setdefault(_hashable(item), item)
+        return list(values.values())
+
+    # ____________ Writes ____________
+
+    def _store(self, doc: Dict, old: Optional[Dict] = None) -> None:
+        '''
+        Stores new version of document after checking unique indexes
+        '''
+        doc_id = doc['_id']
+        for index in self._indexes.values():
+            index.check(doc, doc_id, self.full_name)
+        for index in self._indexes.values():
+            if old is not None:
+                index.remove(old, doc_id)
+            index.add(doc, doc_id)
+        key = _hashable(doc_id)
+        if key not in self._positions:
+            self._positions[key] = self._inserted
+            self._inserted += 1
+        self._documents[key] = doc
+
+    def _insert(self, document: Dict) -> Any:
+        if '_id' not in document:
+            # pymongo adds generated _id to inserted document
+            document['_id'] = ObjectId()
+        doc = copy.deepcopy(document)
+        if _hashable(doc['_id']) in self._documents:
+            self._indexes['_id_'].check(doc, MISSING, self.full_name)
+        self._store(doc)
+        return doc['_id']
+
+    def _delete(self, doc: Dict) -> None:
+        for index in self._indexes.values():
+            index.remove(doc, doc['_id'])
+        del self._documents[_hashable(doc['_id'])]
+        del self._positions[_hashable(doc['_id'])]
+
+    def _update(
+        self, filter: Mapping, update: Mapping, upsert: bool, many: bool, replace: bool = False, sort: Any = None
+    ) -> Tuple[Dict[str, Any], Optional[Dict], Optional[Dict]]:
+        '''
+        Returns raw result with document before and after update of first matched document
+        '''
+        if replace and is_update_document(update):
+            raise ValueError('replacement can not include $ operators')
+        if not replace and not is_update_document(update):
+            raise ValueError('update only works with $ operators')
+        docs = self._matching(filter)
+        if sort:
+            docs = sort_documents(docs, normalize_sort(sort))
+        if not many:
+            docs = docs[:1]
+        result: Dict[str, Any] = {'n': 0, 'nModified': 0, 'ok': 1.0}
+        if not docs:
+            if not upsert:
+                return result, None, None
+            base = upsert_document(filter)
+            new = {**base, **copy.deepcopy(update)} if replace else apply_update(base, update, inserting=True)
+            new.setdefault('_id', base.get('_id', ObjectId()))
+            self._insert(new)
+            result.update(n=1, upserted=new['_id'])
+            return result, None, new
+        before = after = None
+        for doc in docs:
+            if replace:
+                if update.get('_id', doc['_id']) != doc['_id']:
+                    raise OperationFailure(
+                        "After applying the update, the (immutable) field '_id' was found to have been altered", 66
+                    )
+                new = {'_id': doc['_id'], **copy.deepcopy({k: v for k, v in update.items() if k != '_id'})}
+            else:
+                new = apply_update(doc, update)
+            result['n'] += 1
+            if new != doc:
+                self._store(new, old=doc)
+                result['nModified'] += 1
+            if before is None:
+                before, after = doc, new
+        return result, before, after
+
+    async def insert_one(self, document: Dict, **kwargs: Any) -> InsertOneResult:
+        return InsertOneResult(self._insert(document), True)
+
+    async def insert_many(self, documents: Iterable[Dict], ordered: bool = True, **kwargs: Any) -> InsertManyResult:
+        ids, errors = [], []
+        for index, document in enumerate(documents):
+            try:
+                ids.append(self._insert(document))
+            except DuplicateKeyError as error:
+                errors.append({'index': index, 'code': 11000, 'errmsg': str(error), 'op': document})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError(self._bulk_result(nInserted=len(ids), writeErrors=errors))
+        return InsertManyResult(ids, True)
+
+    async def update_one(self, filter: Mapping, update: Mapping, upsert: bool = False, **kwargs: Any) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, upsert, many=False)[0], True)
+
+    async def update_many(self, filter: Mapping, update: Mapping, upsert: bool = False, **kwargs: Any) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, upsert, many=True)[0], True)
+
+    async def replace_one(self, filter: Mapping, replacement: Mapping, upsert: bool = False, **kwargs: Any) -> UpdateResult:
+        return UpdateResult(self._update(filter, replacement, upsert, many=False, replace=True)[0], True)
+
+    async def find_one_and_update(
+        self,
+        filter: Mapping,
+        update: Mapping,
+        projection: Union[None, Mapping, Sequence] = None,
+        sort: Any = None,
+        upsert: bool = False,
+        return_document: bool = ReturnDocument.BEFORE,
+        **kwargs: Any,
+    ) -> Optional[Dict]:
+        _, before, after = self._update(filter, update, upsert, many=False, sort=sort)
+        doc = after if return_document == ReturnDocument.AFTER else before
+        return None if doc is None else project(doc, projection)
+
+    async def find_one_and_replace(
+        self,
+        filter: Mapping,
+        replacement: Mapping,
+        projection: Union[None, Mapping, Sequence] = None,
+        sort: Any = None,
+        upsert: bool = False,
+        return_document: bool = ReturnDocument.BEFORE,
+        **kwargs: Any,
+    ) -> Optional[Dict]:
+        _, before, after = self._update(filter, replacement, upsert, many=False, replace=True, sort=sort)
+        doc = after if return_document == ReturnDocument.AFTER else before
+        return None if doc is None else project(doc, projection)
+
+    async def find_one_and_delete(
+        self, filter: Mapping, projection: Union[None, Mapping, Sequence] = None, sort: Any = None, **kwargs: Any
+    ) -> Optional[Dict]:
+        doc = self._first(filter, sort)
+        if doc is None:
+            return None
+        self._delete(doc)
+        return project(doc, projection)
+
+    async def delete_one(self, filter: Mapping, **kwargs: Any) -> DeleteResult:
+        doc = self._first(filter)
+        if doc is not None:
+            self._delete(doc)
+        return DeleteResult({'n': int(doc is not None), 'ok': 1.0}, True)
+
+    async def delete_many(self, filter: Mapping, **kwargs: Any) -> DeleteResult:
+        docs = self._matching(filter)
+        for doc in docs:
+            self._delete(doc)
+        return DeleteResult({'n': len(docs), 'ok': 1.0}, True)
+
+    @staticmethod
+    def _bulk_result(**values: Any) -> Dict[str, Any]:
+        return {
+            'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0,
+            'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': [], **values,
+        }
+
+    async def bulk_write(self, requests: Sequence[Any], ordered: bool = True, **kwargs: Any) -> BulkWriteResult:
+        result = self._bulk_result()
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self._insert(request._doc)
+                    result['nInserted'] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                    raw, _, _ = self._update(
+                        request._filter, request._doc, request._upsert,
+                        many=isinstance(request, UpdateMany), replace=isinstance(request, ReplaceOne),
+                    )
+                    if 'upserted' in raw:
+                        result['nUpserted'] += 1
+                        result['upserted'].append({'index': index, '_id': raw['upserted']})
+                    else:
+                        result['nMatched'] += raw['n']
+                        result['nModified'] += raw['nModified']
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    docs = self._matching(request._filter)
+                    if isinstance(request, DeleteOne):
+                        docs = docs[:1]
+                    for doc in docs:
+                        self._delete(doc)
+                    result['nRemoved'] += len(docs)
+                else:
+                    raise TypeError(f'{request!r} is not a valid request')
+            except OperationFailure as error:
+                result['writeErrors'].append({
+                    'index': index, 'code': error.code, 'errmsg': str(error),
+                    'op': getattr(request, '_doc', None),
+                })
+                if ordered:
+                    break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    # ____________ Indexes ____________
+
+    async def create_index(
+        self, keys: Union[str, Sequence[Tuple[str, Any]]], name: Optional[str] = None, unique: bool = False, **kwargs: Any
+    ) -> str:
+        keys = [(keys, 1)] if isinstance(keys, str) else [
+            (key, 1) if isinstance(key, str) else tuple(key) for key in keys
+        ]
+        name = name or '_'.join(f'{key}_{direction}' for key, direction in keys)
+        index = MemoryIndex(name, keys, unique)
+        existing = self._indexes.get(name)
+        if existing is not None:
+            if existing.keys != index.keys or existing.unique != index.unique:
+                raise OperationFailure(f'Index with name: {name} already exists with different options', 85)
+            return name
+        if index.is_text and any(other.is_text for other in self._indexes.values()):
+            raise OperationFailure('too many text indexes', 85)
+        for doc in self._documents.values():
+            index.check(doc, doc['_id'], self.full_name)
+            index.add(doc, doc['_id'])
+        self._indexes[name] = index
+        return name
+
+    async def create_indexes(self, indexes: Sequence[IndexModel], **kwargs: Any) -> List[str]:
+        names = []
+        for model in indexes:
+            document = dict(model.document)
+            keys = list(document.pop('key').items())
+            names.append(await self.create_index(keys, **document))
+        return names
+
+    async def drop_index(self, index_or_name: Union[str, Sequence[Tuple[str, Any]]], **kwargs: Any) -> None:
+        name = index_or_name if isinstance(index_or_name, str) else '_'.join(
+            f'{key}_{direction}' for key, direction in index_or_name
+        )
+        if name == '_id_':
+            raise OperationFailure('cannot drop _id index')
+        if name not in self._indexes:
+            raise OperationFailure(f'index not found with name [{name}]', 27)
+        del self._indexes[name]
+
+    async def drop_indexes(self, **kwargs: Any) -> None:
+        self._indexes = {'_id_': self._indexes['_id_']}
+
+    async def index_information(self, **kwargs: Any) -> Dict[str, Dict[str, Any]]:
+        return {name: index.info() for name, index in self._indexes.items()}
+
+    def list_indexes(self, **kwargs: Any) -> MemoryCursor:
+        return MemoryCursor(lambda cursor: [
+            {**index.info(), 'key': SON(index.info()['key']), 'name': name}
+            for name, index in self._indexes.items()
+        ])
+
+    async def drop(self, **kwargs: Any) -> None:
+        await self.database.drop_collection(self.name)
+
+
+class MemoryDatabase:
+
+    def __init__(self, client: 'MemoryClient', name: str) -> None:
+        self.client = client
+        self.name = name
+        self._collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        return self.get_collection(name)
+
+    def get_collection(self, name: str, **kwargs: Any) -> MemoryCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = MemoryCollection(self, name)
+        return collection
+
+    def with_options(self, **kwargs: Any) -> 'MemoryDatabase':
+        return self
+
+    async def list_collection_names(self, **kwargs: Any) -> List[str]:
+        return [name for name, collection in self._collections.items() if collection._documents]
+
+    async def drop_collection(self, name_or_collection: Union[str, MemoryCollection], **kwargs: Any) -> None:
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        collection = self._collections.get(name)
+        if collection is not None:
+            collection.clear()
+
+    def clear(self) -> None:
+        for collection in self._collections.values():
+            collection.clear()
+
+    async def command(self, command: Union[str, Mapping], *args: Any, **kwargs: Any) -> Dict[str, Any]:
+        name = command if isinstance(command, str) else next(iter(command))
+        if name == 'ping':
+            return {'ok': 1.0}
+        raise OperationFailure(f'command {name} is not supported by memory storage')
+
+
+class MemoryClient:
+    '''
+    Stand-in for AsyncIOMotorClient keeping databases in process memory
+    '''
+
+    def __init__(self) -> None:
+        self._databases: Dict[str, MemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        return self.get_database(name)
+
+    def __getattr__(self, name: str) -> MemoryDatabase:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.get_database(name)
+
+    def get_database(self, name: str, **kwargs: Any) -> MemoryDatabase:
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = MemoryDatabase(self, name)
+        return database
+
+    async def list_database_names(self, **kwargs: Any) -> List[str]:
+        return [name for name, database in self._databases.items() if await database.list_collection_names()]
+
+    async def drop_database(self, name_or_database: Union[str, MemoryDatabase], **kwargs: Any) -> None:
+        name = getattr(name_or_database, 'name', name_or_database)
+        database = self._databases.get(name)
+        if database is not None:
+            database.clear()
+
+    async def start_session(self, **kwargs: Any) -> MemorySession:
+        return MemorySession(self)
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryStorage(Storage):
+    '''
+    Keeps all data in process memory, for tests and benchmarks of the app
+    layer. Data is lost on restart and not shared between workers.
+    '''
+
+    def create_client(self) -> MemoryClient:
+        return MemoryClient()
+
+    async def close(self) -> None:
+        # nothing to release, data is kept for the next startup in the same process
+        pass
@@ -0,0 +1,19 @@
+from typing import Any
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from .base import Storage
+
+
+class MongoStorage(Storage):
+    '''
+    MongoDB accessed with Motor, client_options are passed to AsyncIOMotorClient
+    '''
+
+    def __init__(self, url: str, database: str, **client_options: Any) -> None:
+        super().__init__(database)
+        self.url = url
+        self.client_options = client_options
+
+    def create_client(self) -> AsyncIOMotorClient:
+        return AsyncIOMotorClient(self.url, **self.client_options)
@@ -0,0 +1,560 @@
+'''
+Evaluation of MongoDB query, update, projection and aggregation documents
+on plain dicts. Covers the subset of MongoDB used by this application,
+unsupported operators raise OperationFailure instead of being ignored.
+'''
+import copy
+import datetime as dt
+import re
+from functools import cmp_to_key
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Sequence, Tuple, Union
+
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+
+
+class _Missing:
+    def __repr__(self) -> str:
+        return 'MISSING'
+
+
+# value of path absent in document, compared as null like MongoDB does
+MISSING = _Missing()
+
+SortSpec = List[Tuple[str, int]]
+
+
+def get_path(doc: Any, path: str) -> Any:
+    '''
+    Returns value at dotted path, for arrays of embedded documents
+    returns list of values of their fields
+    '''
+    value = doc
+    parts = path.split('.')
+    for i, part in enumerate(parts):
+        if isinstance(value, Mapping):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list):
+            if part.isdigit():
+                index = int(part)
+                value = value[index] if index < len(value) else MISSING
+            else:
+                rest = '.'.join(parts[i:])
+                values = [get_path(item, rest) for item in value if isinstance(item, Mapping)]
+                return [item for item in values if item is not MISSING] or MISSING
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def set_path(doc: Dict, path: str, value: Any) -> None:
+    *parents, last = path.split('.')
+    for part in parents:
+        doc = doc.setdefault(part, {})
+        if not isinstance(doc, dict):
+            raise OperationFailure(f"Cannot create field '{part}' in path '{path}'")
+    doc[last] = value
+
+
+def unset_path(doc: Dict, path: str) -> None:
+    *parents, last = path.split('.')
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+# ______________________ Comparison ______________________
+
+
+def _type_order(value: Any) -> int:
+    '''
+    Order of BSON types in comparisons and sorts
+    '''
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, Mapping):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, (dt.datetime, dt.date)):
+        return 9
+    return 10
+
+
+def compare(a: Any, b: Any) -> int:
+    order_a, order_b = _type_order(a), _type_order(b)
+    if order_a != order_b:
+        return -1 if order_a < order_b else 1
+    if order_a == 1:
+        return 0
+    if order_a == 4:
+        return compare(list(a.items()), list(b.items()))
+    if order_a == 5:
+        for item_a, item_b in zip(a, b):
+            result = compare(item_a, item_b)
+            if result:
+                return result
+        return compare(len(a), len(b))
+    return (a > b) - (a < b)
+
+
+def _equals(value: Any, target: Any) -> bool:
+    if isinstance(value, list) and not isinstance(target, list):
+        return any(_equals(item, target) for item in value)
+    if value is MISSING:
+        return target is None
+    if isinstance(value, list) and isinstance(target, list):
+        return len(value) == len(target) and all(
+            _type_order(a) == _type_order(b) and compare(a, b) == 0 for a, b in zip(value, target)
+        )
+    return _type_order(value) == _type_order(target) and compare(value, target) == 0
+
+
+def _compare_op(check: Callable[[int], bool]) -> Callable[[Any, Any], bool]:
+    def operator(value: Any, target: Any) -> bool:
+        values = value if isinstance(value, list) else [value]
+        return any(
+            _type_order(item) == _type_order(target) and check(compare(item, target))
+            for item in values if item is not MISSING
+        )
+    return operator
+
+
+def _regex(value: Any, pattern: Any, options: str = '') -> bool:
+    flags = 0
+    for option, flag in (('i', re.IGNORECASE), ('m', re.MULTILINE), ('s', re.DOTALL), ('x', re.VERBOSE)):
+        if option in options:
+            flags |= flag
+    if not isinstance(pattern, re.Pattern):
+        pattern = re.compile(pattern, flags)
+    values = value if isinstance(value, list) else [value]
+    return any(isinstance(item, str) and pattern.search(item) for item in values)
+
+
+_QUERY_OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    '$eq': _equals,
+    '$ne': lambda value, target: not _equals(value, target),
+    '$gt': _compare_op(lambda result: result > 0),
+    '$gte': _compare_op(lambda result: result >= 0),
+    '$lt': _compare_op(lambda result: result < 0),
+    '$lte': _compare_op(lambda result: result <= 0),
+    '$in': lambda value, targets: any(_equals(value, target) for target in targets),
+    '$nin': lambda value, targets: not any(_equals(value, target) for target in targets),
+    '$exists': lambda value, exists: (value is not MISSING) == bool(exists),
+    '$size': lambda value, size: isinstance(value, list) and len(value) == size,
+    '$all': lambda value, targets: all(_equals(value, target) for target in targets),
+}
+
+
+def _is_operator_dict(condition: Any) -> bool:
+    return isinstance(condition, Mapping) and bool(condition) and all(
+        key.startswith('$') for key in condition
+    )
+
+
+def _match_condition(value: Any, condition: Any) -> bool:
+    if isinstance(condition, re.Pattern):
+        return _regex(value, condition)
+    if not _is_operator_dict(condition):
+        return _equals(value, condition)
+    for operator, argument in condition.items():
+        if operator == '$regex':
+            if not _regex(value, argument, condition.get('$options', '')):
+                return False
+        elif operator == '$options':
+            continue
+        elif operator == '$not':
+            if _match_condition(value, argument):
+                return False
+        elif operator == '$elemMatch':
+            if not isinstance(value, list) or not any(
+                match(item, argument) if isinstance(item, Mapping) else _match_condition(item, argument)
+                for item in value
+            ):
+                return False
+        elif operator in _QUERY_OPERATORS:
+            if not _QUERY_OPERATORS[operator](value, argument):
+                return False
+        else:
+            raise OperationFailure(f'unknown operator: {operator}')
+    return True
+
+
+def match(doc: Mapping, query: Mapping) -> bool:
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(match(doc, item) for item in condition):
+                return False
+        elif key == '$or':
+            if not any(match(doc, item) for item in condition):
+                return False
+        elif key == '$nor':
+            if any(match(doc, item) for item in condition):
+                return False
+        elif key.startswith('$'):
+            raise OperationFailure(f'{key} is not supported by memory storage')
+        elif not _match_condition(get_path(doc, key), condition):
+            return False
+    return True
+
+
+def equality_value(condition: Any) -> Any:
+    '''
+    Returns value a field is required to be equal to by query condition,
+    MISSING if condition is not a plain equality
+    '''
+    if isinstance(condition, re.Pattern):
+        return MISSING
+    if _is_operator_dict(condition):
+        return condition['$eq'] if set(condition) == {'$eq'} else MISSING
+    return condition
+
+
+# ______________________ Sort and projection ______________________
+
+
+def normalize_sort(sort: Union[None, str, Mapping, Sequence], direction: Any = None) -> SortSpec:
+    if sort is None:
+        return []
+    if isinstance(sort, str):
+        return [(sort, 1 if direction is None else direction)]
+    items = sort.items() if isinstance(sort, Mapping) else sort
+    spec = []
+    for key, value in items:
+        if isinstance(value, Mapping):
+            raise OperationFailure(f'sort by {value} is not supported by memory storage')
+        spec.append((key, value))
+    return spec
+
+
+def sort_documents(docs: Iterable[Dict], sort: SortSpec) -> List[Dict]:
+    def compare_docs(a: Dict, b: Dict) -> int:
+        for key, direction in sort:
+            result = compare(get_path(a, key), get_path(b, key))
+            if result:
+                return result * direction
+        return 0
+    return sorted(docs, key=cmp_to_key(compare_docs))
+
+
+def project(doc: Dict, projection: Union[None, Mapping, Sequence], evaluate: bool = False) -> Dict:
+    '''
+    Returns copy of document with projection applied,
+    computed fields are evaluated when used in aggregation
+    '''
+    if not projection:
+        return copy.deepcopy(doc)
+    if not isinstance(projection, Mapping):
+        projection = {key: 1 for key in projection}
+    fields = {key: value for key, value in projection.items() if key != '_id'}
+    computed = {
+        key: value for key, value in fields.items()
+        if not isinstance(value, (bool, int, float))
+    }
+    if computed and not evaluate:
+        raise OperationFailure('computed projection is supported only in aggregation')
+    included = [key for key, value in fields.items() if key not in computed and value]
+    excluded = [key for key, value in fields.items() if key not in computed and not value]
+    if included and excluded:
+        raise OperationFailure('Cannot do exclusion on field in inclusion projection')
+    include_id = bool(projection.get('_id', 1))
+    # {'_id': 1} alone is an inclusion projection returning only _id
+    if included or computed or (not excluded and '_id' in projection and include_id):
+        result: Dict = {}
+        if include_id and '_id' in doc:
+            result['_id'] = copy.deepcopy(doc['_id'])
+        for key in included:
+            value = get_path(doc, key)
+            if value is not MISSING:
+                set_path(result, key, copy.deepcopy(value))
+        for key, expression in computed.items():
+            set_path(result, key, evaluate_expression(expression, doc))
+        return result
+    result = copy.deepcopy(doc)
+    for key in excluded:
+        unset_path(result, key)
+    if not include_id:
+        result.pop('_id', None)
+    return result
+
+
+# ______________________ Updates ______________________
+
+
+def _inc(doc: Dict, path: str, delta: Any) -> None:
+    value = get_path(doc, path)
+    if value is MISSING or value is None:
+        value = 0
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        raise OperationFailure(f"Cannot apply $inc to a value of non-numeric type at '{path}'")
+    set_path(doc, path, value + delta)
+
+
+def _min_max(keep_new: Callable[[int], bool]) -> Callable[[Dict, str, Any], None]:
+    def operator(doc: Dict, path: str, value: Any) -> None:
+        current = get_path(doc, path)
+        if current is MISSING or keep_new(compare(value, current)):
+            set_path(doc, path, copy.deepcopy(value))
+    return operator
+
+
+def _push(doc: Dict, path: str, value: Any) -> None:
+    current = get_path(doc, path)
+    items = value['$each'] if isinstance(value, Mapping) and '$each' in value else [value]
+    if current is MISSING:
+        current = []
+        set_path(doc, path, current)
+    current.extend(copy.deepcopy(items))
+
+
+def _pull(doc: Dict, path: str, condition: Any) -> None:
+    current = get_path(doc, path)
+    if isinstance(current, list):
+        current[:] = [
+            item for item in current
+            if not (match(item, condition) if isinstance(item, Mapping) and isinstance(condition, Mapping)
+                    and not _is_operator_dict(condition) else _match_condition(item, condition))
+        ]
+
+
+_UPDATE_OPERATORS: Dict[str, Callable[[Dict, str, Any], None]] = {
+    '$set': lambda doc, path, value: set_path(doc, path, copy.deepcopy(value)),
+    '$unset': lambda doc, path, value: unset_path(doc, path),
+    '$inc': _inc,
+    '$min': _min_max(lambda result: result < 0),
+    '$max': _min_max(lambda result: result > 0),
+    '$push': _push,
+    '$pull': _pull,
+}
+
+
+def is_update_document(update: Mapping) -> bool:
+    return bool(update) and all(key.startswith('$') for key in update)
+
+
+def apply_update(doc: Dict, update: Mapping, inserting: bool = False) -> Dict:
+    '''
+    Returns updated copy of document
+    '''
+    if not is_update_document(update):
+        raise ValueError('update only works with $ operators')
+    result = copy.deepcopy(doc)
+    for operator, fields in update.items():
+        if operator == '$setOnInsert':
+            if inserting:
+                for path, value in fields.items():
+                    set_path(result, path, copy.deepcopy(value))
+            continue
+        apply = _UPDATE_OPERATORS.get(operator)
+        if apply is None:
+            raise OperationFailure(f'{operator} is not supported by memory storage')
+        for path, value in fields.items():
+            if path == '_id' and (operator != '$set' or value != doc.get('_id', value)):
+                raise OperationFailure("Performing an update on the path '_id' would modify the immutable field '_id'", 66)
+            apply(result, path, value)
+    return result
+
+
+def upsert_document(query: Mapping) -> Dict:
+    '''
+    Returns document inserted by upsert before update is applied to it,
+    made of equality conditions of query
+    '''
+    doc: Dict = {}
+    for key, condition in query.items():
+        if key == '$and':
+            for item in condition:
+                doc.update(upsert_document(item))
+        elif not key.startswith('$'):
+            value = equality_value(condition)
+            if value is not MISSING:
+                set_path(doc, key, copy.deepcopy(value))
+    return doc
+
+
+# ______________________ Aggregation ______________________
+
+
+def _expression_operator(name: str, argument: Any, doc: Mapping) -> Any:
+    if name == '$literal':
+        return argument
+    args = evaluate_expression(argument, doc)
+    if name == '$indexOfArray':
+        array, item = args[0], args[1]
+        if array is None:
+            return None
+        for index, value in enumerate(array):
+            if _equals(value, item):
+                return index
+        return -1
+    if name in ('$add', '$sum'):
+        values = args if isinstance(args, list) else [args]
+        return sum(value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool))
+    if name == '$subtract':
+        return args[0] - args[1]
+    if name == '$multiply':
+        result = 1
+        for value in args:
+            result *= value
+        return result
+    if name == '$ifNull':
+        return next((value for value in args if value is not None), None)
+    if name == '$size':
+        return len(args)
+    if name == '$eq':
+        return _equals(args[0], args[1])
+    if name == '$toString':
+        return None if args is None else str(args)
+    raise OperationFailure(f'{name} is not supported by memory storage')
+
+
+def evaluate_expression(expression: Any, doc: Mapping) -> Any:
+    if isinstance(expression, str) and expression.startswith('$'):
+        value = get_path(doc, expression[1:])
+        return None if value is MISSING else copy.deepcopy(value)
+    if isinstance(expression, Mapping):
+        if len(expression) == 1:
+            (key, argument), = expression.items()
+            if key.startswith('$'):
+                return _expression_operator(key, argument, doc)
+        return {key: evaluate_expression(value, doc) for key, value in expression.items()}
+    if isinstance(expression, list):
+        return [evaluate_expression(item, doc) for item in expression]
+    return expression
+
+
+def _freeze(value: Any) -> Any:
+    '''
+    Hashable representation of value, used as group key
+    '''
+    if isinstance(value, Mapping):
+        return ('__doc__', tuple((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return ('__list__', tuple(_freeze(item) for item in value))
+    return value
+
+
+class _Accumulator:
+    def __init__(self, operator: str, expression: Any) -> None:
+        self.operator = operator
+        self.expression = expression
+        self.values: List[Any] = []
+
+    def add(self, doc: Mapping) -> None:
+        self.values.append(evaluate_expression(self.expression, doc))
+
+    def result(self) -> Any:
+        values = self.values
+        numbers = [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+        present = [value for value in values if value is not None]
+        if self.operator == '$sum':
+            return sum(numbers)
+        if self.operator == '$count':
+            return len(values)
+        if self.operator == '$avg':
+            return sum(numbers) / len(numbers) if numbers else None
+        if self.operator == '$min':
+            return min(present, key=cmp_to_key(compare)) if present else None
+        if self.operator == '$max':
+            return max(present, key=cmp_to_key(compare)) if present else None
+        if self.operator == '$first':
+            return values[0] if values else None
+        if self.operator == '$last':
+            return values[-1] if values else None
+        if self.operator == '$push':
+            return values
+        if self.operator == '$addToSet':
+            unique: Dict[Any, Any] = {}
+            for value in values:
+                unique.setdefault(_freeze(value), value)
+            return list(unique.values())
+        raise OperationFailure(f'{self.operator} is not supported by memory storage')
+
+
+def _group(docs: List[Dict], spec: Mapping) -> List[Dict]:
+    groups: Dict[Any, Tuple[Any, Dict[str, _Accumulator]]] = {}
+    for doc in docs:
+        key = evaluate_expression(spec['_id'], doc)
+        frozen = _freeze(key)
+        if frozen not in groups:
+            groups[frozen] = (key, {
+                field: _Accumulator(*next(iter(accumulator.items())))
+                for field, accumulator in spec.items() if field != '_id'
+            })
+        for accumulator in groups[frozen][1].values():
+            accumulator.add(doc)
+    return [
+        {'_id': key, **{field: accumulator.result() for field, accumulator in accumulators.items()}}
+        for key, accumulators in groups.values()
+    ]
+
+
+def _add_fields(docs: List[Dict], spec: Mapping) -> List[Dict]:
+    result = []
+    for doc in docs:
+        doc = copy.deepcopy(doc)
+        for key, expression in spec.items():
+            set_path(doc, key, evaluate_expression(expression, doc))
+        result.append(doc)
+    return result
+
+
+def _unwind(docs: List[Dict], spec: Union[str, Mapping]) -> List[Dict]:
+    path = (spec if isinstance(spec, str) else spec['path'])[1:]
+    result = []
+    for doc in docs:
+        values = get_path(doc, path)
+        if not isinstance(values, list):
+            if values is not MISSING and values is not None:
+                result.append(doc)
+            continue
+        for value in values:
+            item = copy.deepcopy(doc)
+            set_path(item, path, value)
+            result.append(item)
+    return result
+
+
+_STAGES: Dict[str, Callable[[List[Dict], Any], List[Dict]]] = {
+    '$match': lambda docs, query: [doc for doc in docs if match(doc, query)],
+    '$sort': lambda docs, sort: sort_documents(docs, normalize_sort(sort)),
+    '$skip': lambda docs, skip: docs[skip:],
+    '$limit': lambda docs, limit: docs[:limit],
+    '$project': lambda docs, projection: [project(doc, projection, evaluate=True) for doc in docs],
+    '$addFields': _add_fields,
+    '$set': _add_fields,
+    '$unset': lambda docs, fields: [
+        project(doc, {field: 0 for field in ([fields] if isinstance(fields, str) else fields)})
+        for doc in docs
+    ],
+    '$count': lambda docs, field: [{field: len(docs)}] if docs else [],
+    '$group': _group,
+    '$unwind': _unwind,
+    '$facet': lambda docs, facets: [
+        {name: aggregate(docs, pipeline) for name, pipeline in facets.items()}
+    ],
+}
+
+
+def aggregate(docs: List[Dict], pipeline: Sequence[Mapping]) -> List[Dict]:
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        run = _STAGES.get(name)
+        if run is None:
+            raise OperationFailure(f'{name} stage is not supported by memory storage')
+        docs = run(docs, spec)
+    return docs
@@ -1,18 +1,33 @@
 import asyncio
+import datetime as dt
+import json
 import os
 from typing import List
 from unittest import TestCase
+from unittest.mock import patch
 from fastapi.testclient import TestClient
 from fastapi_jwt_auth import AuthJWT
+from odmantic.bson import ObjectId
+from pymongo.errors import ServerSelectionTimeoutError
 
 # hack to use 
 os.environ['DATABASE'] = 'test'
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ['SEARCH_BACKEND'] = 'memory'
 
-from server.settings import engine
-from server.main import app
+from server.settings import engine, storage
+from server.main import app, setup_indexes
 from server.models.user import User, UserInfo
-from server.models.post import Post, Like
+from server.models.post import Post, Like, today
 from server.utils.security import create_tokens, JwtTokenPair
+from server.utils.activity import request_time_buffer
+from server.routers.dependencies import get_engine, user_cache
+from server.storage import MemoryStorage
+from server.utils.search import search_backend
+from server.scripts.rebuild_like_counters import rebuild_like_counters
+from server.scripts.migrate_likes import migrate_likes
+from server.models.analytics import LikeCounter, count_like, like_counts_cache
+from server.utils.slow_queries import slow_query_log
 
 
 loop = asyncio.get_event_loop()
@@ -21,15 +36,23 @@ async def create_user(email : str = 'test@mail.com', username : str = 'test', pa
     user = User(email=email, username=username, password=password)
     user.set_password(password)
     user = await engine.save(user)
+    search_backend.index_object(user)
     return user
 
 
-async def create_post(owner: User, title: str = 'post', text: str = 'some text', likes: List[Like] = []):
-    post = Post(owner=owner.id, title=title, text=text, likes=likes)
+async def create_post(owner: User, title: str = 'post', text: str = 'some text', likers: List[User] = []):
+    post = Post(owner=owner.id, title=title, text=text, like_count=len(likers))
     post = await engine.save(post)
+    for user in likers:
+        await engine.save(Like(post=post.id, user_id=user.id, date=today()))
+    search_backend.index_object(post)
     return post
 
 
+async def count_post_likes(post: Post) -> int:
+    return await engine.count(Like, Like.post == post.id)
+
+
 def login_user(client: TestClient, user: User) -> JwtTokenPair:
     tokens = create_tokens(AuthJWT(), str(user.id), is_admin=user.super_user)
     client.headers['Authorization'] = f'Bearer {tokens.access_token}'
@@ -39,18 +62,36 @@ def login_user(client: TestClient, user: User) -> JwtTokenPair:
 class UserRouterTest(TestCase):
 
     def setUp(self) -> None:
+        loop.run_until_complete(setup_indexes())
         self.user = loop.run_until_complete(create_user())
         self.dummy_user1 = loop.run_until_complete(create_user('dummy1@test.com', 'dummy1'))
         self.client = TestClient(app)
 
     def tearDown(self) -> None:
-        engine.client.drop_database('test')
+        loop.run_until_complete(engine.client.drop_database('test'))
+        search_backend.clear()
 
     def test_ping_200_ok(self) -> None:
         response = self.client.get('/ping')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), 'pong')
 
+    def test_ready_checks_database(self) -> None:
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        with patch.object(type(storage), 'ping', side_effect=ServerSelectionTimeoutError('down')):
+            response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 503)
+
+    def test_metrics_by_route_template(self) -> None:
+        login_user(self.client, self.user)
+        self.client.get(f'/api/users/{self.dummy_user1.username}')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('method="GET",route="/api/users/{username}",status="200"', response.text)
+        self.assertIn('db_operation_duration_seconds_count{', response.text)
+        self.assertNotIn(self.dummy_user1.username + '"', response.text)
+
     def test_register_200_ok(self) -> None:
         user_data = {
             'email': 'test2@mail.com',
@@ -142,6 +183,51 @@ class UserRouterTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()['count'], 2)
         
+    def test_list_users_cursor_pagination_over_null_values(self):
+        for number in range(3):
+            loop.run_until_complete(create_user(f'dummy{number + 2}@test.com', f'dummy{number + 2}'))
+        for user in loop.run_until_complete(engine.find(User, User.username.in_(['dummy1', 'dummy3']))):
+            user.last_login = dt.datetime(2021, 1, int(user.username[-1]))
+            loop.run_until_complete(engine.save(user))
+        login_user(self.client, self.user)
+        for sort in ('last_login', '-last_login'):
+            usernames = []
+            params = {'limit': 2, 'cursor': '', 'sort': sort, 'fields': 'username'}
+            while True:
+                resp_data = self.client.get('/api/users/', params=params).json()
+                usernames += [user['username'] for user in resp_data['users']]
+                self.assertTrue(all(set(user) == {'id', 'username'} for user in resp_data['users']))
+                if resp_data['next_cursor'] is None:
+                    break
+                params['cursor'] = resp_data['next_cursor']
+            self.assertEqual(len(usernames), 5)
+            dated = ['dummy1', 'dummy3'] if sort == 'last_login' else ['dummy3', 'dummy1']
+            self.assertEqual(usernames[3:] if sort == 'last_login' else usernames[:2], dated)
+
+    def test_list_users_hides_password(self):
+        login_user(self.client, self.user)
+        response = self.client.get('/api/users/')
+        for user in response.json()['users']:
+            self.assertNotIn('password', user)
+        default_keys = set(response.json()['users'][0])
+        for fields in ('', ' '):
+            response = self.client.get('/api/users/', params={'fields': fields})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual({key for user in response.json()['users'] for key in user}, default_keys)
+        response = self.client.get('/api/users/', params={'fields': 'id'})
+        self.assertEqual(response.status_code, 200)
+        for user in response.json()['users']:
+            self.assertEqual(set(user), {'id'})
+        response = self.client.get('/api/users/', params={'fields': 'username,password'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_user_by_username_selected_fields(self):
+        login_user(self.client, self.user)
+        response = self.client.get(
+            f'/api/users/{self.user.username}', params={'fields': 'email'}
+        )
+        self.assertEqual(response.json(), {'id': str(self.user.id), 'email': self.user.email})
+
     def test_get_user_by_username_200_ok(self):
         login_user(self.client, self.user)
         response = self.client.get(
@@ -150,6 +236,26 @@ class UserRouterTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()['id'], str(self.user.id))
         
+    def test_get_user_by_username_304_not_modified(self):
+        login_user(self.client, self.user)
+        url = f'/api/users/{self.dummy_user1.username}'
+        etag = self.client.get(url).headers['ETag']
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        response = self.client.get(url, params={'fields': 'email'}, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('version', response.json())
+
+    def test_login_changes_user_etag(self):
+        url = f'/api/users/{self.user.username}'
+        login_user(self.client, self.user)
+        etag = self.client.get(url).headers['ETag']
+        self.client.post('/api/users/login', json={'email': self.user.email, 'password': 'test'})
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
     def test_get_user_by_username_404_not_found(self):
         login_user(self.client, self.user)
         response = self.client.get(
@@ -181,20 +287,34 @@ class UserRouterTest(TestCase):
             engine.find_one(User, User.id == self.user.id)
         )
         self.assertEqual(user.deleted, True)
+        self.assertIsNone(user_cache.get(str(self.user.id)))
+
+    def test_request_time_written_on_flush(self):
+        login_user(self.client, self.user)
+        self.client.get('/api/users/')
+        self.assertIsNotNone(request_time_buffer.get(self.user.id))
+        loop.run_until_complete(request_time_buffer.flush())
+        user = loop.run_until_complete(
+            engine.find_one(User, User.id == self.user.id)
+        )
+        self.assertIsNone(request_time_buffer.get(self.user.id))
+        self.assertIsNotNone(user.last_request)
 
 
 class PostRouterTest(TestCase):
 
     def setUp(self) -> None:
+        loop.run_until_complete(setup_indexes())
         self.user = loop.run_until_complete(create_user())
         self.post1 = loop.run_until_complete(create_post(self.user, 'post1'))
         self.post2 = loop.run_until_complete(
-            create_post(self.user, 'post2', likes=[Like(user_id=self.user.id)])
+            create_post(self.user, 'post2', likers=[self.user])
         )
         self.client = TestClient(app)
 
     def tearDown(self) -> None:
-        engine.client.drop_database('test')
+        loop.run_until_complete(engine.client.drop_database('test'))
+        search_backend.clear()
 
     def test_list_posts_200_ok(self):
         login_user(self.client, self.user)
@@ -204,6 +324,69 @@ class PostRouterTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()['count'], 2)
 
+    def test_list_posts_count_respects_search(self):
+        login_user(self.client, self.user)
+        response = self.client.get('/api/posts/', params={'q': 'post1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(len(response.json()['posts']), 1)
+
+    def test_list_posts_search_ordered_by_relevance(self):
+        loop.run_until_complete(create_post(self.user, 'post3 about cats, cats and cats'))
+        loop.run_until_complete(create_post(self.user, 'post4 about cats'))
+        login_user(self.client, self.user)
+        response = self.client.get('/api/posts/', params={'q': 'cats'})
+        self.assertEqual(response.status_code, 200)
+        titles = [post['title'] for post in response.json()['posts']]
+        self.assertEqual(titles, ['post3 about cats, cats and cats', 'post4 about cats'])
+        self.assertEqual(response.json()['count'], 2)
+
+    def test_list_posts_search_removed_post(self):
+        login_user(self.client, self.user)
+        self.client.delete(f'/api/posts/{self.post1.id}')
+        response = self.client.get('/api/posts/', params={'q': 'post1'})
+        self.assertEqual(response.json()['count'], 0)
+
+    def test_list_posts_estimated_count(self):
+        login_user(self.client, self.user)
+        response = self.client.get('/api/posts/', params={'count_mode': 'estimated'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['posts']), 2)
+        self.assertIsInstance(response.json()['count'], int)
+
+    def test_list_posts_cursor_pagination(self):
+        login_user(self.client, self.user)
+        titles = []
+        params = {'limit': 1, 'cursor': '', 'sort': '-title'}
+        for _ in range(3):
+            response = self.client.get('/api/posts/', params=params)
+            self.assertEqual(response.status_code, 200)
+            resp_data = response.json()
+            titles += [post['title'] for post in resp_data['posts']]
+            if resp_data['next_cursor'] is None:
+                break
+            params['cursor'] = resp_data['next_cursor']
+        self.assertEqual(titles, ['post2', 'post1'])
+
+    def test_list_posts_cursor_sort_key_not_returned(self):
+        login_user(self.client, self.user)
+        response = self.client.get('/api/posts/', params={'fields': 'title', 'sort': 'text', 'cursor': ''})
+        self.assertEqual(response.status_code, 200)
+        for post in response.json()['posts']:
+            self.assertEqual(set(post), {'id', 'title'})
+
+    def test_list_posts_400_invalid_cursor(self):
+        login_user(self.client, self.user)
+        response = self.client.get('/api/posts/', params={'cursor': 'broken'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_posts_selected_fields(self):
+        login_user(self.client, self.user)
+        response = self.client.get('/api/posts/')
+        self.assertNotIn('text', response.json()['posts'][0])
+        response = self.client.get('/api/posts/', params={'fields': 'title,text'})
+        self.assertEqual(set(response.json()['posts'][0]), {'id', 'title', 'text'})
+
     def test_list_posts_403_not_authorized(self):
         response = self.client.get(
             '/api/posts/'
@@ -279,6 +462,44 @@ class PostRouterTest(TestCase):
         self.assertEqual(resp_data['title'], update_data['title'])
         self.assertEqual(resp_data['id'], str(self.post1.id))
 
+    def test_update_post_keeps_like_count(self):
+        login_user(self.client, self.user)
+        response = self.client.put(
+            f'/api/posts/{self.post2.id}',
+            json = {'text': 'new text'},
+        )
+        self.assertEqual(response.json()['like_count'], 1)
+        self.assertEqual(response.json()['title'], 'post2')
+
+    def test_update_post_404_not_found(self):
+        login_user(self.client, self.user)
+        response = self.client.put(
+            f'/api/posts/{ObjectId()}',
+            json = {'title': 'new title'},
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_post_304_until_liked(self):
+        login_user(self.client, self.user)
+        url = f'/api/posts/{self.post1.id}'
+        etag = self.client.get(url).headers['ETag']
+        response = self.client.get(url, headers={'If-None-Match': f'"other", W/{etag}'})
+        self.assertEqual(response.status_code, 304)
+        self.client.post(f'{url}/like')
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['like_count'], 1)
+        self.assertEqual(response.json()['version'], 1)
+
+    def test_list_posts_304_not_modified(self):
+        login_user(self.client, self.user)
+        etag = self.client.get('/api/posts/').headers['ETag']
+        response = self.client.get('/api/posts/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.client.put(f'/api/posts/{self.post1.id}', json={'title': 'new title'})
+        response = self.client.get('/api/posts/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
     def test_update_post_403_not_authorized(self):
         update_data = {
             'title': 'new title',
@@ -314,6 +535,20 @@ class PostRouterTest(TestCase):
         self.assertEqual(response.status_code, 204)
         self.assertEqual(post, None)
         
+    def test_delete_post_loads_post_and_user_once(self):
+        login_user(self.client, self.user)
+        user_cache.clear()
+        operations = []
+        storage.add_listener(operations.append)
+        try:
+            response = self.client.delete(f'/api/posts/{self.post1.id}')
+        finally:
+            storage.listeners.remove(operations.append)
+        self.assertEqual(response.status_code, 204)
+        reads = [op.collection for op in operations if op.name in ('find', 'find_one', 'aggregate')]
+        self.assertEqual(reads.count('post'), 1)
+        self.assertEqual(reads.count('user'), 1)
+
     def test_delete_post_403_no_permission(self):
         user = loop.run_until_complete(create_user('noname@mail.com', 'noname'))
         login_user(self.client, user)
@@ -322,6 +557,24 @@ class PostRouterTest(TestCase):
         )
         self.assertEqual(response.status_code, 403)
 
+    def test_like_post_writes_through_overridden_engine(self):
+        other_engine = MemoryStorage('other').engine
+        user = loop.run_until_complete(other_engine.save(User(email='o@mail.com', username='o', password='o')))
+        post = loop.run_until_complete(other_engine.save(Post(owner=user.id, title='other', text='text')))
+        login_user(self.client, user)
+        app.dependency_overrides[get_engine] = lambda: other_engine
+        try:
+            response = self.client.post(f'/api/posts/{post.id}/like')
+        finally:
+            del app.dependency_overrides[get_engine]
+        self.assertEqual(response.status_code, 200)
+        counter = loop.run_until_complete(other_engine.find_one(LikeCounter))
+        self.assertEqual(counter.count, 1)
+        self.assertIsNone(loop.run_until_complete(engine.find_one(LikeCounter)))
+        loop.run_until_complete(request_time_buffer.flush())
+        user = loop.run_until_complete(other_engine.find_one(User, User.id == user.id))
+        self.assertIsNotNone(user.last_request)
+
     def test_like_post_200_ok(self):
         login_user(self.client, self.user)
         response = self.client.post(
@@ -331,7 +584,8 @@ class PostRouterTest(TestCase):
             engine.find_one(Post, Post.id == self.post1.id)
         )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(post.likes), 1)
+        self.assertEqual(post.like_count, 1)
+        self.assertEqual(loop.run_until_complete(count_post_likes(post)), 1)
 
     def test_like_post_twice_400_bad_request(self):
         login_user(self.client, self.user)
@@ -342,7 +596,8 @@ class PostRouterTest(TestCase):
             engine.find_one(Post, Post.id == self.post2.id)
         )
         self.assertEqual(response.status_code, 400)
-        self.assertEqual(len(post.likes), 1)
+        self.assertEqual(post.like_count, 1)
+        self.assertEqual(loop.run_until_complete(count_post_likes(post)), 1)
 
     def test_post_unlike_200_ok(self):
         login_user(self.client, self.user)
@@ -353,7 +608,8 @@ class PostRouterTest(TestCase):
             engine.find_one(Post, Post.id == self.post2.id)
         )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(post.likes), 0)
+        self.assertEqual(post.like_count, 0)
+        self.assertEqual(loop.run_until_complete(count_post_likes(post)), 0)
 
     def test_post_unlike_not_liked_post_400_bad_request(self):
         login_user(self.client, self.user)
@@ -364,4 +620,249 @@ class PostRouterTest(TestCase):
             engine.find_one(Post, Post.id == self.post1.id)
         )
         self.assertEqual(response.status_code, 400)
-        self.assertEqual(len(post.likes), 0)
+        self.assertEqual(post.like_count, 0)
+        self.assertEqual(loop.run_until_complete(count_post_likes(post)), 0)
+
+    def test_like_post_404_not_found(self):
+        login_user(self.client, self.user)
+        response = self.client.post(
+            f'/api/posts/{ObjectId()}/like'
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_like_post_returns_only_change(self):
+        login_user(self.client, self.user)
+        response = self.client.post(
+            f'/api/posts/{self.post1.id}/like'
+        )
+        resp_data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(resp_data['post_id'], str(self.post1.id))
+        self.assertEqual(resp_data['liked'], True)
+        self.assertEqual(resp_data['like']['user_id'], str(self.user.id))
+        self.assertEqual(resp_data['like_count'], 1)
+
+    def test_list_post_likes_200_ok(self):
+        login_user(self.client, self.user)
+        response = self.client.get(
+            f'/api/posts/{self.post2.id}/likes'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(response.json()['likes'][0]['user_id'], str(self.user.id))
+
+    def test_get_post_by_id_returns_like_count(self):
+        login_user(self.client, self.user)
+        response = self.client.get(
+            f'/api/posts/{self.post2.id}'
+        )
+        self.assertEqual(response.json()['like_count'], 1)
+        self.assertNotIn('likes', response.json())
+
+    def test_migrate_likes(self):
+        collection = engine.get_collection(Post)
+        loop.run_until_complete(collection.update_one(
+            {'_id': self.post1.id},
+            {'$set': {'likes': [{'user_id': self.user.id, 'date': today()}]},
+             '$unset': {'like_count': ''}},
+        ))
+        loop.run_until_complete(migrate_likes())
+        loop.run_until_complete(migrate_likes())
+        post = loop.run_until_complete(collection.find_one({'_id': self.post1.id}))
+        self.assertEqual(post['like_count'], 1)
+        self.assertNotIn('likes', post)
+        self.assertEqual(loop.run_until_complete(count_post_likes(self.post1)), 1)
+
+    def test_delete_post_deletes_likes(self):
+        login_user(self.client, self.user)
+        self.client.delete(f'/api/posts/{self.post2.id}')
+        self.assertEqual(loop.run_until_complete(count_post_likes(self.post2)), 0)
+
+    def test_bulk_create_posts_reports_each_item(self):
+        login_user(self.client, self.user)
+        response = self.client.post('/api/posts/bulk', json=[
+            {'title': 'bulk1', 'text': 'text'},
+            {'title': 'bulk2'},
+            {'title': 'bulk3', 'text': 'text'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 2)
+        statuses = [result['status'] for result in response.json()['results']]
+        self.assertEqual(statuses, [201, 422, 201])
+        response = self.client.get('/api/posts/', params={'q': 'bulk3'})
+        self.assertEqual(response.json()['count'], 1)
+
+    def test_bulk_create_too_many_items_400_bad_request(self):
+        login_user(self.client, self.user)
+        with patch('server.routers.posts.BULK_MAX_ITEMS', 1):
+            response = self.client.post('/api/posts/bulk', json=[
+                {'title': 'bulk1', 'text': 'text'},
+                {'title': 'bulk2', 'text': 'text'},
+            ])
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_like_posts_reports_each_item(self):
+        login_user(self.client, self.user)
+        response = self.client.post('/api/posts/likes/bulk', json=[
+            {'post_id': str(self.post1.id)},
+            {'post_id': str(self.post2.id)},
+            {'post_id': str(ObjectId())},
+            {'post_id': 'wrong'},
+            {'post_id': str(self.post1.id)},
+        ])
+        self.assertEqual(response.json()['created'], 1)
+        statuses = [result['status'] for result in response.json()['results']]
+        self.assertEqual(statuses, [201, 400, 404, 422, 400])
+        response = self.client.get(f'/api/posts/{self.post1.id}')
+        self.assertEqual(response.json()['like_count'], 1)
+        self.assertEqual(loop.run_until_complete(count_post_likes(self.post1)), 1)
+
+
+class AnalyticsRouterTest(TestCase):
+
+    def setUp(self) -> None:
+        loop.run_until_complete(setup_indexes())
+        self.admin = loop.run_until_complete(create_user('admin@mail.com', 'admin'))
+        self.admin.super_user = True
+        loop.run_until_complete(engine.save(self.admin))
+        self.post = loop.run_until_complete(create_post(self.admin))
+        self.client = TestClient(app)
+
+    def tearDown(self) -> None:
+        loop.run_until_complete(engine.client.drop_database('test'))
+        search_backend.clear()
+        like_counts_cache.clear()
+
+    def test_get_likes_counts_like_and_unlike(self):
+        login_user(self.client, self.admin)
+        self.client.post(f'/api/posts/{self.post.id}/like')
+        response = self.client.get('/api/analytic/likes')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([day['count'] for day in response.json()], [1])
+        self.client.post(f'/api/posts/{self.post.id}/unlike')
+        response = self.client.get('/api/analytic/likes')
+        self.assertEqual(response.json(), [])
+
+    def test_get_likes_cached_until_like(self):
+        login_user(self.client, self.admin)
+        response = self.client.get('/api/analytic/likes')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        response = self.client.get('/api/analytic/likes')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.client.post(f'/api/posts/{self.post.id}/like')
+        response = self.client.get('/api/analytic/likes')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual([day['count'] for day in response.json()], [1])
+
+    def test_get_likes_date_range(self):
+        login_user(self.client, self.admin)
+        self.client.post(f'/api/posts/{self.post.id}/like')
+        response = self.client.get(
+            '/api/analytic/likes', params={'date_to': '2000-01-01'}
+        )
+        self.assertEqual(response.json(), [])
+
+    def test_rebuild_like_counters(self):
+        loop.run_until_complete(create_post(self.admin, likers=[self.admin]))
+        loop.run_until_complete(rebuild_like_counters())
+        login_user(self.client, self.admin)
+        response = self.client.get('/api/analytic/likes')
+        self.assertEqual([day['count'] for day in response.json()], [1])
+
+    def test_rebuild_like_counters_overwrites_existing(self):
+        loop.run_until_complete(create_post(self.admin, likers=[self.admin]))
+        old_day = today() - dt.timedelta(days=3)
+        loop.run_until_complete(count_like(engine, today(), 5))
+        loop.run_until_complete(count_like(engine, old_day, 2))
+        loop.run_until_complete(rebuild_like_counters())
+        counters = loop.run_until_complete(engine.find(LikeCounter))
+        self.assertEqual([(counter.date, counter.count) for counter in counters], [(today(), 1)])
+
+    def test_slow_queries_grouped_by_shape(self):
+        explained = []
+
+        async def explain(command):
+            explained.append(command)
+            return {'queryPlanner': {'winningPlan': {'stage': 'IXSCAN'}}, 'ok': 1.0}
+
+        login_user(self.client, self.admin)
+        with patch.object(slow_query_log, 'threshold', 0), patch.object(slow_query_log, 'explain', explain):
+            for username in ('admin', 'nobody'):
+                self.client.get(f'/api/users/{username}')
+        response = self.client.get('/api/analytic/slow-queries', params={'limit': 100})
+        slow_query_log.clear()
+        self.assertEqual(response.status_code, 200)
+        shapes = [
+            item for item in response.json()
+            if item['collection'] == 'user' and item['operation'] == 'find_one' and 'username' in item['shape']
+        ]
+        self.assertEqual(len(shapes), 1)
+        self.assertEqual(shapes[0]['shape'], {'username': '?'})
+        self.assertEqual(shapes[0]['count'], 2)
+        self.assertEqual(shapes[0]['routes'], {'GET /api/users/{username}': 2})
+        self.assertEqual(shapes[0]['plan'], {'queryPlanner': {'winningPlan': {'stage': 'IXSCAN'}}})
+        self.assertEqual(len([c for c in explained if c['explain'].get('filter') == {'username': 'admin'}]), 1)
+
+    def test_get_likes_403_not_admin(self):
+        user = loop.run_until_complete(create_user())
+        login_user(self.client, user)
+        response = self.client.get('/api/analytic/likes')
+        self.assertEqual(response.status_code, 403)
+
+
+class ExportRouterTest(TestCase):
+
+    def setUp(self) -> None:
+        loop.run_until_complete(setup_indexes())
+        self.admin = loop.run_until_complete(create_user('admin@mail.com', 'admin'))
+        self.admin.super_user = True
+        loop.run_until_complete(engine.save(self.admin))
+        self.client = TestClient(app)
+
+    def tearDown(self) -> None:
+        loop.run_until_complete(engine.client.drop_database('test'))
+        search_backend.clear()
+
+    def read_lines(self, response) -> List[dict]:
+        return [json.loads(line) for line in response.text.splitlines()]
+
+    def test_export_posts(self):
+        for i in range(3):
+            loop.run_until_complete(create_post(self.admin, title=f'post {i}', likers=[self.admin]))
+        login_user(self.client, self.admin)
+        response = self.client.get('/api/export/posts')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('application/x-ndjson'))
+        posts = self.read_lines(response)
+        self.assertEqual([post['title'] for post in posts], ['post 0', 'post 1', 'post 2'])
+        self.assertEqual(posts[0]['owner'], str(self.admin.id))
+
+    def test_export_users_without_password(self):
+        login_user(self.client, self.admin)
+        response = self.client.get('/api/export/users')
+        users = self.read_lines(response)
+        self.assertEqual([user['username'] for user in users], ['admin'])
+        self.assertNotIn('password', users[0])
+
+    def test_export_likes_date_filter(self):
+        loop.run_until_complete(create_post(self.admin, likers=[self.admin]))
+        login_user(self.client, self.admin)
+        response = self.client.get('/api/export/likes')
+        self.assertEqual(len(self.read_lines(response)), 1)
+        response = self.client.get('/api/export/likes', params={'date_to': '2000-01-01'})
+        self.assertEqual(self.read_lines(response), [])
+
+    def test_export_posts_includes_whole_date_to_day(self):
+        for day, title in ((1, 'noon'), (2, 'next day')):
+            post = loop.run_until_complete(create_post(self.admin, title=title))
+            post.created_at = dt.datetime(2021, 3, day, 12)
+            loop.run_until_complete(engine.save(post))
+        login_user(self.client, self.admin)
+        response = self.client.get('/api/export/posts', params={'date_from': '2021-03-01', 'date_to': '2021-03-01'})
+        self.assertEqual([post['title'] for post in self.read_lines(response)], ['noon'])
+
+    def test_export_403_not_admin(self):
+        user = loop.run_until_complete(create_user())
+        login_user(self.client, user)
+        response = self.client.get('/api/export/posts')
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,344 @@
+import asyncio
+import datetime as dt
+import json
+import os
+import threading
+import time
+from unittest import TestCase
+
+os.environ['DATABASE'] = 'test'
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+from server.settings import engine
+from server.models.indexes import drop_index_if_exists, ensure_indexes
+from server.models.post import Like, LikeStatus, Post
+from server.models.user import User
+from odmantic.bson import ObjectId
+from pymongo import ReadPreference, ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, ServerSelectionTimeoutError
+from server.serve import server_options, usable_cpu_count
+from server.storage import MemoryStorage, MongoStorage, Operation
+from server.storage.query import project
+from server.utils.activity import RequestTimeBuffer
+from server.utils.cache import SingleFlight, TTLCache
+from server.utils.metrics import Histogram
+from server.utils.slow_queries import explain_command, query_shape
+from server.utils.responses import dumps, model_response
+from server.utils.security import PasswordHasher, PasswordHasherBusy
+
+
+loop = asyncio.get_event_loop()
+
+
+class FakeTimer:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TTLCacheTest(TestCase):
+
+    def setUp(self) -> None:
+        self.timer = FakeTimer()
+        self.cache = TTLCache(maxsize=2, ttl=10, timer=self.timer)
+
+    def test_get_counts_hits_and_misses(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_entry_expires(self):
+        self.cache.set('a', 1)
+        self.timer.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_least_recently_used_evicted(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_pop(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.pop('a'), 1)
+        self.assertIsNone(self.cache.pop('a'))
+
+
+class EnsureIndexesTest(TestCase):
+
+    def tearDown(self) -> None:
+        loop.run_until_complete(engine.client.drop_database('test'))
+
+    def test_declared_indexes_created_and_stale_dropped(self):
+        collection = engine.get_collection(Post)
+        loop.run_until_complete(collection.create_index('title', name='title_1'))
+        loop.run_until_complete(ensure_indexes(engine, Post, Post.__indexes__))
+        names = set(loop.run_until_complete(collection.index_information()))
+        self.assertEqual(names, {'_id_', 'title_1', *(index.name for index in Post.__indexes__)})
+        loop.run_until_complete(ensure_indexes(engine, Post, Post.__indexes__, drop_undeclared=True))
+        names = set(loop.run_until_complete(collection.index_information()))
+        self.assertEqual(names, {'_id_', *(index.name for index in Post.__indexes__)})
+
+    def test_index_dropped_by_other_worker_skipped(self):
+        collection = engine.get_collection(Post)
+        loop.run_until_complete(collection.create_index('title', name='title_1'))
+        loop.run_until_complete(drop_index_if_exists(collection, 'title_1'))
+        loop.run_until_complete(drop_index_if_exists(collection, 'title_1'))
+        self.assertNotIn('title_1', loop.run_until_complete(collection.index_information()))
+
+
+class SingleFlightTest(TestCase):
+
+    def test_concurrent_calls_share_result(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        async def run_many():
+            return await asyncio.gather(*(flight.run('key', compute) for _ in range(5)))
+
+        self.assertEqual(loop.run_until_complete(run_many()), [1] * 5)
+        self.assertEqual(len(calls), 1)
+
+
+class PasswordHasherTest(TestCase):
+
+    def setUp(self) -> None:
+        self.hasher = PasswordHasher(workers=1, queue_size=1)
+
+    def tearDown(self) -> None:
+        self.hasher.shutdown()
+
+    def test_runs_in_worker_thread(self):
+        result = loop.run_until_complete(self.hasher.run(threading.current_thread))
+        self.assertIsNot(result, threading.current_thread())
+        self.assertEqual(self.hasher.pending, 0)
+
+    def test_rejects_calls_over_queue_limit(self):
+        release = threading.Event()
+
+        async def run_many():
+            return await asyncio.gather(
+                *(self.hasher.run(release.wait) for _ in range(3)),
+                return_exceptions=True,
+            )
+
+        loop.call_later(0.05, release.set)
+        results = loop.run_until_complete(run_many())
+        self.assertEqual(results[:2], [True, True])
+        self.assertIsInstance(results[2], PasswordHasherBusy)
+
+
+class ResponsesTest(TestCase):
+
+    def test_dumps_encodes_bson_types(self):
+        post_id = ObjectId()
+        date = dt.datetime(2021, 1, 2, 3, 4, 5)
+        self.assertEqual(
+            json.loads(dumps({'id': post_id, 'date': date})),
+            {'id': str(post_id), 'date': '2021-01-02T03:04:05'},
+        )
+
+    def test_model_response_of_constructed_model(self):
+        like = Like(post=ObjectId(), user_id=ObjectId(), date=dt.datetime(2021, 1, 2))
+        status = LikeStatus.construct(post_id=like.post, liked=True, like_count=1, like=like)
+        content = json.loads(model_response(status).body)
+        self.assertEqual(content['like']['id'], str(like.id))
+        self.assertEqual(content['post_id'], str(like.post))
+
+
+class MemoryStorageTest(TestCase):
+
+    def setUp(self) -> None:
+        self.storage = MemoryStorage('test')
+        self.collection = self.storage.get_database()['items']
+        loop.run_until_complete(self.collection.create_index('name', name='name_1', unique=True))
+
+    def test_unique_index_rejects_duplicates(self):
+        loop.run_until_complete(self.collection.insert_one({'name': 'a'}))
+        with self.assertRaises(DuplicateKeyError):
+            loop.run_until_complete(self.collection.insert_one({'name': 'a'}))
+        with self.assertRaises(BulkWriteError) as error:
+            loop.run_until_complete(self.collection.insert_many(
+                [{'name': 'b'}, {'name': 'a'}, {'name': 'c'}], ordered=False
+            ))
+        self.assertEqual([e['index'] for e in error.exception.details['writeErrors']], [1])
+        self.assertEqual(loop.run_until_complete(self.collection.count_documents({})), 3)
+
+    def test_find_filters_sorts_and_projects(self):
+        loop.run_until_complete(self.collection.insert_many(
+            [{'name': name, 'n': n} for name, n in (('a', 3), ('b', 1), ('c', 2), ('d', 5))]
+        ))
+        cursor = self.collection.find({'n': {'$gte': 2}, 'name': {'$regex': '^[a-c]'}}, {'name': 1, '_id': 0})
+        docs = loop.run_until_complete(cursor.sort('n', -1).limit(2).to_list(length=None))
+        self.assertEqual(docs, [{'name': 'a'}, {'name': 'c'}])
+        doc = loop.run_until_complete(self.collection.find_one({'name': 'b'}))
+        self.assertEqual(doc['n'], 1)
+
+    def test_update_operators_and_upsert(self):
+        loop.run_until_complete(self.collection.insert_one({'name': 'a', 'n': 1}))
+        doc = loop.run_until_complete(self.collection.find_one_and_update(
+            {'name': 'a'}, {'$inc': {'n': 2}, '$set': {'tag': 'x'}}, return_document=ReturnDocument.AFTER
+        ))
+        self.assertEqual((doc['n'], doc['tag']), (3, 'x'))
+        loop.run_until_complete(self.collection.update_one({'name': 'b'}, {'$inc': {'n': 1}}, upsert=True))
+        doc = loop.run_until_complete(self.collection.find_one({'name': 'b'}))
+        self.assertEqual(doc['n'], 1)
+
+    def test_projection_of_id_only(self):
+        doc = {'_id': 1, 'name': 'a', 'password': 'secret'}
+        self.assertEqual(project(doc, {'_id': 1}), {'_id': 1})
+        self.assertEqual(project(doc, {'_id': 0}), {'name': 'a', 'password': 'secret'})
+        loop.run_until_complete(self.collection.insert_one(doc))
+        cursor = self.collection.aggregate([{'$match': {}}, {'$project': {'_id': 1}}])
+        self.assertEqual(loop.run_until_complete(cursor.to_list(length=None)), [{'_id': 1}])
+
+    def test_replacement_can_not_change_id(self):
+        loop.run_until_complete(self.collection.insert_one({'_id': 1, 'name': 'a'}))
+        loop.run_until_complete(self.collection.replace_one({'name': 'a'}, {'_id': 1, 'name': 'b'}))
+        with self.assertRaises(OperationFailure):
+            loop.run_until_complete(self.collection.replace_one({'name': 'b'}, {'_id': 2, 'name': 'c'}))
+        with self.assertRaises(BulkWriteError) as error:
+            loop.run_until_complete(self.collection.bulk_write([ReplaceOne({'name': 'b'}, {'_id': 2, 'name': 'c'})]))
+        self.assertEqual(error.exception.details['writeErrors'][0]['code'], 66)
+        self.assertEqual(loop.run_until_complete(self.collection.find_one({})), {'_id': 1, 'name': 'b'})
+
+    def test_aggregate_groups_and_facets(self):
+        day = dt.datetime(2021, 1, 1)
+        loop.run_until_complete(self.collection.insert_many(
+            [{'name': str(i), 'date': day + dt.timedelta(days=i % 2)} for i in range(5)]
+        ))
+        cursor = self.collection.aggregate([
+            {'$group': {'_id': '$date', 'count': {'$sum': 1}}},
+            {'$sort': {'_id': 1}},
+        ])
+        self.assertEqual(
+            loop.run_until_complete(cursor.to_list(length=None)),
+            [{'_id': day, 'count': 3}, {'_id': day + dt.timedelta(days=1), 'count': 2}],
+        )
+        cursor = self.collection.aggregate([
+            {'$match': {}},
+            {'$facet': {'items': [{'$limit': 2}, {'$project': {'name': 1}}], 'count': [{'$count': 'count'}]}},
+        ])
+        result, = loop.run_until_complete(cursor.to_list(length=1))
+        self.assertEqual(len(result['items']), 2)
+        self.assertEqual(result['count'], [{'count': 5}])
+
+    def test_dropped_database_is_cleared_in_place(self):
+        loop.run_until_complete(self.collection.insert_one({'name': 'a'}))
+        loop.run_until_complete(self.storage.client.drop_database('test'))
+        self.assertEqual(loop.run_until_complete(self.collection.count_documents({})), 0)
+        self.assertEqual(list(loop.run_until_complete(self.collection.index_information())), ['_id_'])
+
+
+class StorageLifecycleTest(TestCase):
+
+    def setUp(self) -> None:
+        self.storage = MongoStorage('mongodb://localhost:27017', 'test', maxPoolSize=5)
+
+    def tearDown(self) -> None:
+        loop.run_until_complete(self.storage.close())
+
+    def test_client_created_on_connect_and_released_on_close(self):
+        engine = self.storage.engine
+        self.assertFalse(self.storage.connected)
+        client = self.storage.connect()
+        self.assertIs(engine.client, client)
+        self.assertEqual(client.options.pool_options.max_pool_size, 5)
+        loop.run_until_complete(self.storage.close())
+        self.assertFalse(self.storage.connected)
+        self.assertIsNot(engine.client, client)
+
+    def test_engine_for_read_preference(self):
+        engine = self.storage.engine_for('secondaryPreferred')
+        self.assertIs(self.storage.engine_for('secondaryPreferred'), engine)
+        self.assertEqual(engine.get_collection(Post).read_preference, ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(self.storage.engine.get_collection(Post).read_preference, ReadPreference.PRIMARY)
+
+
+class ServeOptionsTest(TestCase):
+
+    def test_workers_default_to_cpu_count(self):
+        options = server_options(workers=0, max_requests=0)
+        self.assertEqual(options['workers'], usable_cpu_count())
+        self.assertIsNone(options['limit_max_requests'])
+        self.assertEqual(server_options(workers=3, max_requests=100)['limit_max_requests'], 100)
+
+
+class MetricsTest(TestCase):
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = Histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, '/a')
+        lines = histogram.render({'worker': '1'})
+        self.assertIn('latency_seconds_bucket{worker="1",route="/a",le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{worker="1",route="/a",le="1.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{worker="1",route="/a",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_count{worker="1",route="/a"} 4', lines)
+
+    def test_storage_operations_passed_to_listeners(self):
+        storage = MemoryStorage('test')
+        operations = []
+        storage.add_listener(operations.append)
+        collection = storage.get_database()['items']
+        loop.run_until_complete(collection.insert_one({'n': 1}))
+        loop.run_until_complete(collection.find({'n': 1}).sort('n', -1).to_list(length=None))
+        self.assertEqual([(op.collection, op.name) for op in operations], [('items', 'insert_one'), ('items', 'find')])
+        self.assertEqual(operations[1].args, ({'n': 1},))
+        self.assertEqual(operations[1].kwargs['sort'], ('n', -1))
+
+
+class ModelDefaultsTest(TestCase):
+
+    def test_creation_times_taken_per_instance(self):
+        first_post = Post(title='a', text='b', owner=ObjectId())
+        first_user = User(email='a@mail.com', username='a', password='a')
+        time.sleep(0.01)
+        self.assertGreater(Post(title='a', text='b', owner=ObjectId()).created_at, first_post.created_at)
+        self.assertGreater(
+            User(email='b@mail.com', username='b', password='b').registration_date, first_user.registration_date
+        )
+
+
+class RequestTimeBufferTest(TestCase):
+
+    def test_stop_logs_failed_flush(self):
+        buffer = RequestTimeBuffer(60)
+        buffer.touch(engine, ObjectId())
+
+        async def flush():
+            raise ServerSelectionTimeoutError('no servers')
+
+        buffer.flush = flush
+        with self.assertLogs('server.utils.activity', 'ERROR'):
+            loop.run_until_complete(buffer.stop())
+
+
+class SlowQueryShapeTest(TestCase):
+
+    def test_values_replaced_and_structure_kept(self):
+        query = {'$or': [{'title': {'$regex': 'abc', '$options': 'i'}}, {'_id': {'$in': [1, 2, 3]}}], 'owner': 5}
+        self.assertEqual(query_shape(query), {
+            '$or': [{'title': {'$regex': '?', '$options': '?'}}, {'_id': {'$in': '?'}}], 'owner': '?',
+        })
+
+    def test_explain_command_of_find_keeps_values_and_sort(self):
+        operation = Operation('post', 'find', 0.5, ({'owner': 5},), {'sort': [('created_at', -1)], 'limit': 10})
+        command = explain_command(operation)
+        self.assertEqual(command['verbosity'], 'queryPlanner')
+        self.assertEqual(dict(command['explain']), {
+            'find': 'post', 'filter': {'owner': 5}, 'sort': {'created_at': -1}, 'limit': 10,
+        })
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional
+
+from odmantic import AIOEngine
+from odmantic.bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from server.settings import REQUEST_TIME_FLUSH_INTERVAL
+from server.models.user import User
+
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimeBuffer:
+    '''
+    Write-behind buffer for User.last_request.
+
+    Keeps only the latest request time per user and writes all pending
+    values with one unordered bulk update on every flush. Values are written
+    with the engine of the request which touched them.
+
+    Parameters:
+        interval (float): Seconds between background flushes
+    '''
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._pending: Dict[AIOEngine, Dict[ObjectId, datetime]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def touch(self, engine: AIOEngine, user_id: ObjectId, time: Optional[datetime] = None) -> datetime:
+        time = time or datetime.now()
+        pending = self._pending.setdefault(engine, {})
+        if pending.get(user_id, time) <= time:
+            pending[user_id] = time
+        return pending[user_id]
+
+    def get(self, user_id: ObjectId) -> Optional[datetime]:
+        times = [pending[user_id] for pending in self._pending.values() if user_id in pending]
+        return max(times) if times else None
+
+    async def flush(self) -> int:
+        pending_by_engine, self._pending = self._pending, {}
+        flushed, failure = 0, None
+        for engine, pending in pending_by_engine.items():
+            try:
+                flushed += await self._write(engine, pending)
+            except PyMongoError as error:
+                # keep values for the next flush unless newer ones came in
+                for user_id, time in pending.items():
+                    self.touch(engine, user_id, time)
+                failure = error
+        if failure is not None:
+            raise failure
+        return flushed
+
+    async def _write(self, engine: AIOEngine, pending: Dict[ObjectId, datetime]) -> int:
+        field = +User.last_request
+        operations = [
+            UpdateOne(
+                {'_id': user_id, '$or': [{field: None}, {field: {'$lt': time}}]},
+                {'$set': {field: time}, '$inc': {+User.version: 1}},
+            )
+            for user_id, time in pending.items()
+        ]
+        await engine.get_collection(User).bulk_write(operations, ordered=False)
+        return len(operations)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except PyMongoError:
+                logger.exception('Failed to flush request times')
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # errors must not stop the remaining shutdown hooks
+        try:
+            await self.flush()
+        except PyMongoError:
+            logger.exception('Failed to flush request times on shutdown')
+
+
+request_time_buffer = RequestTimeBuffer(REQUEST_TIME_FLUSH_INTERVAL)
@@ -0,0 +1,47 @@
+'''
+Scope of the HTTP request being handled, for code running below the routers
+like database listeners
+'''
+import contextvars
+from typing import Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+current_scope: contextvars.ContextVar[Optional[Scope]] = contextvars.ContextVar('current_scope', default=None)
+
+
+def route_template(scope: Scope) -> str:
+    '''
+    Path template of matched route like "/api/posts/{post_id}", so metrics
+    and logs do not get a value per object id
+    '''
+    route = scope.get('route')
+    return getattr(route, 'path', None) or 'unmatched'
+
+
+def current_route() -> Optional[str]:
+    '''
+    Route template of current request, None outside of requests
+    '''
+    scope = current_scope.get()
+    return None if scope is None else f"{scope['method']} {route_template(scope)}"
+
+
+class RequestContextMiddleware:
+    '''
+    ASGI middleware making scope of HTTP request available with current_scope
+    '''
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        token = current_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_scope.reset(token)
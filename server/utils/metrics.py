@@ -0,0 +1,197 @@
+'''
+Request and database metrics exposed in Prometheus text format.
+Values are kept per worker process, every sample has worker label with pid.
+'''
+import bisect
+import contextvars
+import math
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from server.storage import Operation
+from server.utils.context import route_template
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+DB_CALLS_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    return ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self, base_labels: Dict[str, str]) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self, base_labels: Dict[str, str]) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+            *self.samples(base_labels),
+        ]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self, base_labels: Dict[str, str]) -> Iterable[str]:
+        names = (*base_labels, *self.labelnames)
+        for labels, value in sorted(self._values.items()):
+            yield f'{self.name}{{{_format_labels(names, (*base_labels.values(), *labels))}}} {_format_value(value)}'
+
+
+class Histogram(Metric):
+    '''
+    Histogram with fixed buckets, counts are stored per bucket and made
+    cumulative only when rendered so observe is a bisect and two additions
+    '''
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = HTTP_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per labels: counts of buckets plus +Inf, sum
+        self._values: Dict[Tuple, List] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        item = self._values.get(labels)
+        if item is None:
+            item = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        item[0][bisect.bisect_left(self.buckets, value)] += 1
+        item[1] += value
+
+    def count(self, *labels: str) -> int:
+        item = self._values.get(labels)
+        return sum(item[0]) if item else 0
+
+    def samples(self, base_labels: Dict[str, str]) -> Iterable[str]:
+        names = (*base_labels, *self.labelnames)
+        for labels, (counts, total) in sorted(self._values.items()):
+            label_text = _format_labels(names, (*base_labels.values(), *labels))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{{{label_text},le="{_format_value(float(bound))}"}} {cumulative}'
+            yield f'{self.name}_sum{{{label_text}}} {_format_value(total)}'
+            yield f'{self.name}_count{{{label_text}}} {cumulative}'
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        base_labels = {'worker': str(os.getpid())}
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(base_labels))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    'http_requests_total', 'Finished HTTP requests by route template and status code',
+    ('method', 'route', 'status'),
+))
+http_request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time from request start to end of response by route template',
+    ('method', 'route'), HTTP_BUCKETS,
+))
+http_request_db_calls = registry.register(Histogram(
+    'http_request_db_operations', 'Database operations made by one request by route template',
+    ('method', 'route'), DB_CALLS_BUCKETS,
+))
+db_operation_duration = registry.register(Histogram(
+    'db_operation_duration_seconds', 'Duration of database operations by collection and operation',
+    ('collection', 'operation'), DB_BUCKETS,
+))
+
+# database operations of current request, a list so nested tasks share it
+request_db_calls: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar(
+    'request_db_calls', default=None
+)
+
+
+def record_db_operation(operation: Operation) -> None:
+    '''
+    Storage listener counting database operations
+    '''
+    db_operation_duration.observe(operation.seconds, operation.collection, operation.name)
+    calls = request_db_calls.get()
+    if calls is not None:
+        calls[0] += 1
+
+
+class MetricsMiddleware:
+    '''
+    ASGI middleware recording latency, status and number of database
+    operations of every HTTP request
+    '''
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        calls = [0]
+        token = request_db_calls.set(calls)
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - started
+            request_db_calls.reset(token)
+            method, route = scope['method'], route_template(scope)
+            http_requests.inc(method, route, str(status))
+            http_request_duration.observe(duration, method, route)
+            http_request_db_calls.observe(calls[0], method, route)
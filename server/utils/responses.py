@@ -0,0 +1,84 @@
+import datetime as dt
+import hashlib
+import json
+from typing import Any, Optional
+
+from bson.objectid import ObjectId
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def json_default(value: Any) -> Any:
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    if isinstance(value, BaseModel):
+        return value.dict()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(content: Any) -> bytes:
+    '''
+    Serializes content with orjson when it is installed, falls back to json
+    '''
+    if orjson is not None:
+        return orjson.dumps(content, default=json_default)
+    return json.dumps(
+        content, default=json_default, ensure_ascii=False, separators=(',', ':')
+    ).encode('utf-8')
+
+
+class FastJSONResponse(JSONResponse):
+    '''
+    JSON response rendered with orjson, also knows how to encode ObjectId,
+    datetime and pydantic models
+    '''
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def model_response(instance: BaseModel, status_code: int = 200, **dict_kwargs: Any) -> FastJSONResponse:
+    '''
+    Returns already validated model as response. FastAPI passes Response
+    objects through as is, so response_model of route is used only for docs
+    and the model is not validated and encoded a second time.
+    '''
+    return FastJSONResponse(instance.dict(**dict_kwargs), status_code=status_code)
+
+
+def make_etag(*parts: Any) -> str:
+    return '"' + hashlib.sha1(repr(parts).encode()).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    '''
+    Checks If-None-Match header, weak and strong tags are compared the same way
+    '''
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={'ETag': etag})
+
+
+def etag_response(content: Any, if_none_match: Optional[str] = None) -> Response:
+    '''
+    Returns content with ETag hashed from its body or 304 if client has it,
+    used for lists where there is no single version to compare
+    '''
+    response = FastJSONResponse(content)
+    etag = make_etag(response.body)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers['ETag'] = etag
+    return response
@@ -0,0 +1,165 @@
+import math
+import re
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Sequence, Tuple, Type
+
+from odmantic import AIOEngine, Model
+from odmantic.bson import ObjectId
+from odmantic.field import FieldProxy
+from pymongo import TEXT
+
+from server.settings import SEARCH_BACKEND, SEARCH_MAX_RESULTS
+from server.models.indexes import Index
+
+
+class SearchQuery(NamedTuple):
+    '''
+    query: filter selecting documents matching search string
+    sort_stages: aggregation stages ordering matched documents by relevance
+    '''
+    query: Dict
+    sort_stages: List[Dict]
+
+
+class SearchBackend(ABC):
+    '''
+    Full text search used by Selector for q parameter.
+    Models and their searchable fields are registered by get_selector.
+    '''
+
+    def __init__(self) -> None:
+        self._fields: Dict[Type[Model], Tuple[FieldProxy, ...]] = {}
+
+    def register(self, model: Type[Model], *fields: FieldProxy) -> None:
+        self._fields[model] = tuple(fields)
+
+    def get_indexes(self, model: Type[Model]) -> Sequence[Index]:
+        '''
+        Database indexes required by backend, created along with model ones
+        '''
+        return ()
+
+    async def setup(self, engine: AIOEngine) -> None:
+        '''
+        Called on application startup after database indexes are created
+        '''
+
+    def index_object(self, instance: Model) -> None:
+        '''
+        Called after instance was created or updated
+        '''
+
+    def remove_object(self, instance: Model) -> None:
+        '''
+        Called after instance was deleted
+        '''
+
+    @abstractmethod
+    def search(self, model: Type[Model], q: str) -> SearchQuery:
+        ...
+
+
+class MongoTextSearch(SearchBackend):
+    '''
+    Uses MongoDB text index built over registered fields
+    '''
+
+    def get_indexes(self, model: Type[Model]) -> Sequence[Index]:
+        if model not in self._fields:
+            return ()
+        return (Index(*((+field, TEXT) for field in self._fields[model]), name='text'),)
+
+    def search(self, model: Type[Model], q: str) -> SearchQuery:
+        return SearchQuery(
+            query={'$text': {'$search': q}},
+            sort_stages=[{'$sort': {'score': {'$meta': 'textScore'}}}],
+        )
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r'\w+', text.lower())
+
+
+class InvertedIndexSearch(SearchBackend):
+    '''
+    In-process inverted index, used when there is no MongoDB text index
+    available, for example in test environment. Every worker keeps its own index.
+    '''
+
+    def __init__(self, max_results: int) -> None:
+        super().__init__()
+        self.max_results = max_results
+        # model -> token -> document id -> term frequency
+        self._index: Dict[Type[Model], Dict[str, Dict[ObjectId, int]]] = defaultdict(
+            lambda: defaultdict(dict)
+        )
+        self._tokens: Dict[Type[Model], Dict[ObjectId, List[str]]] = defaultdict(dict)
+
+    async def setup(self, engine: AIOEngine) -> None:
+        for model, fields in self._fields.items():
+            projection = {+field: 1 for field in fields}
+            async for doc in engine.get_collection(model).find({}, projection):
+                self._add(model, doc['_id'], doc)
+
+    def clear(self) -> None:
+        self._index.clear()
+        self._tokens.clear()
+
+    def index_object(self, instance: Model) -> None:
+        model = type(instance)
+        if model in self._fields:
+            self.remove_object(instance)
+            self._add(model, instance.id, instance.doc())
+
+    def remove_object(self, instance: Model) -> None:
+        model = type(instance)
+        index = self._index[model]
+        for token in self._tokens[model].pop(instance.id, []):
+            postings = index[token]
+            postings.pop(instance.id, None)
+            if not postings:
+                del index[token]
+
+    def _add(self, model: Type[Model], object_id: ObjectId, doc: Dict) -> None:
+        tokens = []
+        for field in self._fields[model]:
+            value = doc.get(+field)
+            if isinstance(value, str):
+                tokens += tokenize(value)
+        index = self._index[model]
+        for token in tokens:
+            postings = index[token]
+            postings[object_id] = postings.get(object_id, 0) + 1
+        self._tokens[model][object_id] = list(set(tokens))
+
+    def search(self, model: Type[Model], q: str) -> SearchQuery:
+        index = self._index[model]
+        total = max(len(self._tokens[model]), 1)
+        scores: Dict[ObjectId, float] = defaultdict(float)
+        for token in set(tokenize(q)):
+            postings = index.get(token, {})
+            if not postings:
+                continue
+            idf = math.log(1 + total / len(postings))
+            for object_id, frequency in postings.items():
+                scores[object_id] += frequency * idf
+        ranked = sorted(scores, key=lambda object_id: (-scores[object_id], object_id))
+        ranked = ranked[:self.max_results]
+        return SearchQuery(
+            query={'_id': {'$in': ranked}},
+            sort_stages=[
+                {'$addFields': {'_rank': {'$indexOfArray': [ranked, '$_id']}}},
+                {'$sort': {'_rank': 1}},
+                {'$project': {'_rank': 0}},
+            ],
+        )
+
+
+def get_search_backend(name: str) -> SearchBackend:
+    if name == 'memory':
+        return InvertedIndexSearch(SEARCH_MAX_RESULTS)
+    return MongoTextSearch()
+
+
+search_backend = get_search_backend(SEARCH_BACKEND)
@@ -1,8 +1,12 @@
-from typing import Union
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, Union
 from fastapi_jwt_auth.auth_jwt import AuthJWT
 from passlib.context import CryptContext
 from pydantic.main import BaseModel
 
+from server.settings import PASSWORD_HASH_QUEUE_SIZE, PASSWORD_HASH_WORKERS
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
@@ -14,6 +18,61 @@ def verify_password(raw_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(raw_password, hashed_password)
 
 
+class PasswordHasherBusy(Exception):
+    '''
+    Raised when password hasher queue is full
+    '''
+
+
+class PasswordHasher:
+    '''
+    Runs password hashing on bounded thread pool so it does not block event loop.
+    bcrypt releases GIL while hashing, so threads hash in parallel.
+
+    Parameters:
+        workers (int): Number of hashing threads
+        queue_size (int): Number of calls allowed to wait for a free thread,
+            calls over the limit raise PasswordHasherBusy
+    '''
+
+    def __init__(self, workers: int, queue_size: int) -> None:
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hasher')
+        return self._executor
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        if self.pending >= self.workers + self.queue_size:
+            raise PasswordHasherBusy()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_SIZE)
+
+
+async def hash_password_async(raw_password: str) -> str:
+    return await password_hasher.run(hash_password, raw_password)
+
+
+async def verify_password_async(raw_password: str, hashed_password: str) -> bool:
+    return await password_hasher.run(verify_password, raw_password, hashed_password)
+
+
 class JwtTokenPair(BaseModel):
     access_token: str
     refresh_token: str
@@ -26,4 +85,3 @@ def create_tokens(Authorize: AuthJWT, sub: Union[str, int], *, is_admin: bool, *
         refresh_token = Authorize.create_refresh_token(sub, user_claims=user_claims)
     )
     
-
@@ -0,0 +1,260 @@
+'''
+Log of database operations slower than a threshold, grouped by query shape.
+The shape is the filter with every value replaced by "?", so queries which
+differ only by values are counted together and no user data is logged.
+'''
+import asyncio
+import json
+import logging
+from collections import Counter, OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Mapping, Optional, Set
+
+from bson.son import SON
+from pymongo.errors import PyMongoError
+
+from server.settings import storage, SLOW_QUERY_EXPLAIN, SLOW_QUERY_MAX_SHAPES, SLOW_QUERY_MS
+from server.storage import Operation
+from server.utils.context import current_route
+
+
+logger = logging.getLogger(__name__)
+
+# durations kept per shape for percentiles
+SAMPLES_PER_SHAPE = 1000
+PERCENTILES = (50, 90, 99)
+# index management is slow by nature and has no filter
+IGNORED_OPERATIONS = frozenset((
+    'create_index', 'create_indexes', 'drop_index', 'drop_indexes', 'index_information', 'list_indexes',
+))
+
+
+def query_shape(value: Any) -> Any:
+    '''
+    Replaces values of query with "?", keeps field names, operators and
+    arrays of subqueries like $or
+    '''
+    if isinstance(value, Mapping):
+        # field names built from odmantic fields are str subclasses
+        return {str(key): query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) and value and all(isinstance(item, Mapping) for item in value):
+        return [query_shape(item) for item in value]
+    return '?'
+
+
+def pipeline_shape(pipeline: List[Mapping]) -> List[Dict]:
+    '''
+    Shape of aggregation pipeline, $sort stages are kept as they are
+    '''
+    shape = []
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        if name == '$sort':
+            shape.append({name: {str(key): direction for key, direction in spec.items()}})
+        elif name == '$facet':
+            shape.append({name: {key: pipeline_shape(value) for key, value in spec.items()}})
+        else:
+            shape.append({name: query_shape(spec)})
+    return shape
+
+
+def normalize_sort(sort: Any) -> Optional[List[List]]:
+    '''
+    Converts sort given to pymongo like "field", ("field", 1) or [("field", 1)]
+    to list of [field, direction]
+    '''
+    if not sort:
+        return None
+    if isinstance(sort, str):
+        return [[str(sort), 1]]
+    if isinstance(sort, Mapping):
+        return [[str(key), direction] for key, direction in sort.items()]
+    if isinstance(sort, tuple) and len(sort) == 2 and isinstance(sort[0], str) and not isinstance(sort[1], (list, tuple)):
+        return [[str(sort[0]), sort[1]]]
+    return [[str(key), direction] for key, direction in sort]
+
+
+def operation_filter(operation: Operation) -> Mapping:
+    if operation.args and isinstance(operation.args[0], Mapping):
+        return operation.args[0]
+    return operation.kwargs.get('filter') or {}
+
+
+def operation_pipeline(operation: Operation) -> List[Mapping]:
+    return list(operation.args[0] if operation.args else operation.kwargs.get('pipeline', []))
+
+
+def explain_command(operation: Operation) -> Optional[SON]:
+    '''
+    Returns explain command of operation with its actual values, None if
+    operation can not be explained. Plans are only computed, writes are not run.
+    '''
+    collection, name = operation.collection, operation.name
+    sort = normalize_sort(operation.kwargs.get('sort'))
+    sort = SON(sort) if sort else None
+    if name == 'aggregate':
+        command = SON([('aggregate', collection), ('pipeline', operation_pipeline(operation)), ('cursor', {})])
+    elif name in ('find', 'find_one'):
+        command = SON([('find', collection), ('filter', operation_filter(operation))])
+        if sort:
+            command['sort'] = sort
+        if name == 'find_one':
+            command['limit'] = 1
+        elif operation.kwargs.get('limit'):
+            command['limit'] = operation.kwargs['limit']
+    elif name == 'count_documents':
+        command = SON([('count', collection), ('query', operation_filter(operation))])
+    elif name == 'distinct':
+        command = SON([('distinct', collection), ('key', operation.args[0]), ('query', operation.kwargs.get('filter') or {})])
+    elif name in ('update_one', 'update_many', 'replace_one'):
+        update = operation.args[1] if len(operation.args) > 1 else operation.kwargs.get('update', operation.kwargs.get('replacement'))
+        command = SON([('update', collection), ('updates', [
+            {'q': operation_filter(operation), 'u': update, 'multi': name == 'update_many'},
+        ])])
+    elif name in ('delete_one', 'delete_many'):
+        command = SON([('delete', collection), ('deletes', [
+            {'q': operation_filter(operation), 'limit': 1 if name == 'delete_one' else 0},
+        ])])
+    elif name in ('find_one_and_update', 'find_one_and_replace', 'find_one_and_delete'):
+        command = SON([('findAndModify', collection), ('query', operation_filter(operation))])
+        if name == 'find_one_and_delete':
+            command['remove'] = True
+        else:
+            command['update'] = operation.args[1] if len(operation.args) > 1 else operation.kwargs.get('update')
+        if sort:
+            command['sort'] = sort
+    else:
+        return None
+    return SON([('explain', command), ('verbosity', 'queryPlanner')])
+
+
+class QueryShapeStats:
+
+    def __init__(self, collection: str, operation: str, shape: Any, sort: Optional[List[List]]) -> None:
+        self.collection = collection
+        self.operation = operation
+        self.shape = shape
+        self.sort = sort
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.durations: Deque[float] = deque(maxlen=SAMPLES_PER_SHAPE)
+        self.routes: Counter = Counter()
+        self.plan: Optional[Dict] = None
+
+    def add(self, seconds: float, route: Optional[str]) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.durations.append(seconds)
+        self.routes[route or 'background'] += 1
+
+    def percentile(self, percent: float) -> float:
+        durations = sorted(self.durations)
+        if not durations:
+            return 0.0
+        return durations[min(len(durations) - 1, max(0, round(len(durations) * percent / 100) - 1))]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'collection': self.collection,
+            'operation': self.operation,
+            'shape': self.shape,
+            'sort': self.sort,
+            'count': self.count,
+            'total_ms': round(self.total * 1000, 2),
+            **{f'p{p}_ms': round(self.percentile(p) * 1000, 2) for p in PERCENTILES},
+            'max_ms': round(self.max * 1000, 2),
+            'routes': dict(self.routes.most_common(5)),
+            'plan': self.plan,
+        }
+
+
+class SlowQueryLog:
+    '''
+    Storage listener logging operations slower than threshold and keeping
+    their statistics by query shape. An explain plan is captured in background
+    for the first slow operation of every shape.
+
+    Parameters:
+        threshold (float): Seconds from which operation is logged
+        max_shapes (int): Number of shapes kept, least recently seen are dropped
+        explain (Callable): Coroutine function running explain command, None disables plans
+    '''
+
+    def __init__(
+        self,
+        threshold: float,
+        max_shapes: int,
+        explain: Optional[Callable[[SON], Any]] = None,
+    ) -> None:
+        self.threshold = threshold
+        self.max_shapes = max_shapes
+        self.explain = explain
+        self._shapes: 'OrderedDict[str, QueryShapeStats]' = OrderedDict()
+        self._explaining: Set[asyncio.Task] = set()
+
+    def record(self, operation: Operation) -> None:
+        if operation.seconds < self.threshold or operation.name in IGNORED_OPERATIONS:
+            return
+        if operation.name == 'aggregate':
+            shape = pipeline_shape(operation_pipeline(operation))
+        else:
+            shape = query_shape(operation_filter(operation))
+        sort = normalize_sort(operation.kwargs.get('sort'))
+        key = json.dumps([operation.collection, operation.name, shape, sort], default=str)
+        stats = self._shapes.get(key)
+        new_shape = stats is None
+        if new_shape:
+            stats = self._shapes[key] = QueryShapeStats(operation.collection, operation.name, shape, sort)
+            while len(self._shapes) > self.max_shapes:
+                self._shapes.popitem(last=False)
+        else:
+            self._shapes.move_to_end(key)
+        route = current_route()
+        stats.add(operation.seconds, route)
+        logger.warning(
+            'Slow %s on %s took %.1f ms, route %s, filter %s, sort %s',
+            operation.name, operation.collection, operation.seconds * 1000,
+            route, json.dumps(shape, default=str), sort,
+        )
+        if new_shape and self.explain is not None:
+            command = explain_command(operation)
+            if command is not None:
+                task = asyncio.ensure_future(self._capture_plan(stats, command))
+                self._explaining.add(task)
+                task.add_done_callback(self._explaining.discard)
+
+    async def _capture_plan(self, stats: QueryShapeStats, command: SON) -> None:
+        try:
+            result = await self.explain(command)
+        except PyMongoError as error:
+            stats.plan = {'error': str(error)}
+            return
+        plan = {
+            key: value for key, value in result.items()
+            if key not in ('ok', 'serverInfo', 'serverParameters', 'command', '$clusterTime', 'operationTime')
+        }
+        # plans contain bson types like Regex, they are kept as plain json
+        stats.plan = json.loads(json.dumps(plan, default=str))
+        logger.warning(
+            'Plan of slow %s on %s, filter %s: %s',
+            stats.operation, stats.collection, json.dumps(stats.shape, default=str),
+            json.dumps(stats.plan, default=str),
+        )
+
+    def top(self, limit: int = 20) -> List[Dict[str, Any]]:
+        '''
+        Returns statistics of shapes with the largest total time first
+        '''
+        shapes = sorted(self._shapes.values(), key=lambda stats: stats.total, reverse=True)
+        return [stats.to_dict() for stats in shapes[:limit]]
+
+    def clear(self) -> None:
+        self._shapes.clear()
+
+
+async def explain(command: SON) -> Dict:
+    return await storage.get_database().command(command)
+
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_MS / 1000, SLOW_QUERY_MAX_SHAPES, explain if SLOW_QUERY_EXPLAIN else None)